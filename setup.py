@@ -1,7 +1,7 @@
 from setuptools import setup
 
 setup(
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     name='wavtoflac',
     version='1.0',
     packages=['wavtoflac'],
@@ -10,7 +10,10 @@ setup(
     author='Laurent Mertens',
     author_email='laurent.mertens@outlook.com',
     description='WAV To Flac',
+    entry_points={'console_scripts': ['wavtoflac = wavtoflac.cli:main']},
     install_requires=['mutagen',
                       'pydub',
-                      'termcolor']
+                      'termcolor'],
+    extras_require={'analysis': ['numpy'],
+                    'test': ['numpy', 'pytest']}
 )
@@ -0,0 +1,81 @@
+"""
+Write small WAV and FLAC files for the tests, without an encoder: FLAC frames hold their samples verbatim.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import hashlib
+import struct
+
+from wavtoflac.verify import _crc8, _crc16
+
+# FLAC sample size codes, by number of bits per sample
+SAMPLE_SIZE_CODES = {8: 1, 12: 2, 16: 4, 20: 5, 24: 6, 32: 7}
+
+
+def pcm_bytes(samples, bits_per_sample):
+    """
+    Interleaved samples, as stored in a WAV file: unsigned for 8 bits, signed little endian otherwise.
+
+    :param samples: list of frames, each a tuple with one integer sample per channel.
+    """
+    width = bits_per_sample // 8
+    if bits_per_sample == 8:
+        return bytes(s + 128 for frame in samples for s in frame)
+    return b''.join(s.to_bytes(width, 'little', signed=True) for frame in samples for s in frame)
+
+
+def write_wav(path, samples, sample_rate=44100, bits_per_sample=16):
+    channels = len(samples[0])
+    data = pcm_bytes(samples, bits_per_sample)
+    block_align = channels * bits_per_sample // 8
+    fmt = struct.pack('<HHIIHH', 1, channels, sample_rate, sample_rate * block_align, block_align, bits_per_sample)
+    with open(path, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', 4 + 8 + len(fmt) + 8 + len(data)) + b'WAVE')
+        f.write(b'fmt ' + struct.pack('<I', len(fmt)) + fmt)
+        f.write(b'data' + struct.pack('<I', len(data)) + data)
+
+
+def _utf8_number(n):
+    if n < 0x80:
+        return bytes([n])
+    nb_bytes = 2
+    while n >= 1 << (5 * nb_bytes + 1):
+        nb_bytes += 1
+    out = []
+    for _ in range(nb_bytes - 1):
+        out.insert(0, 0x80 | (n & 0x3F))
+        n >>= 6
+    return bytes([((0xFF00 >> nb_bytes) & 0xFF) | n] + out)
+
+
+def write_flac(path, samples, sample_rate=44100, bits_per_sample=16, block_size=1024, md5_samples=None):
+    """
+    Write a FLAC file holding the samples.
+
+    :param samples: list of frames, each a tuple with one integer sample per channel (signed, also for 8 bits).
+    :param md5_samples: PCM data hashed into STREAMINFO; defaults to the samples, as FLAC encoders hash them.
+    """
+    channels = len(samples[0])
+    width = bits_per_sample // 8
+    frames = []
+    for number, start in enumerate(range(0, len(samples), block_size)):
+        block = samples[start:start + block_size]
+        header = bytes([0xFF, 0xF8, 0x70, ((channels - 1) << 4) | (SAMPLE_SIZE_CODES[bits_per_sample] << 1)])
+        header += _utf8_number(number) + struct.pack('>H', len(block) - 1)
+        header += bytes([_crc8(header)])
+        body = b''.join(b'\x02' + b''.join(frame[ch].to_bytes(width, 'big', signed=True) for frame in block)
+                        for ch in range(channels))
+        frame = header + body
+        frames.append(frame + struct.pack('>H', _crc16(frame)))
+
+    if md5_samples is None:
+        md5_samples = b''.join(s.to_bytes(width, 'little', signed=True) for frame in samples for s in frame)
+    max_frame = max(len(frame) for frame in frames)
+    info = struct.pack('>HH', block_size, block_size) + max_frame.to_bytes(3, 'big') * 2
+    info += ((sample_rate << 44) | ((channels - 1) << 41) | ((bits_per_sample - 1) << 36) |
+             len(samples)).to_bytes(8, 'big')
+    info += hashlib.md5(md5_samples).digest()
+    with open(path, 'wb') as f:
+        f.write(b'fLaC' + bytes([0x80, 0, 0, len(info)]) + info)
+        for frame in frames:
+            f.write(frame)
@@ -0,0 +1,22 @@
+import pytest
+
+from tests.library import write_library
+
+
+@pytest.fixture
+def w2f(tmp_path):
+    from wavtoflac.covercache import CoverCache
+    from wavtoflac.wavtoflac import WAVToFlac
+    return WAVToFlac(cover_cache=CoverCache(cache_dir=str(tmp_path / 'covers')))
+
+
+@pytest.fixture
+def library(tmp_path):
+    """
+    Source with a single album of two tracks and a cover, and an empty target; see tests.library.
+
+    :return: path_in, path_out
+    """
+    path_in, path_out = str(tmp_path / 'in'), str(tmp_path / 'out')
+    write_library(path_in, path_out)
+    return path_in, path_out
@@ -0,0 +1,53 @@
+"""
+A small library of WAV files, and a target as a conversion run leaves it, without encoding anything: the outputs
+are written by tests.audio.write_flac.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+
+from tests.audio import write_flac, write_wav
+from wavtoflac.manifest import Manifest
+
+SAMPLES = [(i % 200 - 100, i % 50) for i in range(3000)]
+ALBUM = 'Artist - (1999) - Album'
+TRACKS = ('01 - First.wav', '02 - Second.wav')
+# Content hash recorded in the manifest for the converted files
+CONTENT_HASH = 'c0ffee'
+
+
+def write_library(path_in, path_out):
+    """
+    Write a source with a single album of two tracks and a cover, and create an empty target.
+    """
+    os.makedirs(os.path.join(path_in, ALBUM))
+    for name in TRACKS:
+        write_wav(os.path.join(path_in, ALBUM, name), SAMPLES)
+    write_cover(os.path.join(path_in, ALBUM, 'cover.jpg'))
+    os.makedirs(path_out)
+
+
+def write_cover(path, size=32):
+    with open(path, 'wb') as f:
+        f.write(b'\xff\xd8' + bytes(size - 2))
+
+
+def convert(w2f, path_in, path_out, b_add_cover=False):
+    """
+    Act as if a run converted the library: write a complete FLAC file for each planned job, and its manifest entry.
+
+    :return: the planned jobs
+    """
+    jobs = w2f.plan(path_in, path_out, b_add_cover=b_add_cover)
+    for job in jobs:
+        os.makedirs(os.path.dirname(job.path_out), exist_ok=True)
+        write_flac(job.path_out, SAMPLES)
+    manifest = Manifest(path_out)
+    manifest.update({os.path.relpath(job.path_in, path_in): job.entry._replace(content_hash=CONTENT_HASH)
+                     for job in jobs})
+    manifest.close()
+    return jobs
+
+
+def by_name(jobs):
+    return {os.path.basename(job.path_in): job for job in jobs}
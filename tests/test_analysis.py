@@ -0,0 +1,95 @@
+"""
+Loudness, peak and MD5 of WAV files, and the K-weighting filter; requires NumPy.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import hashlib
+import math
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from tests.audio import pcm_bytes, write_wav  # noqa: E402
+from wavtoflac.analysis import PCMAnalyzer, album_tags, analyze_file, k_weighting  # noqa: E402
+from wavtoflac.wavinfo import read_wav_header  # noqa: E402
+
+
+def sine(frequency, level_db, seconds=3., sample_rate=48000, channels=2):
+    amplitude = 10 ** (level_db / 20) * 32767
+    return [(round(amplitude * math.sin(2 * math.pi * frequency * i / sample_rate)),) * channels
+            for i in range(int(seconds * sample_rate))]
+
+
+def gain(tag):
+    return float(tag[:-len(' dB')])
+
+
+def response_db(sample_rate, frequency):
+    """
+    Gain of the K-weighting filter at a frequency, in dB.
+    """
+    n = 1 << 20
+    response = np.abs(np.fft.rfft(k_weighting(sample_rate), n))
+    return 20 * math.log10(response[round(frequency * n / sample_rate)])
+
+
+@pytest.mark.parametrize('sample_rate', [44100, 48000, 96000])
+def test_k_weighting(sample_rate):
+    # The -0.691 dB of the loudness formula compensates the gain at 1 kHz
+    assert response_db(sample_rate, 1000) == pytest.approx(0.691, abs=0.05)
+    # High shelf of +4 dB
+    assert response_db(sample_rate, 10000) == pytest.approx(4., abs=0.2)
+    # High-pass
+    assert response_db(sample_rate, 10) < -10.
+
+
+def test_loudness_of_sine(tmp_path):
+    # EBU Tech 3341, test case 1: a stereo 1 kHz sine at -23 dBFS is -23 LUFS
+    samples = sine(1000, -23.)
+    path = str(tmp_path / 'sine.wav')
+    write_wav(path, samples, sample_rate=48000)
+    analysis = analyze_file(path)
+    assert analysis.loudness == pytest.approx(-23., abs=0.1)
+    assert analysis.peak == pytest.approx(10 ** (-23. / 20), rel=1e-3)
+    assert gain(analysis.tags()['replaygain_track_gain']) == pytest.approx(5., abs=0.1)
+    assert analysis.md5 == hashlib.md5(pcm_bytes(samples, 16)).hexdigest()
+
+
+def test_album_loudness(tmp_path):
+    tracks = []
+    for level_db in (-20., -26.):
+        path = str(tmp_path / f'{level_db}.wav')
+        write_wav(path, sine(1000, level_db), sample_rate=48000)
+        tracks.append(analyze_file(path))
+    tags = album_tags(tracks)
+    # Equal durations: the mean energy of both tracks
+    loudness = 10 * math.log10((10 ** (-20. / 10) + 10 ** (-26. / 10)) / 2)
+    assert gain(tags['replaygain_album_gain']) == pytest.approx(-18. - loudness, abs=0.1)
+    assert tags['replaygain_album_peak'] == f"{tracks[0].peak:.6f}"
+
+
+def test_silence_isnt_amplified(tmp_path):
+    path = str(tmp_path / 'silence.wav')
+    write_wav(path, [(0, 0)] * 48000, sample_rate=48000)
+    analysis = analyze_file(path)
+    assert analysis.loudness is None and analysis.peak == 0.
+    assert analysis.tags()['replaygain_track_gain'] == '+0.00 dB'
+
+
+def test_md5_of_8_bit_samples(tmp_path):
+    samples = [((i * 7) % 256 - 128,) for i in range(3000)]
+    path = str(tmp_path / 'a.wav')
+    write_wav(path, samples, bits_per_sample=8)
+    assert analyze_file(path).md5 == hashlib.md5(bytes(s & 0xFF for s, in samples)).hexdigest()
+
+    # As the 16 bit samples ffmpeg encodes them to
+    wav_info = read_wav_header(path)
+    analyzer = PCMAnalyzer(wav_info, path, flac_bits_per_sample=16)
+    with open(path, 'rb') as f:
+        f.seek(wav_info.data_offset)
+        analyzer.update(f.read())
+    assert analyzer.finish().md5 == hashlib.md5(pcm_bytes([(s << 8,) for s, in samples], 16)).hexdigest()
+
+    with pytest.raises(ValueError):
+        PCMAnalyzer(wav_info, path, flac_bits_per_sample=24)
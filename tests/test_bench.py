@@ -0,0 +1,46 @@
+"""
+The working directory of the benchmark; run_benchmark itself needs ffmpeg, and is replaced here.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import json
+import os
+
+import pytest
+
+from wavtoflac import bench
+
+
+@pytest.fixture
+def roots(monkeypatch):
+    """
+    Replace run_benchmark by a function that writes a file in its working directory.
+
+    :return: list to which the working directories of the runs are appended
+    """
+    roots = []
+
+    def run_benchmark(root, **kwargs):
+        roots.append(root)
+        with open(os.path.join(root, 'library'), 'w') as f:
+            f.write('generated')
+        return {'stages': []}
+    monkeypatch.setattr(bench, 'run_benchmark', run_benchmark)
+    return roots
+
+
+def test_root_keeps_existing_files(tmp_path, roots):
+    root = tmp_path / 'music'
+    root.mkdir()
+    (root / 'album.flac').write_bytes(b'fLaC')
+    out = str(tmp_path / 'bench.json')
+    bench.main(['--root', str(root), '--out', out])
+    assert os.path.dirname(roots[0]) == str(root)
+    assert os.listdir(str(root)) == ['album.flac']
+    with open(out) as f:
+        assert json.load(f) == {'stages': []}
+
+
+def test_keep(tmp_path, roots):
+    bench.main(['--root', str(tmp_path), '--keep', '--out', str(tmp_path / 'bench.json')])
+    assert os.path.isfile(os.path.join(roots[0], 'library'))
@@ -0,0 +1,56 @@
+"""
+Selecting the albums that fit on a target of limited size.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import pytest
+
+from wavtoflac.budget import AlbumEstimate, parse_size, select_albums
+
+ALBUMS = [AlbumEstimate('A', size=40, size_done=0, mtime_ns=3),
+          AlbumEstimate('B', size=70, size_done=70, mtime_ns=1),
+          AlbumEstimate('C', size=30, size_done=10, mtime_ns=2)]
+
+
+def names(albums):
+    return [album.path for album in albums]
+
+
+def test_select_recent_first():
+    selected, skipped = select_albums(ALBUMS, 100)
+    assert names(selected) == ['A', 'C']
+    assert names(skipped) == ['B']
+
+
+def test_select_by_name_skips_albums_that_dont_fit():
+    # B doesn't fit after A, but C, which comes after it, does
+    selected, skipped = select_albums(ALBUMS, 75, priority='name')
+    assert names(selected) == ['A', 'C']
+    assert names(skipped) == ['B']
+
+
+def test_select_by_function():
+    selected, skipped = select_albums(ALBUMS, 100, priority=lambda path: path == 'B')
+    assert names(selected) == ['B', 'C']
+    assert names(skipped) == ['A']
+
+
+def test_select_nothing_fits():
+    selected, skipped = select_albums(ALBUMS, 10)
+    assert selected == [] and names(skipped) == ['A', 'C', 'B']
+
+
+def test_select_rejects_unknown_priority():
+    with pytest.raises(ValueError):
+        select_albums(ALBUMS, 100, priority='size')
+
+
+@pytest.mark.parametrize('size, expected', [(1000, 1000), ('1000', 1000), ('256G', 256 * 10 ** 9),
+                                            ('1.5T', 1.5 * 10 ** 12), ('64 MB', 64 * 10 ** 6), ('2k', 2000)])
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+def test_parse_size_rejects_invalid_sizes():
+    with pytest.raises(ValueError):
+        parse_size('lots')
@@ -0,0 +1,26 @@
+"""
+The command line interface; only commands that don't encode anything are run here.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+
+import pytest
+
+from wavtoflac.cli import main
+
+
+def test_plan(library, capsys):
+    path_in, path_out = library
+    assert main(['plan', path_in, path_out, '--copy', 'jpg']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    actions = [line.split()[0] for line in lines if line.startswith(('convert ', 'copy '))]
+    assert actions == ['convert', 'convert', 'copy']
+    assert lines[-1].startswith('2 files to convert or retag (0.0 MB), 1 files to copy')
+    # A dry run leaves the target untouched
+    assert os.listdir(path_out) == []
+
+
+def test_stream_rejects_list_options(library):
+    with pytest.raises(SystemExit):
+        main(['convert', *library, '--stream', '--resume'])
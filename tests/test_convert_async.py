@@ -0,0 +1,22 @@
+"""
+The asyncio conversion pipeline.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import asyncio
+import os
+
+from tests.library import ALBUM, write_cover
+
+
+def test_failed_job_doesnt_stop_run(w2f, tmp_path):
+    path_in, path_out = str(tmp_path / 'in'), str(tmp_path / 'out')
+    os.makedirs(os.path.join(path_in, ALBUM))
+    write_cover(os.path.join(path_in, ALBUM, 'cover.jpg'))
+    # Listed, but can't be opened
+    broken = os.path.join(path_in, ALBUM, '01 - Gone.wav')
+    os.symlink(os.path.join(path_in, 'missing.wav'), broken)
+
+    asyncio.run(w2f.convert_async(path_in, path_out, to_copy={'jpg'}))
+    assert w2f.failed == [broken]
+    assert os.listdir(os.path.join(path_out, ALBUM)) == ['cover.jpg']
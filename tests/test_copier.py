@@ -0,0 +1,53 @@
+"""
+Copying the files that are mirrored as is.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+from typing import NamedTuple
+
+from wavtoflac.copier import TEMP_SUFFIX, BulkCopier, copy_file, needs_copy
+from wavtoflac.tree import FileInfo
+
+
+class Job(NamedTuple):
+    path_in: str
+    path_out: str
+
+
+def test_needs_copy():
+    src = FileInfo(100, 2000)
+    assert needs_copy(src, None)
+    assert needs_copy(src, FileInfo(99, 2000))
+    assert needs_copy(src, FileInfo(100, 1999))
+    assert not needs_copy(src, FileInfo(100, 2000))
+    assert not needs_copy(src, FileInfo(100, 3000))
+
+
+def test_copy_file(tmp_path):
+    src, dst = str(tmp_path / 'a.pdf'), str(tmp_path / 'b.pdf')
+    data = os.urandom(100000)
+    with open(src, 'wb') as f:
+        f.write(data)
+    os.utime(src, ns=(10 ** 18, 10 ** 18 + 123))
+    assert copy_file(src, dst) == len(data)
+    with open(dst, 'rb') as f:
+        assert f.read() == data
+    # Copies keep the modification time of their source, so they aren't copied again
+    assert os.stat(dst).st_mtime_ns == 10 ** 18 + 123
+    assert not os.path.exists(dst + TEMP_SUFFIX)
+
+
+def test_bulk_copier(tmp_path):
+    jobs = []
+    for name in ('a.jpg', 'b.png', 'missing.jpg'):
+        jobs.append(Job(str(tmp_path / name), str(tmp_path / ('copy_' + name))))
+        if name != 'missing.jpg':
+            (tmp_path / name).write_bytes(name.encode())
+    copied = []
+    copier = BulkCopier(workers=2, on_copy=lambda metrics, b_ok: copied.append((metrics.path, b_ok)))
+    copier.submit(jobs)
+    assert copier.finish() == [True, True, False]
+    assert sorted(copied) == sorted((job.path_in, job.path_in != jobs[-1].path_in) for job in jobs)
+    assert (tmp_path / 'copy_b.png').read_bytes() == b'b.png'
+    assert not os.path.exists(jobs[-1].path_out) and not os.path.exists(jobs[-1].path_out + TEMP_SUFFIX)
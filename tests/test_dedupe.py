@@ -0,0 +1,48 @@
+"""
+Encoding identical audio only once.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+import shutil
+
+import pytest
+
+from tests.audio import write_wav
+from tests.library import ALBUM, SAMPLES, TRACKS, convert
+from wavtoflac.manifest import Manifest
+
+
+def test_duplicates_in_run(w2f, library):
+    path_in, path_out = library
+    # Same samples, different format: not a duplicate
+    write_wav(os.path.join(path_in, ALBUM, '03 - Third.wav'), SAMPLES, sample_rate=48000)
+    jobs = w2f.plan(path_in, path_out)
+    planned, duplicates = w2f._plan_dedupe(jobs, None, path_out)
+    assert [os.path.basename(job.path_in) for job in planned] == ['01 - First.wav', '03 - Third.wav']
+    [(duplicate, source)] = duplicates
+    assert os.path.basename(duplicate.path_in) == '02 - Second.wav' and source is planned[0]
+    # The hash is stored in the manifest entry, so the next run doesn't read the file again
+    assert duplicate.entry.content_hash == source.entry.content_hash
+
+
+def test_duplicate_of_converted_file(w2f, library):
+    pytest.importorskip('mutagen.flac')
+    path_in, path_out = library
+    jobs = convert(w2f, path_in, path_out)
+    content_hash = w2f._audio_key(jobs[0])[-1]
+    manifest = Manifest(path_out)
+    manifest.update({os.path.relpath(job.path_in, path_in): job.entry._replace(content_hash=content_hash)
+                     for job in jobs})
+    manifest.close()
+    os.makedirs(os.path.join(path_in, 'Various - Best Of'))
+    shutil.copy(os.path.join(path_in, ALBUM, TRACKS[0]), os.path.join(path_in, 'Various - Best Of', '07 - Hit.wav'))
+
+    jobs = w2f.plan(path_in, path_out)
+    assert [os.path.basename(job.path_in) for job in jobs] == ['07 - Hit.wav']
+    manifest = Manifest(path_out)
+    planned, duplicates = w2f._plan_dedupe(jobs, manifest, path_out)
+    manifest.close()
+    assert duplicates == []
+    assert os.path.relpath(planned[0].source_out, path_out) in (os.path.join(ALBUM, '01 - First.flac'),
+                                                                 os.path.join(ALBUM, '02 - Second.flac'))
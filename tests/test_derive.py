@@ -0,0 +1,69 @@
+"""
+Outputs derived from another encoded file holding the same audio, and their ReplayGain tags.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+import shutil
+
+import pytest
+
+from tests.library import ALBUM, TRACKS, convert
+from wavtoflac.analysis import TrackAnalysis
+from wavtoflac.wavtoflac import ConvertJob, Format
+
+
+@pytest.fixture
+def duplicate(w2f, library):
+    """
+    The first track of the album, also on a compilation; the album is converted, and its output has ReplayGain tags.
+
+    :return: the job deriving the output of the compilation track from that of the album track
+    """
+    mutagen_flac = pytest.importorskip('mutagen.flac')
+    path_in, path_out = library
+    os.makedirs(os.path.join(path_in, 'Various - Best Of'))
+    shutil.copy(os.path.join(path_in, ALBUM, TRACKS[0]), os.path.join(path_in, 'Various - Best Of', '07 - Hit.wav'))
+    convert(w2f, path_in, path_out)
+
+    song = mutagen_flac.FLAC(os.path.join(path_out, ALBUM, '01 - First.flac'))
+    song.update({'title': 'First', 'replaygain_track_gain': '-1.00 dB', 'replaygain_album_gain': '-2.00 dB',
+                 'replaygain_album_peak': '0.900000'})
+    song.save()
+    return ConvertJob(os.path.join(path_in, 'Various - Best Of', '07 - Hit.wav'),
+                      os.path.join(path_out, 'Various - Best Of', '07 - Hit.flac'), Format.WAV,
+                      source_out=os.path.join(path_out, ALBUM, '01 - First.flac'))
+
+
+def tags(path):
+    from mutagen.flac import FLAC
+    return {k: v[0] for k, v in FLAC(path).tags.as_dict().items()}
+
+
+def test_derive_drops_album_tags_of_other_album(w2f, duplicate):
+    assert w2f._derive_output(duplicate).b_ok
+    derived = tags(duplicate.path_out)
+    assert derived['title'] == 'Hit' and derived['album'] == 'Best Of' and derived['tracknumber'] == '07'
+    assert derived['replaygain_track_gain'] == '-1.00 dB'
+    assert 'replaygain_album_gain' not in derived and 'replaygain_album_peak' not in derived
+
+
+def test_derive_keeps_album_tags_of_same_output(w2f, duplicate):
+    job = duplicate._replace(path_in=duplicate.path_in.replace(os.path.join('Various - Best Of', '07 - Hit.wav'),
+                                                               os.path.join(ALBUM, TRACKS[0])),
+                             path_out=duplicate.source_out)
+    assert w2f._derive_output(job).b_ok
+    derived = tags(job.path_out)
+    assert derived['title'] == 'First'
+    assert derived['replaygain_album_gain'] == '-2.00 dB' and derived['replaygain_album_peak'] == '0.900000'
+
+
+def test_derive_uses_analysis_of_source(w2f, duplicate):
+    analysis = TrackAnalysis(loudness=-20., peak=0.5, md5='', blocks=None)
+    w2f.b_analyze = True
+    w2f._analyses = {duplicate.source_out: analysis}
+    result = w2f._derive_output(duplicate)
+    assert result.b_ok and result.analysis is analysis
+    derived = tags(duplicate.path_out)
+    assert derived['replaygain_track_gain'] == '+2.00 dB'
+    assert 'replaygain_album_gain' not in derived
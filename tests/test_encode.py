@@ -0,0 +1,31 @@
+"""
+The ffmpeg command line encoding, tagging and adding the cover in a single pass.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+from tests.audio import write_wav
+from wavtoflac.wavinfo import read_wav_header
+
+
+def test_stream_args(w2f, tmp_path):
+    path = str(tmp_path / 'a.wav')
+    write_wav(path, [(0, 0)] * 10, sample_rate=48000)
+    wav_info = read_wav_header(path)
+    args = w2f._stream_args(wav_info, 's16le', {'title': 'First', 'artist': 'Artist'}, 'cover.jpg', 'a.flac')
+    assert args[args.index('-f') + 1] == 's16le'
+    assert args[args.index('-ar') + 1] == '48000' and args[args.index('-ac') + 1] == '2'
+    assert args[args.index('-i') + 1] == 'pipe:0'
+    assert args[args.index('-disposition:v') + 1] == 'attached_pic'
+    assert ['-i', 'cover.jpg', '-map', '0:a', '-map', '1:v'] == args[args.index('cover.jpg') - 1:][:6]
+    assert ['-metadata', 'title=First', '-metadata', 'artist=Artist'] == args[args.index('title=First') - 1:][:4]
+    assert w2f.profile.ffmpeg_args() == args[args.index('flac') + 1:][:len(w2f.profile.ffmpeg_args())]
+    assert args[args.index('-metadata_header_padding') + 1] == str(w2f.padding)
+    assert args[-1] == 'a.flac'
+
+
+def test_stream_args_without_cover(w2f, tmp_path):
+    path = str(tmp_path / 'a.wav')
+    write_wav(path, [(0,)] * 10)
+    args = w2f._stream_args(read_wav_header(path), 's16le', {}, None, 'a.flac')
+    assert '-disposition:v' not in args and '-map' not in args and '-metadata' not in args
+    assert args.count('-i') == 1
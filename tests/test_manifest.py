@@ -0,0 +1,65 @@
+"""
+The manifest of converted files, and the fingerprints it holds.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+
+from wavtoflac.manifest import Manifest, ManifestEntry, hash_cover, hash_file, hash_tags
+from wavtoflac.tree import FileInfo
+
+
+def entry(path_out):
+    return ManifestEntry(size=1, mtime_ns=2, content_hash=None, path_out=path_out, tag_hash='t', cover_hash='')
+
+
+def test_update_and_load(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    entries = {'a.wav': entry('a.flac'), os.path.join('Album', 'b.wav'): entry(os.path.join('Album', 'b.flac'))}
+    manifest.update(entries)
+    manifest.update({'a.wav': entry('c.flac')})
+    manifest.close()
+
+    manifest = Manifest(str(tmp_path))
+    assert manifest.load() == dict(entries, **{'a.wav': entry('c.flac')})
+    manifest.delete(['a.wav'])
+    assert list(manifest.sources()) == [os.path.join('Album', 'b.wav')]
+    manifest.close()
+
+
+def test_load_dir(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    sources = ['a.wav', os.path.join('Album', 'b.wav'), os.path.join('Album', 'Disc 1', 'c.wav'),
+               os.path.join('Album 2', 'd.wav'), os.path.join('Album-', 'e.wav')]
+    manifest.update({source: entry(source) for source in sources})
+    assert set(manifest.load_dir('')) == {'a.wav'}
+    assert set(manifest.load_dir('Album')) == {os.path.join('Album', 'b.wav')}
+    assert set(manifest.load_dir(os.path.join('Album', 'Disc 1'))) == {os.path.join('Album', 'Disc 1', 'c.wav')}
+    manifest.close()
+
+
+def test_hash_file(tmp_path):
+    path = str(tmp_path / 'a.bin')
+    with open(path, 'wb') as f:
+        f.write(b'header' + bytes(range(256)) * 10)
+    # Only the region is hashed, whatever the block size
+    assert hash_file(path, offset=6, block_size=7) == hash_file(path, offset=6)
+    assert hash_file(path, offset=6) != hash_file(path)
+    assert hash_file(path, offset=6, size=256) == hash_file(path, offset=6 + 256, size=256)
+
+
+def test_hash_tags_ignores_order():
+    assert hash_tags({'artist': 'A', 'title': 'B'}) == hash_tags({'title': 'B', 'artist': 'A'})
+    assert hash_tags({'artist': 'A'}) != hash_tags({'artist': 'B'})
+
+
+def test_hash_cover():
+    info = FileInfo(100, 200)
+    assert hash_cover(None) == ''
+    # Relative to the root of the library, which can be moved
+    assert hash_cover('/music/Album/cover.jpg', info, '/music') == \
+        hash_cover('/mnt/backup/music/Album/cover.jpg', info, '/mnt/backup/music')
+    assert hash_cover('/music/Album/cover.jpg', info, '/music') != \
+        hash_cover('/music/Album/cover.jpg', FileInfo(100, 201), '/music')
+    assert hash_cover('/music/Album/cover.jpg', info, '/music') != \
+        hash_cover('/music/Album/front.jpg', info, '/music')
@@ -0,0 +1,65 @@
+"""
+Stage timings and byte counts of the files of a run, and the sinks reporting them.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import json
+import time
+
+from wavtoflac.metrics import FileMetrics, JsonlSink, Recorder, Sink, stage
+
+
+class ListSink(Sink):
+    def __init__(self):
+        self.events = []
+        self.summary = None
+
+    def on_event(self, event):
+        self.events.append(event)
+
+    def close(self, summary):
+        self.summary = summary
+
+
+def test_stages_exclude_nested_stages():
+    metrics = FileMetrics('a.wav', kind='convert')
+    with metrics.activate():
+        with stage('encode'):
+            time.sleep(0.02)
+            with stage('tags'):
+                time.sleep(0.05)
+        with stage('tags'):
+            time.sleep(0.01)
+    assert 0.02 <= metrics.stages['encode'] < 0.05
+    assert metrics.stages['tags'] >= 0.06
+    assert metrics.seconds >= sum(metrics.stages.values())
+
+
+def test_stage_without_active_metrics():
+    with stage('encode'):
+        pass
+
+
+def test_recorder(tmp_path):
+    sink = ListSink()
+    recorder = Recorder([sink, JsonlSink(str(tmp_path / 'trace.jsonl'))])
+    with recorder.activate(), stage('scan'):
+        pass
+    recorder.start(total=3, total_bytes=300)
+    for b_ok in (True, False):
+        metrics = FileMetrics('a.wav')
+        metrics.bytes_in, metrics.bytes_out = 100, 60
+        recorder.record(metrics, b_ok)
+    recorder.record(None, True)
+    summary = recorder.finish()
+
+    files = [event for event in sink.events if event['event'] == 'file']
+    assert [(event['done'], event['ok']) for event in files] == [(1, True), (2, False), (3, True)]
+    assert files[-1]['done_bytes'] == 200 and files[-1]['total_bytes'] == 300
+    [run] = [event for event in sink.events if event['event'] == 'run']
+    assert 'scan' in run['stages']
+    assert sink.summary == summary
+    assert (summary['done'], summary['failed'], summary['bytes_in'], summary['bytes_out']) == (3, 1, 200, 120)
+    with open(str(tmp_path / 'trace.jsonl')) as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['event'] for line in lines] == ['file', 'file', 'file', 'run', 'summary']
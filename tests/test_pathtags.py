@@ -0,0 +1,70 @@
+"""
+Deriving tags from the paths of tracks.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+
+import pytest
+
+from wavtoflac.pathtags import PathTagParser, extract_discnr
+from wavtoflac.tree import TreeModel
+
+
+@pytest.fixture
+def parser(tmp_path):
+    for d in ('Artist - (1999) - Album', 'Band - Double/Disc 1', 'Band - Double/Disc 2', 'Band - Live/Encore',
+              'Author/Book/CD 3'):
+        os.makedirs(os.path.join(str(tmp_path), d))
+    return PathTagParser(str(tmp_path), TreeModel.scan(str(tmp_path)))
+
+
+def parse(parser, path):
+    return parser.parse(os.path.join(parser.ref_path, path))
+
+
+def test_album(parser):
+    assert parse(parser, 'Artist - (1999) - Album/01 - Song - Remix.wav') == {
+        'artist': 'Artist', 'album': 'Album', 'date': '1999', 'totaldiscs': '1', 'tracknumber': '01',
+        'title': 'Song - Remix'}
+
+
+def test_disc_of_album(parser):
+    assert parse(parser, 'Band - Double/Disc 2/03 Song.wav') == {
+        'artist': 'Band', 'album': 'Double', 'totaldiscs': '2', 'discnumber': '2', 'tracknumber': '03',
+        'title': 'Song'}
+
+
+def test_subdirectory_of_album(parser):
+    # Not a disc: part of the album name
+    tags = parse(parser, 'Band - Live/Encore/01-Song.wav')
+    assert tags['album'] == 'Live - Encore'
+    assert 'discnumber' not in tags
+
+
+def test_audiobook(parser):
+    assert parse(parser, 'Author/Book/CD 3/12 - Chapter.wav') == {
+        'author': 'Author', 'artist': 'Author', 'album': 'Book', 'totaldiscs': '1', 'discnumber': '3',
+        'tracknumber': '12', 'title': 'Chapter'}
+
+
+def test_tags_are_shared_per_directory(parser):
+    first, second = parser.parse_many([os.path.join(parser.ref_path, 'Artist - (1999) - Album', name)
+                                       for name in ('01 - One.wav', '02 - Two.wav')])
+    assert (first['title'], second['title']) == ('One', 'Two')
+    first['artist'] = 'Changed'
+    assert second['artist'] == 'Artist'
+
+
+@pytest.mark.parametrize('filename, expected', [('01 - Title.wav', {'tracknumber': '01', 'title': 'Title'}),
+                                                ('01-Title.wav', {'tracknumber': '01', 'title': 'Title'}),
+                                                ('7 Title here.wav', {'tracknumber': '7', 'title': 'Title here'}),
+                                                ('Title.wav', {'title': 'Title'})])
+def test_parse_filename(filename, expected):
+    assert PathTagParser.parse_filename(filename) == expected
+
+
+@pytest.mark.parametrize('disc_dir, expected', [('Disc 2', '2'), ('CD12', '12'), ('disc 3 - Bonus', '3'),
+                                                ('Bonus', '')])
+def test_extract_discnr(disc_dir, expected):
+    assert extract_discnr(disc_dir) == expected
@@ -0,0 +1,63 @@
+"""
+Running jobs serially or on a pool of worker processes.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import time
+
+import pytest
+
+from wavtoflac.pool import run_jobs, stream_jobs
+
+
+class Squarer:
+    """
+    Converter whose jobs are numbers; defined at module level, so that worker processes can unpickle it.
+    """
+    def _process_job(self, job):
+        time.sleep(0.01 * (job % 3))
+        return job * job
+
+
+class Throttle:
+    limit = 1
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_run_jobs(workers):
+    seen, started = [], []
+    results = run_jobs(Squarer(), list(range(10)), workers=workers, on_start=lambda: started.append(True),
+                       on_result=lambda job, result: seen.append((job, result)))
+    assert results == [i * i for i in range(10)]
+    assert sorted(seen) == [(i, i * i) for i in range(10)]
+    assert started == [True]
+
+
+def test_run_jobs_throttled():
+    assert run_jobs(Squarer(), list(range(6)), workers=3, throttle=Throttle()) == [i * i for i in range(6)]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_stream_jobs_bounds_producer(workers):
+    produced, ahead, seen = [], [], []
+
+    def jobs():
+        for i in range(20):
+            produced.append(i)
+            yield i
+
+    def on_result(job, result):
+        seen.append((job, result))
+        ahead.append(len(produced) - len(seen))
+
+    assert stream_jobs(Squarer(), jobs(), workers=workers, max_pending=3, on_result=on_result) == 20
+    assert sorted(seen) == [(i, i * i) for i in range(20)]
+    # Jobs taken from the producer but not finished yet, besides the one just reported
+    assert max(ahead) < 3
+
+
+def test_invalid_args():
+    with pytest.raises(ValueError):
+        run_jobs(Squarer(), [1], workers=0)
+    with pytest.raises(ValueError):
+        stream_jobs(Squarer(), [1], workers=2, max_pending=0)
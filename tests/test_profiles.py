@@ -0,0 +1,24 @@
+"""
+Settings of the FLAC encoder.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import pytest
+
+from wavtoflac.profiles import PROFILES, EncoderProfile, get_profile
+
+
+def test_ffmpeg_args():
+    assert PROFILES['fast'].ffmpeg_args() == ['-compression_level', '0']
+    profile = EncoderProfile('custom', compression_level=12, frame_size=4608, max_lpc_order=32,
+                             extra=(('lpc_passes', 2),))
+    assert profile.ffmpeg_args() == ['-compression_level', '12', '-frame_size', '4608', '-max_prediction_order', '32',
+                                     '-lpc_passes', '2']
+
+
+def test_get_profile():
+    assert get_profile('max') is PROFILES['max']
+    profile = EncoderProfile('custom')
+    assert get_profile(profile) is profile
+    with pytest.raises(ValueError):
+        get_profile('slow')
@@ -0,0 +1,43 @@
+"""
+Finding what is on the target of a conversion but no longer in its source.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+
+from wavtoflac.prune import PruneItem, Pruner, expected_names
+
+
+def touch(path, size=0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(bytes(size))
+
+
+def test_expected_names():
+    names = expected_names(['01 - Song.wav', '02 - Song.WAV', '03 - Talk.mpga', 'cover.jpg', 'README'])
+    # The names WAVToFlac gives its outputs: the last 4 characters are replaced, including the dot of '.wav' but
+    # not that of '.mpga'
+    assert names == {'01 - Song.wav', '02 - Song.WAV', '03 - Talk.mpga', 'cover.jpg', 'README',
+                     '01 - Song.flac', '02 - Song.flac', '03 - Talk..flac'}
+
+
+def test_plan(tmp_path):
+    path_in, path_out = str(tmp_path / 'in'), str(tmp_path / 'out')
+    touch(os.path.join(path_in, 'Album', '01 - Song.wav'))
+    touch(os.path.join(path_in, 'Album', 'cover.jpg'))
+    touch(os.path.join(path_out, 'Album', '01 - Song.flac'), size=10)
+    touch(os.path.join(path_out, 'Album', 'cover.jpg'), size=10)
+    # The source of these was removed
+    touch(os.path.join(path_out, 'Album', '02 - Gone.flac'), size=20)
+    touch(os.path.join(path_out, 'Gone', 'Disc 1', '01 - Song.flac'), size=30)
+    touch(os.path.join(path_out, 'Gone', '02 - Song.flac'), size=40)
+    # Files of the conversion itself
+    touch(os.path.join(path_out, '.wavtoflac_manifest.sqlite'))
+    touch(os.path.join(path_out, 'Album', '03 - Song.flac.part'))
+
+    expected = [PruneItem(os.path.join(path_out, 'Gone'), True, 70),
+                PruneItem(os.path.join(path_out, 'Album', '02 - Gone.flac'), False, 20)]
+    pruner = Pruner(workers=2)
+    assert pruner.plan(path_in, path_out) == expected
+    assert list(pruner.iter_plan(path_in, path_out)) == expected
@@ -0,0 +1,54 @@
+"""
+Resuming interrupted conversion runs from their journal.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+
+from tests.audio import write_wav
+from tests.library import SAMPLES, by_name
+from wavtoflac.journal import Journal
+
+
+def interrupt(w2f, path_in, path_out, nb_done):
+    """
+    Start a run, and leave its journal behind as if it was interrupted after its first nb_done jobs.
+
+    :return: the jobs of the run
+    """
+    jobs = sorted(w2f.plan(path_in, path_out))
+    journal = Journal(path_out)
+    journal.start({'path_in': path_in, 'adopted': {}}, [w2f._job_record(job) for job in jobs])
+    for job in jobs[:nb_done]:
+        journal.done(job.path_in, True, job.entry)
+    journal._f.close()
+    return jobs
+
+
+def resume(w2f, path_in, path_out):
+    jobs, manifest, adopted, journal = w2f._start_run(path_in, path_out, b_add_cover=False, to_copy=None,
+                                                      b_manifest=True, b_resume=True)
+    manifest.close()
+    journal.close()
+    return jobs, adopted
+
+
+def test_resume_skips_finished_and_vanished_sources(w2f, library):
+    path_in, path_out = library
+    done, left = interrupt(w2f, path_in, path_out, nb_done=1)
+    os.remove(left.path_in)
+    jobs, adopted = resume(w2f, path_in, path_out)
+    assert jobs == []
+    assert adopted == {os.path.relpath(done.path_in, path_in): done.entry}
+
+
+def test_resume_refreshes_modified_sources(w2f, library):
+    path_in, path_out = library
+    modified, unchanged = interrupt(w2f, path_in, path_out, nb_done=0)
+    write_wav(modified.path_in, SAMPLES * 2)
+    jobs = by_name(resume(w2f, path_in, path_out)[0])
+    assert jobs[os.path.basename(unchanged.path_in)] == unchanged
+    job = jobs[os.path.basename(modified.path_in)]
+    assert job.entry.size == os.path.getsize(modified.path_in)
+    assert job.entry.mtime_ns == os.stat(modified.path_in).st_mtime_ns
+    assert job.entry.content_hash is None and job.prev_hash is None
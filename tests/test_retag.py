@@ -0,0 +1,56 @@
+"""
+Rewriting only the tags that changed, in place within the padding of FLAC files.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+
+import pytest
+
+from tests.library import ALBUM, convert
+
+
+@pytest.fixture
+def converted(w2f, library):
+    """
+    The converted album, with the tags derived from its path.
+
+    :return: the root of the FLAC library
+    """
+    pytest.importorskip('mutagen.flac')
+    path_in, path_out = library
+    convert(w2f, path_in, path_out)
+    w2f.update_tags(path_out)
+    assert len(w2f.retagged) == 2
+    return path_out
+
+
+def sizes(root):
+    return {name: os.path.getsize(os.path.join(root, name)) for name in os.listdir(root)}
+
+
+def test_equal_tags_are_not_written(w2f, converted):
+    path = os.path.join(converted, ALBUM, '01 - First.flac')
+    mtime_ns = os.stat(path).st_mtime_ns
+    w2f.update_tags(converted)
+    assert w2f.retagged == [] and w2f.failed == []
+    assert os.stat(path).st_mtime_ns == mtime_ns
+
+
+def test_changed_tags_fit_in_padding(w2f, converted):
+    from mutagen.flac import FLAC
+    path = os.path.join(converted, ALBUM, '01 - First.flac')
+    song = FLAC(path)
+    song['replaygain_track_gain'] = '-1.00 dB'
+    song.save(padding=w2f._keep_padding)
+    album = os.path.join(converted, 'Artist - (2001) - Album')
+    os.rename(os.path.join(converted, ALBUM), album)
+    before = sizes(album)
+
+    w2f.update_tags(converted)
+    assert len(w2f.retagged) == 2
+    assert sizes(album) == before
+    song = FLAC(os.path.join(album, '01 - First.flac'))
+    assert song['date'] == ['2001']
+    # Tags written by the analysis are kept
+    assert song['replaygain_track_gain'] == ['-1.00 dB']
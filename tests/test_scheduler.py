@@ -0,0 +1,64 @@
+"""
+Ordering encoding jobs, and throttling them on the latency of the target device.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+from typing import NamedTuple, Optional
+
+import pytest
+
+from tests.audio import write_wav
+from wavtoflac.scheduler import JOB_OVERHEAD, LIGHT_JOB_COST, WriteThrottle, job_cost, order_longest_first
+
+
+class Job(NamedTuple):
+    path_in: str
+    b_retag_only: bool = False
+    source_out: Optional[str] = None
+
+
+def test_job_cost(tmp_path):
+    path = str(tmp_path / 'a.wav')
+    write_wav(path, [(0, 0)] * 1000)
+    assert job_cost(Job(path), size=0) == JOB_OVERHEAD + 2000
+    # Estimated from the size, as 16 bit samples
+    assert job_cost(Job(path), size=8000, b_header=False) == JOB_OVERHEAD + 4000
+    assert job_cost(Job(str(tmp_path / 'missing.wav')), size=8000) == JOB_OVERHEAD + 4000
+    assert job_cost(Job(path, b_retag_only=True), size=0) == LIGHT_JOB_COST
+    assert job_cost(Job(path, source_out='b.flac'), size=0) == LIGHT_JOB_COST
+
+
+def test_order_longest_first():
+    jobs = [Job('a'), Job('b'), Job('c'), Job('d')]
+    costs = {'a': 1, 'b': 3, 'c': 1, 'd': 2}
+    # Jobs of equal cost keep their order
+    assert [job.path_in for job in order_longest_first(jobs, costs)] == ['b', 'd', 'a', 'c']
+
+
+def test_throttle():
+    throttle = WriteThrottle(max_jobs=8, window=4)
+    for _ in range(4):
+        throttle.observe(100, 1.)
+    assert throttle.limit == 8
+    # The target device falls behind: latency doubles
+    for _ in range(4):
+        throttle.observe(100, 2.)
+    assert throttle.limit == 4
+    for _ in range(4):
+        throttle.observe(100, 2.)
+    assert throttle.limit == 2
+    # It keeps up again
+    for _ in range(8):
+        throttle.observe(100, 1.)
+    assert throttle.limit == 4
+
+
+def test_throttle_limits():
+    throttle = WriteThrottle(max_jobs=2, min_jobs=2, window=1)
+    throttle.observe(100, 1.)
+    throttle.observe(100, 10.)
+    assert throttle.limit == 2
+    with pytest.raises(ValueError):
+        WriteThrottle(max_jobs=2, min_jobs=3)
+    with pytest.raises(ValueError):
+        WriteThrottle(max_jobs=2, slowdown=1.)
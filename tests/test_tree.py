@@ -0,0 +1,27 @@
+"""
+Listing directories into a model of a tree.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+
+from wavtoflac.tree import UNREADABLE, DirInfo, FileInfo, TreeModel
+
+
+def test_scan(tmp_path):
+    os.makedirs(str(tmp_path / 'Album' / 'Disc 1'))
+    (tmp_path / 'Album' / 'a.wav').write_bytes(bytes(10))
+    (tmp_path / 'Album' / 'b.WAV').write_bytes(bytes(20))
+    tree = TreeModel.scan(str(tmp_path))
+    dir_info = tree.get(str(tmp_path / 'Album'))
+    assert dir_info.subdirs == ['Disc 1']
+    assert dir_info.file_info('b.WAV') == FileInfo(20, os.stat(str(tmp_path / 'Album' / 'b.WAV')).st_mtime_ns)
+    assert dir_info.ext_counts == {'.wav': 1, '.WAV': 1}
+    assert tree.isfile(str(tmp_path / 'Album' / 'a.wav'))
+    assert tree.isdir(str(tmp_path / 'Album' / 'Disc 1'))
+
+
+def test_scan_keeps_dangling_links(tmp_path):
+    os.symlink(str(tmp_path / 'missing.wav'), str(tmp_path / 'link.wav'))
+    assert DirInfo.scan(str(tmp_path)).file_info('link.wav') == UNREADABLE
+    assert DirInfo.scan(str(tmp_path), b_stat=False).file_info('link.wav') == UNREADABLE
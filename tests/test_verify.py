@@ -0,0 +1,70 @@
+"""
+Comparing WAV files with FLAC files, and finding the end of the last frame of a FLAC file.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+
+from tests.audio import write_flac, write_wav
+from wavtoflac.verify import Status, Verifier, VerifyJob, flac_end_sample, read_streaminfo
+
+SAMPLES = [(i % 20000 - 10000, (i * 7) % 30000 - 15000) for i in range(5000)]
+SAMPLES_8 = [((i * 7) % 256 - 128, (i * 3) % 256 - 128) for i in range(3000)]
+
+
+def compare(path_wav, path_flac):
+    return Verifier(workers=1)._compare(VerifyJob(path_wav, path_flac, os.path.basename(path_flac), None)).status
+
+
+def test_flac_end_sample(tmp_path):
+    path = str(tmp_path / 'a.flac')
+    write_flac(path, SAMPLES, block_size=256)
+    assert read_streaminfo(path).total_samples == len(SAMPLES)
+    assert flac_end_sample(path) == len(SAMPLES)
+
+
+def test_flac_end_sample_of_truncated_file(tmp_path):
+    path = str(tmp_path / 'a.flac')
+    write_flac(path, SAMPLES, block_size=256)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 10)
+    assert flac_end_sample(path) is None
+
+
+def test_flac_end_sample_of_file_cut_between_frames(tmp_path):
+    full, cut = str(tmp_path / 'full.flac'), str(tmp_path / 'cut.flac')
+    write_flac(full, SAMPLES, block_size=1024)
+    write_flac(cut, SAMPLES[:4096], block_size=1024)
+    # Same header as the complete file, but only the first 4 frames
+    with open(full, 'rb') as f:
+        header = f.read(42)
+    with open(cut, 'r+b') as f:
+        f.write(header)
+    assert read_streaminfo(cut).total_samples == len(SAMPLES)
+    assert flac_end_sample(cut) == 4096
+
+
+def test_compare(tmp_path):
+    path_wav, path_flac = str(tmp_path / 'a.wav'), str(tmp_path / 'a.flac')
+    write_wav(path_wav, SAMPLES)
+    write_flac(path_flac, SAMPLES)
+    assert compare(path_wav, path_flac) == Status.OK
+    write_flac(path_flac, SAMPLES[:-1] + [(0, 0)])
+    assert compare(path_wav, path_flac) == Status.MISMATCH
+
+
+def test_compare_8_bit(tmp_path):
+    path_wav, path_flac = str(tmp_path / 'a.wav'), str(tmp_path / 'a.flac')
+    write_wav(path_wav, SAMPLES_8, bits_per_sample=8)
+    write_flac(path_flac, SAMPLES_8, bits_per_sample=8)
+    assert compare(path_wav, path_flac) == Status.OK
+
+
+def test_compare_8_bit_with_16_bit_flac(tmp_path):
+    # As encoded by ffmpeg
+    path_wav, path_flac = str(tmp_path / 'a.wav'), str(tmp_path / 'a.flac')
+    write_wav(path_wav, SAMPLES_8, bits_per_sample=8)
+    write_flac(path_flac, [(left << 8, right << 8) for left, right in SAMPLES_8], bits_per_sample=16)
+    assert compare(path_wav, path_flac) == Status.OK
+    write_flac(path_flac, [(left << 8 | 1, right << 8) for left, right in SAMPLES_8], bits_per_sample=16)
+    assert compare(path_wav, path_flac) == Status.MISMATCH
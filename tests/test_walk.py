@@ -0,0 +1,49 @@
+"""
+Walking a tree one directory at a time.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+
+import pytest
+
+from wavtoflac.walk import iter_dirs
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for path in ('b', 'b/y', 'a', 'a/x', 'a/x/deep', 'c'):
+        os.makedirs(str(tmp_path / path))
+        (tmp_path / path / 'track.wav').write_bytes(b'')
+    # Modification times in the order of this list, later directories being more recent
+    for i, path in enumerate(('b/y', 'a/x/deep', 'a/x', 'b', 'c', 'a')):
+        os.utime(str(tmp_path / path), ns=(10 ** 18, 10 ** 18 + i * 10 ** 9))
+    return tmp_path
+
+
+def rel(root, dirs):
+    return [os.path.relpath(path, str(root)) for path, _ in dirs]
+
+
+def test_name_order(tree):
+    assert rel(tree, iter_dirs(str(tree))) == ['.', 'a', 'a/x', 'a/x/deep', 'b', 'b/y', 'c']
+
+
+def test_newest_first(tree):
+    # Only directories already found compete: 'a/x' is older than 'c', but only found once 'a' was listed
+    assert rel(tree, iter_dirs(str(tree), order='newest')) == ['.', 'a', 'c', 'b', 'a/x', 'a/x/deep', 'b/y']
+
+
+def test_oldest_first(tree):
+    assert rel(tree, iter_dirs(str(tree), order='oldest')) == ['.', 'b', 'b/y', 'c', 'a', 'a/x', 'a/x/deep']
+
+
+def test_files(tree):
+    infos = dict(iter_dirs(str(tree)))
+    assert list(infos[str(tree / 'a' / 'x')].files) == ['track.wav']
+
+
+def test_missing_root(tmp_path):
+    assert list(iter_dirs(str(tmp_path / 'missing'))) == []
+    with pytest.raises(ValueError):
+        list(iter_dirs(str(tmp_path), order='size'))
@@ -0,0 +1,97 @@
+"""
+Syncing the albums of a watched source, with fake event sources instead of inotify.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+import time
+
+import pytest
+
+from wavtoflac.watch import IN_CLOSE_WRITE, Watcher
+
+
+class Converter:
+    """
+    Records the albums that are synced, and stops the watch after a number of syncs.
+    """
+    def __init__(self, nb_syncs=1):
+        self.synced = []
+        self.nb_syncs = nb_syncs
+
+    def check_dirs_out_to_in(self, path_in, path_out, b_delete=False, subdirs=None):
+        pass
+
+    def parse_dir_convert(self, path_in, path_out, b_add_cover=False, to_copy=None, workers=None, subdirs=None):
+        self.synced.append((time.monotonic(), subdirs))
+        if len(self.synced) == self.nb_syncs:
+            raise KeyboardInterrupt
+
+
+class Events:
+    """
+    Event source that gives an event for a file of an album every 'interval' seconds, 'count' times, and is quiet
+    afterwards. Stops the watch after 3 seconds in any case.
+    """
+    def __init__(self, path, interval=0.01, count=None):
+        self.path = path
+        self.interval = interval
+        self.count = count
+        self.b_closed = False
+        self.deadline = time.monotonic() + 3.
+
+    def add_tree(self, root):
+        pass
+
+    def read(self, timeout=None):
+        if time.monotonic() > self.deadline:
+            raise KeyboardInterrupt
+        if self.count == 0:
+            if timeout is None:
+                raise KeyboardInterrupt
+            time.sleep(timeout)
+            return []
+        if self.count is not None:
+            self.count -= 1
+        time.sleep(self.interval)
+        return [(self.path, IN_CLOSE_WRITE)]
+
+    def close(self):
+        self.b_closed = True
+
+
+@pytest.fixture
+def album(tmp_path):
+    path = str(tmp_path / 'in' / 'Artist - Album')
+    os.makedirs(path)
+    return path
+
+
+def test_sync_when_quiet(tmp_path, album):
+    converter = Converter()
+    events = Events(os.path.join(album, '01 - Song.wav'), count=3)
+    start = time.monotonic()
+    Watcher(converter, str(tmp_path / 'in'), str(tmp_path / 'out'), settle=0.1, max_delay=10.).run(inotify=events)
+    [(synced_at, subdirs)] = converter.synced
+    assert subdirs == [album]
+    assert synced_at - start < 1.
+    assert events.b_closed
+
+
+def test_sync_while_events_keep_coming(tmp_path, album):
+    converter = Converter(nb_syncs=2)
+    events = Events(os.path.join(album, '01 - Song.wav'))
+    start = time.monotonic()
+    Watcher(converter, str(tmp_path / 'in'), str(tmp_path / 'out'), settle=0.1, max_delay=0.3).run(inotify=events)
+    (first, subdirs), (second, _) = converter.synced
+    assert subdirs == [album]
+    # The source never went quiet for 'settle' seconds
+    assert 0.3 <= first - start < 1.
+    assert 0.3 <= second - first < 1.
+
+
+def test_events_outside_albums_are_ignored(tmp_path, album):
+    converter = Converter()
+    events = Events(str(tmp_path / 'in' / 'notes.txt'), count=3)
+    Watcher(converter, str(tmp_path / 'in'), str(tmp_path / 'out'), settle=0.05, max_delay=1.).run(inotify=events)
+    assert converter.synced == []
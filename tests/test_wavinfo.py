@@ -0,0 +1,68 @@
+"""
+Reading and writing the headers of WAV files.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import struct
+
+import pytest
+
+from wavtoflac.wavinfo import WAVE_FORMAT_EXTENSIBLE, WAVE_FORMAT_PCM, read_wav_header, wav_header
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+@pytest.mark.parametrize('channels, bits_per_sample', [(1, 8), (2, 16), (2, 24), (6, 16), (2, 32)])
+def test_wav_header(tmp_path, channels, bits_per_sample):
+    data = bytes(channels * bits_per_sample // 8 * 100)
+    header = wav_header(channels, 44100, bits_per_sample, len(data))
+    path = write(tmp_path / 'a.wav', header + data)
+    wav_info = read_wav_header(path)
+    # Extensible files are resolved to the format of their sub-format
+    assert wav_info.format_tag == WAVE_FORMAT_PCM
+    assert (wav_info.channels, wav_info.sample_rate, wav_info.bits_per_sample) == (channels, 44100, bits_per_sample)
+    assert wav_info.data_offset == len(header) and wav_info.data_size == len(data)
+    assert wav_info.nb_frames == 100 and not wav_info.b_truncated
+    b_extensible = struct.unpack('<H', header[20:22])[0] == WAVE_FORMAT_EXTENSIBLE
+    assert b_extensible == (channels > 2 or bits_per_sample > 16)
+
+
+def test_wav_header_rejects_unsupported_bits():
+    with pytest.raises(ValueError):
+        wav_header(2, 44100, 12, 0)
+
+
+def test_read_wav_header_skips_odd_chunks(tmp_path):
+    header = wav_header(2, 44100, 16, 8)
+    # A 'LIST' chunk of odd size, padded to an even size, between the 'fmt ' and 'data' chunks
+    fmt_end = 12 + 8 + 16
+    extra = b'LIST' + struct.pack('<I', 3) + b'abc\x00'
+    path = write(tmp_path / 'a.wav', header[:fmt_end] + extra + header[fmt_end:] + bytes(8))
+    wav_info = read_wav_header(path)
+    assert wav_info.data_offset == len(header) + len(extra)
+    assert wav_info.data_size == 8
+
+
+def test_read_wav_header_of_truncated_file(tmp_path):
+    path = write(tmp_path / 'a.wav', wav_header(2, 44100, 16, 400) + bytes(100))
+    wav_info = read_wav_header(path)
+    assert wav_info.b_truncated
+    assert wav_info.data_size == 100 and wav_info.nb_frames == 25
+
+
+def test_read_wav_header_of_unset_size(tmp_path):
+    # Streaming recorders may leave the size of the 'data' chunk at 0
+    path = write(tmp_path / 'a.wav', wav_header(2, 44100, 16, 0) + bytes(100))
+    wav_info = read_wav_header(path)
+    assert not wav_info.b_truncated
+    assert wav_info.data_size == 100
+
+
+@pytest.mark.parametrize('data', [b'', b'RIFF\x00\x00\x00\x00AVI ', b'RIFF\x04\x00\x00\x00WAVE'])
+def test_read_wav_header_rejects_invalid_files(tmp_path, data):
+    with pytest.raises(ValueError):
+        read_wav_header(write(tmp_path / 'a.wav', data))
@@ -0,0 +1,124 @@
+"""
+Planning of conversion runs against the manifest.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+import shutil
+
+from tests.audio import write_flac, write_wav
+from tests.library import ALBUM, CONTENT_HASH, SAMPLES, TRACKS, by_name, convert, write_cover
+from wavtoflac.wavtoflac import Format
+
+
+def test_plan_converts_new_files(w2f, library):
+    path_in, path_out = library
+    jobs = by_name(w2f.plan(path_in, path_out))
+    assert set(jobs) == set(TRACKS)
+    job = jobs['01 - First.wav']
+    assert job.audio_format == Format.WAV and not job.b_retag_only
+    assert job.path_out == os.path.join(path_out, ALBUM, '01 - First.flac')
+    assert job.entry.path_out == os.path.join(ALBUM, '01 - First.flac')
+
+
+def test_plan_skips_converted_files(w2f, library):
+    convert(w2f, *library)
+    assert w2f.plan(*library) == []
+
+
+def test_plan_converts_deleted_outputs(w2f, library):
+    path_in, path_out = library
+    convert(w2f, path_in, path_out)
+    os.remove(os.path.join(path_out, ALBUM, '01 - First.flac'))
+    [job] = w2f.plan(path_in, path_out)
+    assert job.path_out == os.path.join(path_out, ALBUM, '01 - First.flac')
+    assert not job.b_retag_only and job.prev_hash is None and job.source_out is None
+    # The source didn't change
+    assert job.entry.content_hash == CONTENT_HASH
+
+
+def test_plan_converts_deleted_album(w2f, library):
+    path_in, path_out = library
+    convert(w2f, path_in, path_out)
+    shutil.rmtree(os.path.join(path_out, ALBUM))
+    assert set(by_name(w2f.plan(path_in, path_out))) == set(TRACKS)
+    assert set(by_name(w2f.plan(path_in, path_out, b_add_cover=True))) == set(TRACKS)
+
+
+def test_plan_retags_when_tags_change(w2f, library):
+    path_in, path_out = library
+    convert(w2f, path_in, path_out)
+    # One more track changes the 'totaltracks' tag of the others
+    write_wav(os.path.join(path_in, ALBUM, '03 - Third.wav'), SAMPLES)
+    jobs = by_name(w2f.plan(path_in, path_out))
+    assert not jobs.pop('03 - Third.wav').b_retag_only
+    assert set(jobs) == set(TRACKS)
+    for job in jobs.values():
+        assert job.b_retag_only
+        assert job.entry.content_hash == CONTENT_HASH
+
+
+def test_plan_reencodes_modified_source(w2f, library):
+    path_in, path_out = library
+    convert(w2f, path_in, path_out)
+    path = os.path.join(path_in, ALBUM, TRACKS[0])
+    write_wav(path, SAMPLES * 2)
+    [job] = w2f.plan(path_in, path_out)
+    assert job.path_in == path
+    assert not job.b_retag_only and job.prev_hash is None and job.source_out is None
+    assert job.entry.size == os.path.getsize(path)
+    assert job.entry.content_hash is None
+
+
+def test_plan_compares_content_of_touched_source(w2f, library):
+    path_in, path_out = library
+    convert(w2f, path_in, path_out)
+    path = os.path.join(path_in, ALBUM, TRACKS[0])
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    [job] = w2f.plan(path_in, path_out)
+    assert job.path_in == path
+    assert job.prev_hash == CONTENT_HASH
+    assert not job.b_retag_only
+    assert job.entry.mtime_ns == st.st_mtime_ns + 10 ** 9
+
+
+def test_plan_remuxes_when_only_cover_changes(w2f, library):
+    path_in, path_out = library
+    convert(w2f, path_in, path_out, b_add_cover=True)
+    write_cover(os.path.join(path_in, ALBUM, 'cover.jpg'), size=64)
+    jobs = w2f.plan(path_in, path_out, b_add_cover=True)
+    assert len(jobs) == len(TRACKS)
+    for job in jobs:
+        assert job.source_out == job.path_out
+        assert job.entry.content_hash == CONTENT_HASH
+
+
+def test_plan_ignores_move_of_library(w2f, library, tmp_path):
+    path_in, path_out = library
+    convert(w2f, path_in, path_out, b_add_cover=True)
+    moved = str(tmp_path / 'moved')
+    # copytree keeps the modification times
+    shutil.copytree(path_in, moved)
+    assert w2f.plan(moved, path_out, b_add_cover=True) == []
+
+
+def test_plan_adopts_complete_outputs_only(w2f, library):
+    path_in, path_out = library
+    os.makedirs(os.path.join(path_out, ALBUM))
+    complete, truncated = [os.path.join(path_out, ALBUM, name[:-4] + '.flac') for name in TRACKS]
+    write_flac(complete, SAMPLES, block_size=256)
+    write_flac(truncated, SAMPLES, block_size=256)
+    # The header is complete, but the last frame is missing
+    with open(truncated, 'r+b') as f:
+        f.truncate(os.path.getsize(truncated) - 100)
+    [job] = w2f.plan(path_in, path_out)
+    assert job.path_out == truncated
+
+
+def test_plan_doesnt_adopt_outputs_of_other_length(w2f, library):
+    path_in, path_out = library
+    os.makedirs(os.path.join(path_out, ALBUM))
+    for name in TRACKS:
+        write_flac(os.path.join(path_out, ALBUM, name[:-4] + '.flac'), SAMPLES[:-1])
+    assert len(w2f.plan(path_in, path_out)) == len(TRACKS)
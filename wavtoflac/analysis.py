@@ -0,0 +1,280 @@
+"""
+Loudness (EBU R128, i.e., ITU-R BS.1770 integrated loudness), sample peak and MD5 of the PCM data of WAV files,
+computed from the blocks of PCM data the encoder reads, so that analysing a file doesn't read it again.
+
+The loudness is turned into ReplayGain 2.0 tags (reference level of -18 LUFS), per track and per album; the album
+loudness is computed over the gating blocks of all its tracks, not averaged over the tracks. The MD5 is computed as
+FLAC encoders do for the STREAMINFO block, so that it can be compared with the one of the encoded file.
+
+NumPy is only needed, and imported, when files are analysed.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import hashlib
+import math
+from typing import NamedTuple, Optional
+
+from wavtoflac.wavinfo import WAVE_FORMAT_PCM, read_wav_header
+
+# Loudness reference of ReplayGain 2.0, in LUFS
+REFERENCE_LOUDNESS = -18.
+# Gates of BS.1770: blocks below the absolute gate (LUFS), then blocks more than the relative gate (LU) below the
+# loudness of the remaining blocks, are ignored
+ABSOLUTE_GATE = -70.
+RELATIVE_GATE = -10.
+# Gating blocks last 400 ms, and start every 100 ms
+STEP_SECONDS = 0.1
+STEPS_PER_BLOCK = 4
+# Length of the impulse response of the K-weighting filter that is applied, in seconds; the response of the filter
+# has decayed well before that
+FILTER_SECONDS = 0.05
+# Vorbis comments written by the analysis. They are not derived from the path of a file, and are kept when its other
+# tags are updated; the album tags only hold for the album of the file.
+ALBUM_ANALYSIS_TAGS = {'replaygain_album_gain', 'replaygain_album_peak'}
+ANALYSIS_TAGS = {'replaygain_track_gain', 'replaygain_track_peak', 'replaygain_reference_loudness'} | \
+    ALBUM_ANALYSIS_TAGS
+
+
+def require_numpy():
+    """
+    Fail early, before any file is processed, if NumPy is missing.
+    """
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        raise ImportError("Analysing files requires NumPy, install it with 'pip install wavtoflac[analysis]'.")
+
+
+class TrackAnalysis(NamedTuple):
+    # Integrated loudness, in LUFS; None for silence
+    loudness: Optional[float]
+    # Sample peak, relative to full scale
+    peak: float
+    # MD5 of the samples, as stored in the STREAMINFO block of a FLAC file
+    md5: str
+    # Mean square of each gating block (numpy array), to compute the loudness of the album
+    blocks: object
+
+    def tags(self) -> dict:
+        """
+        The ReplayGain tags of the track.
+        """
+        return {'replaygain_track_gain': _gain(self.loudness), 'replaygain_track_peak': f"{self.peak:.6f}",
+                'replaygain_reference_loudness': f"{REFERENCE_LOUDNESS:.2f} LUFS"}
+
+
+def album_tags(tracks) -> dict:
+    """
+    The ReplayGain tags of an album.
+
+    :param tracks: list of TrackAnalysis, one per track of the album.
+    """
+    import numpy as np
+    blocks = np.concatenate([track.blocks for track in tracks])
+    return {'replaygain_album_gain': _gain(gated_loudness(blocks)),
+            'replaygain_album_peak': f"{max(track.peak for track in tracks):.6f}"}
+
+
+def _gain(loudness):
+    # Silence isn't amplified
+    gain = 0. if loudness is None else REFERENCE_LOUDNESS - loudness
+    return f"{gain:+.2f} dB"
+
+
+def gated_loudness(blocks) -> Optional[float]:
+    """
+    Integrated loudness of BS.1770, from the mean square of each gating block.
+
+    :param blocks: numpy array with the mean square of each block, channel weights applied.
+    :return: loudness in LUFS, or None if all blocks are below the absolute gate.
+    """
+    import numpy as np
+    with np.errstate(divide='ignore'):
+        loudness = -0.691 + 10 * np.log10(blocks)
+    blocks = blocks[loudness > ABSOLUTE_GATE]
+    if not len(blocks):
+        return None
+    threshold = -0.691 + 10 * math.log10(blocks.mean()) + RELATIVE_GATE
+    blocks = blocks[-0.691 + 10 * np.log10(blocks) > threshold]
+    return -0.691 + 10 * math.log10(blocks.mean())
+
+
+def k_weighting(sample_rate):
+    """
+    Impulse response of the K-weighting filter of BS.1770 (high shelf, then high-pass), for any sample rate. The
+    coefficients of both biquads are derived as in libebur128.
+
+    :return: numpy array
+    """
+    import numpy as np
+    k = math.tan(math.pi * 1681.974450955533 / sample_rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf_b = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0]
+    shelf_a = [1., 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    k = math.tan(math.pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass_b = [1., -2., 1.]
+    high_pass_a = [1., 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+    taps = int(FILTER_SECONDS * sample_rate)
+    n = 1 << (8 * taps - 1).bit_length()
+    response = np.fft.rfft(np.convolve(shelf_b, high_pass_b), n) / np.fft.rfft(np.convolve(shelf_a, high_pass_a), n)
+    return np.fft.irfft(response, n)[:taps]
+
+
+def channel_weights(channels):
+    """
+    Weights of the channels in the loudness: surround channels weigh more, and the LFE channel of 5.1 isn't counted.
+    """
+    if channels == 5:
+        return [1., 1., 1., 1.41, 1.41]
+    if channels == 6:
+        return [1., 1., 1., 0., 1.41, 1.41]
+    return [1.] * channels
+
+
+class PCMAnalyzer:
+    def __init__(self, wav_info, path='', flac_bits_per_sample=None):
+        """
+        Analyse the PCM data of a WAV file, fed one block at a time with update().
+
+        :param wav_info: wavinfo.WavInfo of the file.
+        :param path: path of the file, for error messages.
+        :param flac_bits_per_sample: bits per sample of the FLAC file the MD5 is compared with; defaults to those of
+        the WAV file. 8 bit samples can be hashed as the 16 bit samples ffmpeg encodes them to.
+        """
+        import numpy as np
+        if wav_info.format_tag != WAVE_FORMAT_PCM or wav_info.bits_per_sample not in (8, 16, 24, 32):
+            raise ValueError(f"unsupported WAV format {wav_info.format_tag}/{wav_info.bits_per_sample} bit")
+        if flac_bits_per_sample not in (None, wav_info.bits_per_sample) and \
+                (wav_info.bits_per_sample, flac_bits_per_sample) != (8, 16):
+            raise ValueError(f"can't hash {wav_info.bits_per_sample} bit samples as {flac_bits_per_sample} bit samples")
+        if wav_info.b_truncated:
+            raise RuntimeError(f"Truncated WAV file, {wav_info.data_size} bytes of audio left: [{path}]")
+        self._np = np
+        self.channels = wav_info.channels
+        self.bits_per_sample = wav_info.bits_per_sample
+        self.frame_size = wav_info.channels * wav_info.bits_per_sample // 8
+        self.b_widen = self.bits_per_sample == 8 and flac_bits_per_sample == 16
+        self.step = round(STEP_SECONDS * wav_info.sample_rate)
+        self.weights = np.array(channel_weights(wav_info.channels))
+        # The filter is applied by overlap-save FFT convolution: FFTs of a few times the length of the filter are
+        # faster, in total, than a single FFT of a whole block
+        k_filter = k_weighting(wav_info.sample_rate)
+        self.taps = len(k_filter)
+        self.fft_size = 1 << (4 * self.taps - 1).bit_length()
+        self.hop = self.fft_size - self.taps + 1
+        self._filter_fft = np.fft.rfft(k_filter, self.fft_size)
+        self.peak = 0.
+        self._md5 = hashlib.md5()
+        # Bytes of a frame split over two blocks
+        self._remainder = b''
+        # Samples (one row per channel) that weren't filtered yet, preceded by the taps - 1 samples before them
+        self._input = np.zeros((self.channels, self.taps - 1))
+        # Weighted energy of the samples that don't fill a step yet
+        self._carry = np.zeros(0)
+        # Energy of each step
+        self._steps = []
+
+    def update(self, block):
+        """
+        Analyse the next block of PCM data; blocks don't need to hold whole frames.
+        """
+        np = self._np
+        if self._remainder:
+            block = self._remainder + bytes(block)
+        end = len(block) - len(block) % self.frame_size
+        self._remainder = bytes(block[end:])
+        if not end:
+            return
+        data = block[:end]
+
+        if self.bits_per_sample == 8:
+            # 8 bit WAV samples are unsigned, FLAC's are signed
+            samples = np.frombuffer(data, dtype=np.uint8).astype(np.int16) - 128
+            if self.b_widen:
+                self._md5.update((samples << 8).astype('<i2').tobytes())
+            else:
+                self._md5.update(samples.astype(np.int8).tobytes())
+            scale = 1 << 7
+        else:
+            self._md5.update(data)
+            if self.bits_per_sample == 24:
+                raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+                samples = ((raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)) << 8) >> 8
+            else:
+                samples = np.frombuffer(data, dtype='<i2' if self.bits_per_sample == 16 else '<i4')
+            scale = 1 << (self.bits_per_sample - 1)
+        samples = samples.reshape(-1, self.channels).T / scale
+        self.peak = max(self.peak, float(np.abs(samples).max()))
+        self._add_energy(self._filter(samples))
+
+    def _filter(self, samples, b_flush=False):
+        """
+        K-weight the samples, continuing from the previous ones.
+
+        :param samples: numpy array, one row per channel.
+        :param b_flush: also filter the samples that don't fill an FFT frame, as if followed by silence.
+        :return: the filtered samples that are available, one row per channel
+        """
+        np = self._np
+        signal = np.concatenate([self._input, samples], axis=1)
+        nb_samples = signal.shape[1] - self.taps + 1
+        nb_frames = nb_samples // self.hop
+        if b_flush and nb_samples % self.hop:
+            nb_frames += 1
+            signal = np.pad(signal, ((0, 0), (0, nb_frames * self.hop - nb_samples)))
+        if not nb_frames:
+            self._input = signal
+            return np.zeros((self.channels, 0))
+        frames = np.lib.stride_tricks.sliding_window_view(signal, self.fft_size, axis=1)[:, ::self.hop][:, :nb_frames]
+        filtered = np.fft.irfft(np.fft.rfft(frames) * self._filter_fft, self.fft_size)[:, :, self.taps - 1:]
+        self._input = signal[:, nb_frames * self.hop:]
+        return filtered.reshape(self.channels, -1)[:, :nb_samples]
+
+    def _add_energy(self, filtered):
+        """
+        Add the weighted energy of filtered samples to the energy of each step.
+        """
+        np = self._np
+        energy = np.concatenate([self._carry, self.weights @ (filtered * filtered)])
+        nb_steps = len(energy) // self.step
+        self._steps.append(energy[:nb_steps * self.step].reshape(nb_steps, self.step).sum(axis=1))
+        self._carry = energy[nb_steps * self.step:]
+
+    def finish(self) -> TrackAnalysis:
+        np = self._np
+        self._add_energy(self._filter(np.zeros((self.channels, 0)), b_flush=True))
+        steps = np.concatenate(self._steps) if self._steps else np.zeros(0)
+        if len(steps) >= STEPS_PER_BLOCK:
+            sums = np.convolve(steps, np.ones(STEPS_PER_BLOCK), mode='valid')
+            blocks = sums / (STEPS_PER_BLOCK * self.step)
+        elif len(steps) or len(self._carry):
+            # Shorter than a single block
+            blocks = np.array([(steps.sum() + self._carry.sum()) / (len(steps) * self.step + len(self._carry))])
+        else:
+            blocks = np.zeros(0)
+        return TrackAnalysis(loudness=gated_loudness(blocks), peak=self.peak, md5=self._md5.hexdigest(),
+                             blocks=blocks)
+
+
+def analyze_file(path, block_size=1 << 20) -> TrackAnalysis:
+    """
+    Analyse a complete WAV file, for files that weren't streamed to the encoder.
+    """
+    wav_info = read_wav_header(path)
+    analyzer = PCMAnalyzer(wav_info, path)
+    with open(path, 'rb') as f:
+        f.seek(wav_info.data_offset)
+        remaining = wav_info.data_size
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            analyzer.update(block)
+            remaining -= len(block)
+    return analyzer.finish()
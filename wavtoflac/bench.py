@@ -0,0 +1,242 @@
+"""
+Benchmark WAVToFlac and FlacToWAV on a synthetic library.
+
+A library following the layout expected by WAVToFlac._extract_tags ("Artist - (year) - Album/Disc x/NN - Title.wav")
+is generated with varying sample rates, bit depths, track lengths and cover sizes. The following stages are then
+timed, and the results are written as JSON so that runs can be compared across versions and machines:
+
+- convert: full WAV to FLAC conversion
+- noop: the same conversion again, which should not have anything left to do
+- retag: update of the tags of all converted files
+- reverse: FLAC to WAV conversion of the converted library
+
+Usage: python -m wavtoflac.bench --albums 8 --workers 4 --out bench.json
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import wave
+
+from PIL import Image
+
+from wavtoflac.covercache import CoverCache
+from wavtoflac.flactowav import FlacToWAV
+from wavtoflac.tree import TreeModel
+from wavtoflac.wavtoflac import WAVToFlac
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+SAMPLE_RATES = (44100, 48000, 96000, 192000)
+BITS_PER_SAMPLE = (16, 24)
+TRACK_LENGTHS = (5, 20, 60)
+COVER_SIZES = (300, 1200, 3000)
+
+
+def _pcm_second(sample_rate, bits_per_sample, channels, rng):
+    """
+    One second of PCM data: a tone plus some noise, so that it compresses somewhat like music does.
+    """
+    sample_width = bits_per_sample // 8
+    amplitude = (1 << (bits_per_sample - 1)) - 1
+    freq = rng.choice((220., 330., 440., 550.))
+    out = bytearray()
+    for i in range(sample_rate):
+        value = 0.5 * math.sin(2 * math.pi * freq * i / sample_rate) + rng.uniform(-0.01, 0.01)
+        sample = struct.pack('<i', int(value * amplitude))[:sample_width]
+        out += sample * channels
+    return bytes(out)
+
+
+def generate_library(root, nb_albums=8, seed=0):
+    """
+    Generate a synthetic library.
+
+    Every other album spans two discs; sample rate, bit depth, track length and cover size vary per album.
+
+    :param root: directory in which the library is generated.
+    :param nb_albums: number of albums.
+    :param seed: seed of the random generator, so that the same library can be generated again.
+    :return: dictionary with the number of tracks and the total size of the library, in bytes.
+    """
+    rng = random.Random(seed)
+    pcm_cache = {}
+    nb_tracks, nb_bytes = 0, 0
+    for idx_album in range(nb_albums):
+        sample_rate = SAMPLE_RATES[idx_album % len(SAMPLE_RATES)]
+        bits_per_sample = BITS_PER_SAMPLE[idx_album % len(BITS_PER_SAMPLE)]
+        length = TRACK_LENGTHS[idx_album % len(TRACK_LENGTHS)]
+        cover_size = COVER_SIZES[idx_album % len(COVER_SIZES)]
+
+        album_dir = os.path.join(root, f"Artist {idx_album % 3} - ({1970 + idx_album}) - Album {idx_album}")
+        disc_dirs = [album_dir] if idx_album % 2 == 0 else \
+            [os.path.join(album_dir, f"Disc {d}") for d in (1, 2)]
+
+        key = (sample_rate, bits_per_sample)
+        if key not in pcm_cache:
+            pcm_cache[key] = _pcm_second(sample_rate, bits_per_sample, 2, rng)
+        pcm = pcm_cache[key]
+
+        for disc_dir in disc_dirs:
+            os.makedirs(disc_dir, exist_ok=True)
+            cover = Image.frombytes('RGB', (cover_size, cover_size), os.urandom(cover_size * cover_size * 3))
+            cover.save(os.path.join(disc_dir, 'cover.jpg'), quality=90)
+
+            for idx_track in range(1, rng.randint(4, 8) + 1):
+                path = os.path.join(disc_dir, f"{idx_track:02d} - Title {idx_track}.wav")
+                with wave.open(path, 'wb') as f:
+                    f.setnchannels(2)
+                    f.setsampwidth(bits_per_sample // 8)
+                    f.setframerate(sample_rate)
+                    f.writeframes(pcm * length)
+                nb_tracks += 1
+                nb_bytes += os.path.getsize(path)
+
+    return {'tracks': nb_tracks, 'bytes': nb_bytes}
+
+
+def _tree_stats(root, extension):
+    """
+    Number and total size of the files with the given extension in a tree.
+    """
+    tree = TreeModel.scan(root)
+    nb_files, nb_bytes = 0, 0
+    for dir_info in tree.dirs.values():
+        for name in dir_info.files:
+            if name.lower().endswith(extension):
+                nb_files += 1
+                nb_bytes += dir_info.file_info(name).size
+    return nb_files, nb_bytes
+
+
+def _peak_rss_mb():
+    """
+    Peak resident set size of this process and of its (waited for) child processes, e.g., the encoders, in MB.
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    scale = 1 / (1 << 20) if sys.platform == 'darwin' else 1 / (1 << 10)
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale, 1))
+
+
+def _run_stage(name, func, nb_files, nb_bytes, b_verbose):
+    print(f"Running stage '{name}'...", file=sys.stderr)
+    out = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stdout if b_verbose else out):
+        func()
+    elapsed = time.perf_counter() - start
+    peak_rss_self, peak_rss_children = _peak_rss_mb()
+    return {'stage': name,
+            'seconds': round(elapsed, 3),
+            'files': nb_files,
+            'bytes': nb_bytes,
+            'files_per_s': round(nb_files / elapsed, 2) if elapsed else None,
+            'mb_per_s': round(nb_bytes / 1e6 / elapsed, 2) if elapsed else None,
+            'peak_rss_mb': peak_rss_self,
+            'peak_rss_children_mb': peak_rss_children}
+
+
+def run_benchmark(root, nb_albums=8, workers=None, seed=0, b_verbose=False):
+    """
+    Generate a library in root, and time all stages.
+
+    :param root: working directory; the library, its conversion and the reverse conversion are written here.
+    :param nb_albums: number of albums in the synthetic library.
+    :param workers: number of worker processes used by the conversions; defaults to the number of CPUs.
+    :param seed: seed used to generate the library.
+    :param b_verbose: show the output of the conversions.
+    :return: dictionary with the results, ready to be dumped as JSON.
+    """
+    path_lib = os.path.join(root, 'library')
+    path_flac = os.path.join(root, 'flac')
+    path_wav = os.path.join(root, 'wav')
+
+    start = time.perf_counter()
+    library = generate_library(path_lib, nb_albums=nb_albums, seed=seed)
+    library['generate_seconds'] = round(time.perf_counter() - start, 3)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        w2f = WAVToFlac(cover_cache=CoverCache(cache_dir=os.path.join(root, 'cover_cache')))
+        f2w = FlacToWAV()
+
+    def convert():
+        w2f.parse_dir_convert(path_in=path_lib, path_out=path_flac, b_add_cover=True, to_copy={'jpg'},
+                              workers=workers)
+
+    def retag():
+        w2f.update_tags(path_flac)
+
+    def reverse():
+        f2w.parse_dir_convert(path_flac, path_out=path_wav, to_copy={'jpg'}, workers=workers)
+
+    nb_wav, bytes_wav = _tree_stats(path_lib, '.wav')
+    stages = [_run_stage('convert', convert, nb_wav, bytes_wav, b_verbose),
+              _run_stage('noop', convert, nb_wav, bytes_wav, b_verbose)]
+    nb_flac, bytes_flac = _tree_stats(path_flac, '.flac')
+    stages += [_run_stage('retag', retag, nb_flac, bytes_flac, b_verbose),
+               _run_stage('reverse', reverse, nb_flac, bytes_flac, b_verbose)]
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'workers': workers,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'library': library,
+            'failed': len(w2f.failed) + len(f2w.failed),
+            'compression_ratio': round(bytes_flac / bytes_wav, 4) if bytes_wav else None,
+            'stages': stages}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark WAVToFlac and FlacToWAV on a synthetic library.")
+    parser.add_argument('--albums', type=int, default=8, help="number of albums in the synthetic library")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes")
+    parser.add_argument('--seed', type=int, default=0, help="seed used to generate the library")
+    parser.add_argument('--root', default=None,
+                        help="directory in which the working directory is created (default: the system's temporary "
+                             "directory); nothing else in it is touched")
+    parser.add_argument('--keep', action='store_true', help="don't remove the working directory afterwards")
+    parser.add_argument('--out', default=None, help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--verbose', action='store_true', help="show the output of the conversions")
+    args = parser.parse_args(argv)
+
+    # Always a new directory, so that removing it afterwards can't remove anything the benchmark didn't create
+    if args.root is not None:
+        os.makedirs(args.root, exist_ok=True)
+    root = tempfile.mkdtemp(prefix='wavtoflac_bench_', dir=args.root)
+    if args.keep:
+        print(f"Working directory: [{root}]", file=sys.stderr)
+    try:
+        results = run_benchmark(root, nb_albums=args.albums, workers=args.workers, seed=args.seed,
+                                b_verbose=args.verbose)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.out is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+Fit a selection of a library onto a device of fixed capacity, e.g., an SD card, instead of mirroring everything until
+the device is full.
+
+The size each album will take on the target is estimated before anything is converted: from the WAV headers of its
+tracks and a compression ratio calibrated on files that were already converted, or from the actual size of the
+files that are already on the target. Albums are then selected by priority until the budget is used up.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+import random
+from typing import NamedTuple
+
+from wavtoflac.wavinfo import read_wav_header
+
+# Compression ratio (size of the FLAC file / size of the PCM data) used when no converted files are available to
+# calibrate on
+DEFAULT_RATIO = 0.6
+# Size of the FLAC file of a decoded MPEG audio file, relative to the size of the MPEG audio file
+MPGA_FLAC_FACTOR = 4.5
+# Maximum number of converted files read to calibrate the compression ratios
+CALIBRATION_SAMPLE = 200
+# Size of the metadata of a FLAC file (tags, cover, padding), in bytes
+FLAC_OVERHEAD = 64 * 1024
+
+# Decimal units, as the capacity of storage devices is given in
+SIZE_UNITS = {'': 1, 'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12}
+
+
+def parse_size(size) -> int:
+    """
+    Parse a size such as '256G' or '1.5T', or a number of bytes.
+    """
+    text = str(size).strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    try:
+        value = float(text[:len(text) - len(unit)])
+    except ValueError:
+        raise ValueError(f"Invalid size '{size}', expected e.g. '256G' or a number of bytes.")
+    return int(value * SIZE_UNITS[unit])
+
+
+class CompressionModel:
+    def __init__(self, default=DEFAULT_RATIO):
+        """
+        Estimate the size of FLAC files from the WAV files they are encoded from.
+
+        :param default: compression ratio used for sample formats that weren't calibrated.
+        """
+        self.default = default
+        # Bits per sample -> compression ratio
+        self.ratios = {}
+
+    @classmethod
+    def calibrate(cls, pairs, sample_size=CALIBRATION_SAMPLE, seed=0):
+        """
+        Compute the compression ratio of each sample format from files that were already converted.
+
+        :param pairs: list of (WAV file, size of its FLAC file in bytes) tuples.
+        :param sample_size: maximum number of WAV headers to read.
+        :param seed: seed of the sample.
+        :return: CompressionModel
+        """
+        model = cls()
+        pairs = list(pairs)
+        if len(pairs) > sample_size:
+            pairs = random.Random(seed).sample(pairs, sample_size)
+        totals = {}
+        for path_in, size_out in pairs:
+            try:
+                info = read_wav_header(path_in)
+            except (OSError, ValueError):
+                continue
+            total_in, total_out = totals.get(info.bits_per_sample, (0, 0))
+            totals[info.bits_per_sample] = (total_in + info.data_size, total_out + max(0, size_out - FLAC_OVERHEAD))
+        model.ratios = {bits: total_out / total_in for bits, (total_in, total_out) in totals.items() if total_in > 0}
+        return model
+
+    def ratio(self, bits_per_sample):
+        return self.ratios.get(bits_per_sample, self.default)
+
+    def estimate(self, path_in, size_in):
+        """
+        Estimate the size of the FLAC file a WAV or MPGA file will be converted to.
+
+        :param path_in: the file to convert.
+        :param size_in: its size in bytes.
+        :return: estimated size in bytes
+        """
+        if path_in.lower().endswith('.wav'):
+            try:
+                info = read_wav_header(path_in)
+                return FLAC_OVERHEAD + int(info.data_size * self.ratio(info.bits_per_sample))
+            except (OSError, ValueError):
+                return FLAC_OVERHEAD + int(size_in * self.default)
+        return FLAC_OVERHEAD + int(size_in * MPGA_FLAC_FACTOR)
+
+
+class AlbumEstimate(NamedTuple):
+    # Album directory, directly below the source root
+    path: str
+    # Estimated size of the album on the target, in bytes
+    size: int
+    # Part of size that is already on the target
+    size_done: int
+    # Most recent modification time of the files of the album
+    mtime_ns: int
+
+
+def estimate_albums(tree, out_tree, path_in, path_out, to_copy, rows=None):
+    """
+    Estimate the size each album, i.e., each directory directly below path_in, takes on the target once it is
+    converted. Files that are already on the target count for their actual size; the size of the others is
+    estimated from their WAV header, with compression ratios calibrated on the files of the manifest (rows) that are
+    on the target, or, without manifest, on the WAV files of which the FLAC file is on the target.
+
+    :param tree: tree.TreeModel of path_in, with file sizes and modification times.
+    :param out_tree: tree.TreeModel of path_out, with file sizes.
+    :param path_in: root of the source.
+    :param path_out: root of the target.
+    :param to_copy: set of file extensions that are copied as is.
+    :param rows: the content of the manifest, as returned by Manifest.load(), or None.
+    :return: list of AlbumEstimate; the compression model used
+    """
+    albums = []
+    pending, pairs = [], []
+    root_info = tree.get(path_in)
+    for album in sorted(root_info.subdirs):
+        album_dir = os.path.join(path_in, album)
+        size, size_done, mtime_ns, todo = 0, 0, 0, []
+        stack = [album_dir]
+        while stack:
+            dir_in = stack.pop()
+            dir_info = tree.get(dir_in)
+            stack.extend(os.path.join(dir_in, elem) for elem in dir_info.subdirs)
+            dir_out = path_out + dir_in[len(path_in):]
+            dir_info_out = out_tree.get(dir_out)
+            for elem in dir_info.files:
+                ext = elem.rsplit('.', 1)[1].lower() if '.' in elem else ''
+                if ext in ('wav', 'mpga'):
+                    name_out = elem[:-4] + '.flac'
+                elif ext in to_copy:
+                    name_out = elem
+                else:
+                    continue
+                info = dir_info.file_info(elem)
+                mtime_ns = max(mtime_ns, info.mtime_ns)
+                if dir_info_out is not None and name_out in dir_info_out.files:
+                    size_out = dir_info_out.file_info(name_out).size
+                    size += size_out
+                    size_done += size_out
+                    if ext == 'wav' and rows is None:
+                        pairs.append((os.path.join(dir_in, elem), size_out))
+                elif ext in to_copy:
+                    size += info.size
+                else:
+                    todo.append((os.path.join(dir_in, elem), info.size))
+        pending.append(todo)
+        albums.append(AlbumEstimate(album_dir, size, size_done, mtime_ns))
+
+    if rows is not None:
+        for source, row in rows.items():
+            if not source.lower().endswith('.wav'):
+                continue
+            full_path_out = os.path.join(path_out, row.path_out)
+            dir_info_out = out_tree.get(os.path.dirname(full_path_out))
+            if dir_info_out is not None and os.path.basename(full_path_out) in dir_info_out.files:
+                pairs.append((os.path.join(path_in, source),
+                              dir_info_out.file_info(os.path.basename(full_path_out)).size))
+    model = CompressionModel.calibrate(pairs)
+
+    return [album._replace(size=album.size + sum(model.estimate(path, size) for path, size in todo))
+            for album, todo in zip(albums, pending)], model
+
+
+def select_albums(albums, budget, priority='recent'):
+    """
+    Select albums, in order of priority, as long as they fit in the budget. Albums that don't fit are skipped, and
+    the next ones tried.
+
+    :param albums: list of AlbumEstimate.
+    :param budget: number of bytes available for the library on the target.
+    :param priority: 'recent' (most recently modified albums first), 'name' (alphabetical order), or a function
+    returning the priority of an album directory (highest first).
+    :return: selected albums, in order of priority; skipped albums, in order of priority
+    """
+    if priority == 'recent':
+        ordered = sorted(albums, key=lambda album: -album.mtime_ns)
+    elif priority == 'name':
+        ordered = sorted(albums, key=lambda album: album.path)
+    elif callable(priority):
+        ordered = sorted(albums, key=lambda album: -priority(album.path))
+    else:
+        raise ValueError(f"Argument 'priority' should be 'recent', 'name' or a function, got '{priority}' instead.")
+
+    selected, skipped, used = [], [], 0
+    for album in ordered:
+        if used + album.size <= budget:
+            selected.append(album)
+            used += album.size
+        else:
+            skipped.append(album)
+    return selected, skipped
+
+
+def report(selected, skipped, budget):
+    """
+    Print the outcome of select_albums().
+    """
+    size = sum(album.size for album in selected)
+    done = sum(album.size_done for album in selected)
+    print(f"Selected {len(selected)} albums, {size / 1e9:.2f} GB of {budget / 1e9:.2f} GB "
+          f"({done / 1e9:.2f} GB already on target, {(size - done) / 1e9:.2f} GB to write).")
+    if skipped:
+        print(f"Skipped {len(skipped)} albums that don't fit, {sum(album.size for album in skipped) / 1e9:.2f} GB:")
+        for album in skipped:
+            print(f"\t{os.path.basename(album.path)} ({album.size / 1e6:.0f} MB)")
@@ -0,0 +1,222 @@
+"""
+Command line interface:
+
+    wavtoflac convert PATH_IN PATH_OUT --cover --copy jpg png pdf
+    wavtoflac convert PATH_IN PATH_OUT --stream --order newest --copy jpg png
+    wavtoflac plan PATH_IN PATH_OUT --cover --copy jpg png pdf
+    wavtoflac budget PATH_IN PATH_OUT 256G --priority recent --cover --copy jpg png [--dry-run]
+    wavtoflac prune PATH_IN PATH_OUT [--delete] [--stream]
+    wavtoflac retag PATH
+    wavtoflac restore PATH_IN PATH_OUT --copy mp3 jpg png
+    wavtoflac watch PATH_IN PATH_OUT --cover --copy jpg png
+    wavtoflac verify PATH_IN PATH_OUT [--decode] [--since DAYS] [--time-limit MINUTES] [--restored]
+
+Only the modules a command needs are imported, so that, e.g., planning or pruning starts fast.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import argparse
+import asyncio
+
+
+def _add_convert_args(parser):
+    parser.add_argument('path_in', help="root of the WAV library")
+    parser.add_argument('path_out', help="directory in which the library is mirrored")
+    parser.add_argument('--cover', action='store_true', help="add the cover image of each album to its files")
+    parser.add_argument('--copy', nargs='*', default=[], metavar='EXT',
+                        help="extensions of the files that are copied as is, e.g., jpg png pdf")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes")
+
+
+def _add_manifest_arg(parser):
+    parser.add_argument('--no-manifest', action='store_true',
+                        help="don't use the manifest; skip every file for which an output exists")
+
+
+def _converter(args):
+    from wavtoflac.wavtoflac import Encoder, WAVToFlac
+    return WAVToFlac(encoder=Encoder(getattr(args, 'encoder', 'stream')), profile=getattr(args, 'profile', 'balanced'))
+
+
+def _recorder(args):
+    from wavtoflac.metrics import JsonlSink, ProgressSink, Recorder, SummarySink
+    sinks = [ProgressSink()]
+    if args.summary:
+        sinks.append(SummarySink())
+    if args.trace is not None:
+        sinks.append(JsonlSink(args.trace))
+    return Recorder(sinks)
+
+
+def cmd_convert(args):
+    w2f = _converter(args)
+    if args.stream:
+        if args.resume or args.dedupe or args.throttle or args.analyze or args.use_async:
+            raise SystemExit("--stream can't be combined with --resume, --dedupe, --throttle, --analyze or --async.")
+        w2f.parse_dir_convert_stream(args.path_in, args.path_out, b_add_cover=args.cover, to_copy=set(args.copy),
+                                     workers=args.workers, b_manifest=not args.no_manifest, recorder=_recorder(args),
+                                     order=args.order, max_pending=args.max_pending)
+        return 1 if w2f.failed else 0
+    kwargs = dict(path_in=args.path_in, path_out=args.path_out, b_add_cover=args.cover, to_copy=set(args.copy),
+                  b_manifest=not args.no_manifest, recorder=_recorder(args), b_resume=args.resume)
+    if args.use_async:
+        asyncio.run(w2f.convert_async(max_encoders=args.workers, **kwargs))
+    else:
+        w2f.parse_dir_convert(workers=args.workers, b_dedupe=args.dedupe, b_throttle=args.throttle,
+                              b_analyze=args.analyze, **kwargs)
+    return 1 if w2f.failed else 0
+
+
+def cmd_plan(args):
+    w2f = _converter(args)
+    w2f.plan(args.path_in, args.path_out, b_add_cover=args.cover, to_copy=set(args.copy), workers=args.workers,
+             b_manifest=not args.no_manifest)
+    return 0
+
+
+def cmd_budget(args):
+    w2f = _converter(args)
+    w2f.parse_dir_convert_budget(args.path_in, args.path_out, args.size, priority=args.priority,
+                                 to_copy=set(args.copy), b_manifest=not args.no_manifest, b_dry_run=args.dry_run,
+                                 b_add_cover=args.cover, workers=args.workers)
+    return 1 if w2f.failed else 0
+
+
+def cmd_prune(args):
+    w2f = _converter(args)
+    w2f.check_dirs_out_to_in(args.path_in, args.path_out, b_delete=args.delete, workers=args.threads,
+                             b_stream=args.stream)
+    return 0
+
+
+def cmd_retag(args):
+    w2f = _converter(args)
+    w2f.update_tags(args.path)
+    return 1 if w2f.failed else 0
+
+
+def cmd_restore(args):
+    from wavtoflac.flactowav import Decoder, FlacToWAV
+    f2w = FlacToWAV(decoder=Decoder(args.decoder))
+    f2w.parse_dir_convert(args.path_in, args.path_in, to_copy=set(args.copy), path_out=args.path_out,
+                          workers=args.workers)
+    return 1 if f2w.failed else 0
+
+
+def cmd_watch(args):
+    from wavtoflac.watch import Watcher
+    watcher = Watcher(_converter(args), args.path_in, args.path_out, b_add_cover=args.cover, to_copy=set(args.copy),
+                      workers=args.workers, settle=args.settle)
+    watcher.run(b_initial_sync=args.initial_sync)
+    return 0
+
+
+def cmd_verify(args):
+    import time
+    kwargs = dict(workers=args.workers, device_streams=args.streams, b_decode=args.decode, b_full=args.full,
+                  since_ns=None if args.since is None else time.time_ns() - int(args.since * 86400e9),
+                  time_limit=None if args.time_limit is None else args.time_limit * 60)
+    if args.restored:
+        from wavtoflac.flactowav import FlacToWAV
+        converter = FlacToWAV()
+    else:
+        converter = _converter(args)
+    converter.verify(args.path_in, args.path_out, **kwargs)
+    return 1 if converter.failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='wavtoflac', description="Mirror a WAV library as FLAC files.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    convert = commands.add_parser('convert', help="convert the WAV and MPGA files of a library to FLAC")
+    _add_convert_args(convert)
+    _add_manifest_arg(convert)
+    convert.add_argument('--encoder', choices=['stream', 'pydub'], default='stream', help="how files are encoded")
+    convert.add_argument('--profile', choices=['fast', 'balanced', 'max'], default='balanced',
+                         help="FLAC encoder settings")
+    convert.add_argument('--resume', action='store_true', help="resume an interrupted run")
+    convert.add_argument('--dedupe', action='store_true', help="encode identical audio only once")
+    convert.add_argument('--throttle', action='store_true',
+                         help="encode fewer files at a time when the target device can't keep up")
+    convert.add_argument('--analyze', action='store_true',
+                         help="write ReplayGain tags (EBU R128 loudness) and check the encoded audio; needs numpy")
+    convert.add_argument('--async', dest='use_async', action='store_true',
+                         help="overlap reads, encodes and copies with asyncio, for slow target devices")
+    convert.add_argument('--stream', action='store_true',
+                         help="for very large libraries: convert files as the source is walked, with flat memory use")
+    convert.add_argument('--order', choices=['name', 'newest', 'oldest'], default='name',
+                         help="with --stream, the order in which directories are converted")
+    convert.add_argument('--max-pending', type=int, default=None, metavar='N',
+                         help="with --stream, the maximum number of files queued or being converted at a time")
+    convert.add_argument('--summary', action='store_true', help="print a table of the time spent per stage")
+    convert.add_argument('--trace', default=None, metavar='FILE', help="write the metrics of each file as JSONL")
+    convert.set_defaults(func=cmd_convert)
+
+    plan = commands.add_parser('plan', help="list what 'convert' would do, with estimated sizes and durations")
+    _add_convert_args(plan)
+    _add_manifest_arg(plan)
+    plan.set_defaults(func=cmd_plan)
+
+    budget = commands.add_parser('budget', help="convert the albums that fit in a given size, by priority")
+    _add_convert_args(budget)
+    _add_manifest_arg(budget)
+    budget.add_argument('size', help="size the converted library may take on the target, e.g., 256G")
+    budget.add_argument('--priority', choices=['recent', 'name'], default='recent',
+                        help="which albums go first: the most recently modified ones, or in alphabetical order")
+    budget.add_argument('--profile', choices=['fast', 'balanced', 'max'], default='balanced',
+                        help="FLAC encoder settings")
+    budget.add_argument('--dry-run', action='store_true', help="only report which albums would be selected")
+    budget.set_defaults(func=cmd_budget)
+
+    prune = commands.add_parser('prune', help="find what is on the target but no longer in the source")
+    prune.add_argument('path_in', help="root of the WAV library")
+    prune.add_argument('path_out', help="directory in which the library is mirrored")
+    prune.add_argument('--delete', action='store_true', help="delete what was found; otherwise only report it")
+    prune.add_argument('--threads', type=int, default=4, help="number of threads per device")
+    prune.add_argument('--stream', action='store_true',
+                       help="for very large libraries: compare the trees one directory at a time, with flat memory use")
+    prune.set_defaults(func=cmd_prune)
+
+    retag = commands.add_parser('retag', help="update the tags of a FLAC library to the ones derived from its paths")
+    retag.add_argument('path', help="root of the FLAC library")
+    retag.set_defaults(func=cmd_retag)
+
+    restore = commands.add_parser('restore', help="convert a FLAC library back to WAV")
+    restore.add_argument('path_in', help="root of the FLAC library")
+    restore.add_argument('path_out', help="directory in which the library is mirrored")
+    restore.add_argument('--copy', nargs='*', default=[], metavar='EXT',
+                         help="extensions of the files that are copied as is, e.g., mp3 jpg png")
+    restore.add_argument('--workers', type=int, default=None, help="number of worker processes")
+    restore.add_argument('--decoder', choices=['direct', 'pydub'], default='direct', help="how files are decoded")
+    restore.set_defaults(func=cmd_restore)
+
+    watch = commands.add_parser('watch', help="keep the target in sync while the source changes (Linux only)")
+    _add_convert_args(watch)
+    watch.add_argument('--settle', type=float, default=5.,
+                       help="number of seconds without changes after which the changed albums are synced")
+    watch.add_argument('--initial-sync', action='store_true', help="first bring the whole target up to date")
+    watch.set_defaults(func=cmd_watch)
+
+    verify = commands.add_parser('verify', help="check that the converted files hold the audio of their source")
+    verify.add_argument('path_in', help="root of the source library")
+    verify.add_argument('path_out', help="directory in which the library is mirrored")
+    verify.add_argument('--decode', action='store_true',
+                        help="decode the FLAC files, instead of trusting the MD5 stored in their header")
+    verify.add_argument('--restored', action='store_true',
+                        help="PATH_IN holds FLAC files that were restored to WAV files in PATH_OUT")
+    verify.add_argument('--since', type=float, default=None, metavar='DAYS',
+                        help="also verify the files last verified more than DAYS days ago")
+    verify.add_argument('--time-limit', type=float, default=None, metavar='MINUTES',
+                        help="don't start verifying files after MINUTES minutes; the next run continues")
+    verify.add_argument('--full', action='store_true', help="verify all files")
+    verify.add_argument('--workers', type=int, default=None, help="number of threads")
+    verify.add_argument('--streams', type=int, default=2, help="number of files read at a time per device")
+    verify.set_defaults(func=cmd_verify)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,192 @@
+"""
+Copy files (e.g., mp3/flac/m4a/dsf/pdf/images, that are mirrored as is) with zero-copy transfers, using a thread pool
+per target device.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from wavtoflac.devices import device_id, mount_point
+from wavtoflac.metrics import FileMetrics
+
+# Suffix of the temporary files copies are written to, before renaming them to their final name
+TEMP_SUFFIX = '.part'
+
+
+def needs_copy(src_info, dst_info):
+    """
+    Decide whether a file should be (re-)copied.
+
+    Files are copied with the modification time of their source, so a target that is older than its source, or has
+    a different size, is out of date.
+
+    :param src_info: tree.FileInfo of the source file
+    :param dst_info: tree.FileInfo of the target file, or None if it doesn't exist
+    :return: bool
+    """
+    return dst_info is None or dst_info.size != src_info.size or dst_info.mtime_ns < src_info.mtime_ns
+
+
+def _zero_copy(fd_in, fd_out, size):
+    """
+    Copy 'size' bytes between two file descriptors without passing them through user space, if the OS allows it.
+    """
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                n = os.copy_file_range(fd_in, fd_out, size - offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError:
+            # Not supported for these file systems/this kernel; continue with sendfile
+            pass
+    if offset < size and hasattr(os, 'sendfile'):
+        try:
+            while offset < size:
+                n = os.sendfile(fd_out, fd_in, offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError:
+            pass
+    if offset < size:
+        os.lseek(fd_in, offset, os.SEEK_SET)
+        os.lseek(fd_out, offset, os.SEEK_SET)
+        with open(fd_in, 'rb', closefd=False) as f_in, open(fd_out, 'wb', closefd=False) as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    return size
+
+
+def clone_file(path_in, path_out):
+    """
+    Copy the content of a file, without passing it through user space if the OS allows it; file systems that
+    support it (e.g., btrfs, XFS) then share the data blocks of both files instead of copying them.
+
+    :param path_in: the file to copy
+    :param path_out: the copy
+    :return: os.stat_result of path_in
+    """
+    with open(path_in, 'rb') as f_in, open(path_out, 'wb') as f_out:
+        st = os.fstat(f_in.fileno())
+        _zero_copy(f_in.fileno(), f_out.fileno(), st.st_size)
+    return st
+
+
+def copy_file(path_in, path_out):
+    """
+    Copy a file, giving the copy the modification time of the source. The copy is written to a temporary file
+    first, and renamed once complete.
+
+    :param path_in: the file to copy
+    :param path_out: the copy
+    :return: number of bytes copied
+    """
+    temp_file = path_out + TEMP_SUFFIX
+    try:
+        st = clone_file(path_in, temp_file)
+        size = st.st_size
+        os.utime(temp_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(temp_file, path_out)
+    except Exception:
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+        raise
+    return size
+
+
+class BulkCopier:
+    def __init__(self, workers=4, device_workers=None, b_fsync=False, on_copy=None):
+        """
+
+        :param workers: number of threads copying to a single target device.
+        :param device_workers: optional dictionary mapping a path to the number of threads copying to the device
+        holding that path, e.g., {PATH_OUT: 2} for an SD card.
+        :param b_fsync: flush all copied files to their device once all copies are done.
+        :param on_copy: optional function called as on_copy(metrics, b_ok) after each copy, from the copying thread,
+        with the metrics.FileMetrics of the copy.
+        """
+        self.workers = workers
+        self.device_workers = {device_id(p): n for p, n in (device_workers or {}).items()}
+        self.b_fsync = b_fsync
+        self.on_copy = on_copy
+        # Device id -> (executor, futures, job paths, start time)
+        self._devices = {}
+        # All futures, in the order in which the jobs were submitted
+        self._submitted = []
+        self._lock = threading.Lock()
+        # Device id -> number of bytes copied, time at which the last copy finished
+        self._bytes = {}
+        self._end = {}
+
+    def submit(self, jobs):
+        """
+        Start copying, in the background.
+
+        :param jobs: list of objects with 'path_in' and 'path_out' attributes.
+        :return:
+        """
+        for job in jobs:
+            dev = device_id(os.path.dirname(job.path_out))
+            if dev not in self._devices:
+                executor = ThreadPoolExecutor(max_workers=self.device_workers.get(dev, self.workers))
+                self._devices[dev] = (executor, [], [], time.perf_counter())
+                self._bytes[dev] = 0
+            executor, futures, paths, _ = self._devices[dev]
+            future = executor.submit(self._copy, dev, job.path_in, job.path_out)
+            futures.append(future)
+            paths.append(job.path_out)
+            self._submitted.append(future)
+
+    def _copy(self, dev, path_in, path_out):
+        print(f"Copying [{path_in}] to\n\t[{path_out}]")
+        metrics = FileMetrics(path_in, kind='copy')
+        b_ok = True
+        with metrics.activate(), metrics.stage('copy'):
+            try:
+                metrics.bytes_in = metrics.bytes_out = copy_file(path_in, path_out)
+            except Exception as e:
+                print(e.__class__.__name__)
+                print(e)
+                b_ok = False
+        if b_ok:
+            with self._lock:
+                self._bytes[dev] += metrics.bytes_out
+                self._end[dev] = time.perf_counter()
+        if self.on_copy is not None:
+            self.on_copy(metrics, b_ok)
+        return b_ok
+
+    @classmethod
+    def _fsync(cls, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def finish(self):
+        """
+        Wait for all copies to finish, flush them if requested, and report the throughput of each device.
+
+        :return: list of booleans, True for each successful copy, in the order in which the jobs were submitted.
+        """
+        results = {}
+        for dev, (executor, futures, paths, start) in self._devices.items():
+            b_ok = [f.result() for f in futures]
+            if self.b_fsync:
+                list(executor.map(self._fsync, [p for p, ok in zip(paths, b_ok) if ok]))
+            executor.shutdown()
+            elapsed = (time.perf_counter() if self.b_fsync else self._end.get(dev, start)) - start
+            nb_bytes = self._bytes[dev]
+            print(f"Copied {sum(b_ok)} files ({nb_bytes / 1e6:.1f} MB) to [{mount_point(paths[0])}] "
+                  f"at {nb_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s.")
+            results.update(zip(futures, b_ok))
+        submitted, self._devices, self._submitted = self._submitted, {}, []
+
+        return [results[f] for f in submitted]
@@ -0,0 +1,130 @@
+"""
+Cache of cover images, resized and re-encoded to JPEG once per album instead of once per track.
+
+Prepared covers are stored outside of the music library, in a cache directory that is kept under a size cap by
+evicting the least recently used images.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import hashlib
+import os
+import tempfile
+
+from wavtoflac.metrics import stage
+
+HOME = os.path.expanduser("~")
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(HOME, '.cache')), 'wavtoflac', 'covers')
+MAX_CACHE_SIZE = 256 * (1 << 20)
+COVER_HEIGHT = 500
+
+
+class CoverCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_size=MAX_CACHE_SIZE, height=COVER_HEIGHT):
+        """
+
+        :param cache_dir: directory in which prepared covers are stored.
+        :param max_size: maximum total size of the prepared covers, in bytes.
+        :param height: covers higher than this are resized to this height, keeping their aspect ratio.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.height = height
+        # Covers prepared or looked up by this process: cache key -> path of the prepared cover
+        self._paths = {}
+        # Last cover read by this process, as (path of the prepared cover, bytes); tracks of an album are usually
+        # processed one after the other
+        self._last_data = None
+
+    def get(self, path, file_info=None) -> str:
+        """
+        Get the prepared version of a cover image, preparing it if it isn't cached yet.
+
+        :param path: path to the original image.
+        :param file_info: the size and modification time of the image (tree.FileInfo), if already known.
+        :return: path to the prepared JPEG image.
+        """
+        if file_info is None:
+            st = os.stat(path)
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        else:
+            size, mtime_ns = file_info
+        key = hashlib.blake2b(f"{os.path.abspath(path)}|{size}|{mtime_ns}|{self.height}".encode('utf-8'),
+                              digest_size=16).hexdigest()
+
+        cached = self._paths.get(key)
+        if cached is not None:
+            return cached
+
+        cached = os.path.join(self.cache_dir, key + '.jpg')
+        if os.path.isfile(cached):
+            # Mark as recently used
+            os.utime(cached)
+        else:
+            with stage('cover'):
+                self._prepare(path, cached)
+                self._evict()
+        self._paths[key] = cached
+
+        return cached
+
+    def read(self, cached) -> bytes:
+        """
+        Get the bytes of a prepared cover image.
+
+        :param cached: path to the prepared image, as returned by get().
+        :return: the prepared JPEG image.
+        """
+        if self._last_data is None or self._last_data[0] != cached:
+            with open(cached, 'rb') as f:
+                self._last_data = (cached, f.read())
+        return self._last_data[1]
+
+    def _prepare(self, path, cached):
+        from PIL import Image
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        with open(path, 'rb') as f:
+            img_pic = Image.open(f).convert('RGB')
+        if img_pic.height > self.height:
+            conv = self.height / img_pic.height
+            new_width = round(img_pic.width*conv)
+            img_pic = img_pic.resize((new_width, self.height))
+            print(f"Resized cover image to {new_width}px x {self.height}px.")
+
+        # Write to a temporary file first, so that other processes never see a partially written cover
+        fd, temp_file = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                img_pic.save(f, format='JPEG', quality=95)
+            os.replace(temp_file, cached)
+        except Exception:
+            os.remove(temp_file)
+            raise
+
+    def _evict(self):
+        """
+        Remove the least recently used covers until the cache is below its size cap.
+        """
+        entries = []
+        total_size = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.jpg'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                    total_size += st.st_size
+        if total_size <= self.max_size:
+            return
+
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Evicted by another process
+                pass
+            for key in [k for k, v in self._paths.items() if v == path]:
+                del self._paths[key]
+            total_size -= size
+            if total_size <= self.max_size:
+                break
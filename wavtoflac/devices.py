@@ -0,0 +1,83 @@
+"""
+Per-device concurrency limits, so that slow devices (e.g., an SD card) are never oversubscribed while faster ones
+are kept busy.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import asyncio
+import os
+
+
+def device_id(path):
+    """
+    Get the id of the device holding a path. For paths that don't exist (yet), the device of the closest existing
+    parent directory is returned.
+
+    :param path: the path
+    :return: st_dev of the path
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return os.stat(path).st_dev
+
+
+def mount_point(path):
+    """
+    Get the mount point of the file system holding a path, to name a device in reports.
+    """
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class DeviceSemaphores:
+    def __init__(self, default_limit, limits=None, factory=asyncio.Semaphore):
+        """
+
+        :param default_limit: maximum number of concurrent I/O streams per device.
+        :param limits: optional dictionary mapping a path to the limit for the device holding that path, e.g.,
+        {PATH_OUT: 1} for an SD card.
+        :param factory: semaphore class to use, e.g., asyncio.Semaphore or threading.Semaphore.
+        """
+        self.default_limit = default_limit
+        self.factory = factory
+        self._limits = {device_id(p): n for p, n in (limits or {}).items()}
+        self._semaphores = {}
+        # Directory -> device id, to avoid looking up the device of each file
+        self._devices = {}
+
+    def device(self, path):
+        dir_path = os.path.dirname(os.path.abspath(path))
+        dev = self._devices.get(dir_path)
+        if dev is None:
+            dev = self._devices[dir_path] = device_id(dir_path)
+        return dev
+
+    def limit(self, dev):
+        return self._limits.get(dev, self.default_limit)
+
+    def get(self, path):
+        """
+        Get the semaphore of the device holding a path.
+        """
+        dev = self.device(path)
+        sem = self._semaphores.get(dev)
+        if sem is None:
+            sem = self._semaphores[dev] = self.factory(self.limit(dev))
+        return sem
+
+    def for_paths(self, *paths):
+        """
+        Get the semaphores of the devices holding the given paths, each device only once, always in the same order
+        so that acquiring them one after the other can't deadlock.
+        """
+        devs = sorted({self.device(p): p for p in paths}.items())
+        return [self.get(p) for _, p in devs]
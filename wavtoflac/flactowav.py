@@ -3,18 +3,31 @@ Convert files in flac to wav, following same directory structure.
 
 .. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
 """
+import mmap
 import os
-import shutil
+import subprocess
 from enum import Enum
+from typing import NamedTuple
 
-from mutagen.flac import FLAC
-from pydub import AudioSegment
-from termcolor import cprint
+
+from wavtoflac.copier import TEMP_SUFFIX, copy_file
+from wavtoflac.pool import run_jobs
+from wavtoflac.tree import TreeModel
+from wavtoflac.verify import Status, Verifier, collect_jobs, report
+from wavtoflac.wavinfo import wav_header
 
 # Defaults
 HOME = os.path.expanduser("~")
 PATH_IN = os.path.join(HOME, "../../media/lmertens/SD_CARD/MUSIC")
 PATH_OUT = os.path.join(HOME, "../../media/lmertens/MusicMorryIII/Music")
+# Size of the blocks of PCM data that are read from the decoder at a time
+BLOCK_SIZE = 1 << 20
+
+# ffmpeg raw output format and codec for each number of bits per sample that can be decoded directly
+PCM_RAW_FORMATS = {8: ('u8', 'pcm_u8'),
+                   16: ('s16le', 'pcm_s16le'),
+                   24: ('s24le', 'pcm_s24le'),
+                   32: ('s32le', 'pcm_s32le')}
 
 
 class Format(Enum):
@@ -23,83 +36,250 @@ class Format(Enum):
     WAV = '.wav'
 
 
+class Decoder(Enum):
+    # Load the full FLAC file in memory with pydub, and export it to WAV
+    PYDUB = 'pydub'
+    # Read the PCM data decoded by ffmpeg, one block at a time, straight into the memory-mapped WAV file
+    DIRECT = 'direct'
+
+
+class ConvertJob(NamedTuple):
+    """
+    A single file to be processed by FlacToWAV._process_job; b_convert is False for files that should simply be copied.
+    """
+    path_in: str
+    path_out: str
+    b_convert: bool
+
+
 class FlacToWAV:
-    def __init__(self):
+    def __init__(self, decoder: Decoder = Decoder.DIRECT, block_size: int = BLOCK_SIZE):
+        """
+
+        :param decoder: how FLAC files are decoded to WAV. Decoder.DIRECT keeps memory use bounded by block_size,
+        regardless of the length of the track; files it can't handle are decoded with Decoder.PYDUB instead.
+        :param block_size: size in bytes of the blocks of PCM data read from the decoder when using Decoder.DIRECT.
+        """
+        if block_size < 1:
+            raise ValueError(f"Argument 'block_size' should be at least 1, got '{block_size}' instead.")
+        self.decoder = decoder
+        self.block_size = block_size
         self.failed = []
+        # Models of the source and output trees, so that each directory is only listed once per run
+        self.tree = TreeModel(b_stat=False)
+        self.out_tree = TreeModel(b_stat=False)
 
-    def parse_dir_convert(self, path, ref_path, to_copy=None, b_initial=True):
+    def parse_dir_convert(self, path, ref_path=None, to_copy=None, path_out=PATH_OUT, workers=None):
         """
+        Parse a directory to convert the FLAC files to WAV.
+
+        The directory tree is walked first, to collect all files that need to be converted or copied. These jobs
+        are then processed by a pool of worker processes.
 
         :param path: the path to parse
-        :param ref_path: this is the path you will first call the method with. After the initial call, the method
-        will recursively traverse subpaths, and use this 'original' path to extract the names of the directories
-        specific to the music being parsed. If this doesn't make any sense, read the code.
+        :param ref_path: the root of the library being converted; the part of each path below ref_path is mirrored
+        within path_out. Defaults to 'path'.
         :param to_copy: an optional set of file extensions that should be copied from PATH_IN to PATH_OUT.
-        :param b_initial: boolean indicating that this call did not originate from within the method itself. Should
-        not be specified by the user.
+        :param path_out: the output path in which the folder structure found within ref_path will be mirrored.
+        :param workers: number of worker processes used to convert files in parallel; defaults to the number of CPUs.
+        Use 1 to convert the files one at a time, in the current process.
         :return:
         """
         if to_copy is None:
             to_copy = set()
         elif not isinstance(to_copy, set):
             raise ValueError(f"Argument 'to_copy' should be of type 'set', got '{to_copy.__class__.__name__}' instead.")
+        if ref_path is None:
+            ref_path = path
 
         # Reset container for failed files
-        if b_initial:
-            self.failed = []
+        self.failed = []
+        self.tree = TreeModel.scan(path, b_stat=False)
+        self.out_tree = TreeModel(b_stat=False)
+
+        jobs = []
+        self._collect_jobs(path, ref_path, path_out, to_copy=to_copy, jobs=jobs)
+        results = run_jobs(self, jobs, workers=workers)
+        self.failed = [job.path_in for job, b_ok in zip(jobs, results) if not b_ok]
+
+        print()
+        if not self.failed:
+            print("All files converted successfully.")
+        else:
+            for e in self.failed:
+                print(f"Failed to process: [{e}]")
+
+    def verify(self, path_in, path_out=PATH_OUT, workers=None, device_streams=2, device_limits=None, b_decode=False,
+               since_ns=None, time_limit=None, b_full=False):
+        """
+        Verify that the WAV files below path_out hold the audio of the FLAC files they were decoded from; see
+        WAVToFlac.verify for the parameters. Without b_decode, the complete WAV files are read, but only the
+        header of the FLAC files.
+
+        :return: list of verify.VerifyResult
+        """
+        for path in (path_in, path_out):
+            if not os.path.isdir(path):
+                raise ValueError(f"Directory '{path}' does not exist.")
+        jobs = collect_jobs(path_in, path_out, lambda name: name.replace('.flac', '.wav') if name.endswith('.flac')
+                            else None, b_wav_in=False)
+        verifier = Verifier(workers=workers, device_streams=device_streams, device_limits=device_limits,
+                            b_decode=b_decode)
+        results, left = verifier.run(jobs, path_out, since_ns=since_ns, time_limit=time_limit, b_full=b_full)
+        report(results, left)
+        self.failed = [result.job.path_flac for result in results if result.status != Status.OK]
+        return results
+
+    def _collect_jobs(self, path, ref_path, path_out, to_copy, jobs: list):
+        """
+        Recursively parse a directory, and add a ConvertJob to 'jobs' for each file that needs to be converted or
+        copied. Output directories are created along the way.
+
+        :param path: the path to parse
+        :param ref_path: the root of the library being converted.
+        :param path_out: the output path in which the folder structure found within ref_path will be mirrored.
+        :param to_copy: set of file extensions that should be copied from PATH_IN to PATH_OUT.
+        :param jobs: list to which the jobs are appended.
+        :return:
+        """
+        dir_info = self.tree.get(path)
+        for elem in dir_info.subdirs:
+            self._collect_jobs(os.path.join(path, elem), ref_path, path_out, to_copy, jobs=jobs)
 
-        for elem in os.listdir(path):
+        for elem in dir_info.files:
             full_path_in = os.path.join(path, elem)
-            # Get file extension, if applicable (i.e., we're not dealing with a directory)
+            # Get file extension
             ext = elem.rsplit('.', 1)
             if len(ext) == 2:
                 ext = ext[1]
             else:
                 ext = ''
 
-            if os.path.isdir(full_path_in):
-                self.parse_dir_convert(full_path_in, ref_path, to_copy, b_initial=False)
-            elif ext == "flac":
-                full_dir_out = os.path.dirname(full_path_in).replace(PATH_IN, PATH_OUT)
-                if not os.path.exists(full_dir_out):
+            if ext == "flac" or ext in to_copy:
+                full_dir_out = os.path.dirname(full_path_in).replace(ref_path, path_out)
+                if not self.out_tree.isdir(full_dir_out):
                     os.makedirs(full_dir_out)
-                full_path_out = os.path.join(full_dir_out, elem).replace('.flac', '.wav')
-                if os.path.isfile(full_path_out):
+                    self.out_tree.add_dir(full_dir_out)
+                if ext == "flac":
+                    full_path_out = os.path.join(full_dir_out, elem).replace('.flac', '.wav')
+                    b_convert = True
+                else:
+                    full_path_out = os.path.join(full_dir_out, elem)
+                    b_convert = False
+                if self.out_tree.isfile(full_path_out):
                     continue
+                jobs.append(ConvertJob(full_path_in, full_path_out, b_convert))
+
+    def _process_job(self, job):
+        """
+        Convert or copy a single file.
+
+        :param job: the ConvertJob to process.
+        :return: True if the file was processed successfully, False otherwise.
+        """
+        elem = os.path.basename(job.path_in)
+        full_path_in, full_path_out = job.path_in, job.path_out
 
-                print(f"Converting '{elem}' to\n\t[{full_path_out}]")
+        # Is this a file that should be copied?
+        if not job.b_convert:
+            print(f"Copying [{full_path_in}] to\n\t[{full_path_out}]")
+            copy_file(full_path_in, full_path_out)
+            return True
 
-                # Convert to WAV
-                # ### PyDub
+        print(f"Converting '{elem}' to\n\t[{full_path_out}]")
+
+        # Convert to WAV, in a temporary file that only replaces full_path_out once complete
+        temp_file = full_path_out + TEMP_SUFFIX
+        try:
+            if self.decoder == Decoder.DIRECT:
                 try:
-                    song = AudioSegment.from_file(full_path_in, format='flac')
-                    song.export(full_path_out, format='wav')
-                except Exception as e:
-                    print(e.__class__.__name__)
-                    print(e)
-                    self.failed.append(full_path_in)
-
-            # Is this a file that should be copied?
-            elif ext in to_copy:
-                full_dir_out = os.path.dirname(full_path_in).replace(PATH_IN, PATH_OUT)
-                if not os.path.exists(full_dir_out):
-                    os.makedirs(full_dir_out)
-                full_path_out = os.path.join(full_dir_out, elem)
-                if os.path.isfile(full_path_out):
-                    continue
-                print(f"Copying [{full_path_in}] to\n\t[{full_path_out}]")
-                shutil.copyfile(full_path_in, full_path_out)
+                    self._decode_direct(full_path_in, temp_file)
+                except ValueError as e:
+                    print(f"Can't decode '{elem}' directly ({e}), falling back to pydub.")
+                    self._decode_pydub(full_path_in, temp_file)
+            else:
+                self._decode_pydub(full_path_in, temp_file)
+            os.replace(temp_file, full_path_out)
+        except Exception as e:
+            print(e.__class__.__name__)
+            print(e)
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+            return False
+
+        return True
 
-        if b_initial:
-            print()
-            if not self.failed:
-                print("All files converted successfully.")
+    @classmethod
+    def _decode_pydub(cls, full_path_in, path_out):
+        # ### PyDub
+        from pydub import AudioSegment
+        song = AudioSegment.from_file(full_path_in, format='flac')
+        song.export(path_out, format='wav')
+
+    def _decode_direct(self, full_path_in, path_out):
+        """
+        Decode a FLAC file to WAV with ffmpeg, reading the PCM data it writes to its stdout straight into the
+        memory-mapped output file.
+
+        The size of the audio data is known from the STREAMINFO block of the FLAC file, so that the complete WAV
+        file can be allocated, and its header written, before decoding starts. ffmpeg outputs the interleaved,
+        little-endian samples that make up the 'data' chunk of a WAV file, so each block is read from the pipe
+        into its final place in the mapping, without any intermediate copy; peak memory use is bounded by the
+        block size, however long the track is.
+
+        :param full_path_in: the FLAC file to decode
+        :param path_out: the WAV file to write
+        :return:
+        """
+        from mutagen.flac import FLAC
+        info = FLAC(full_path_in).info
+        if info.bits_per_sample not in PCM_RAW_FORMATS:
+            raise ValueError(f"unsupported FLAC format, {info.bits_per_sample} bit")
+        if not info.total_samples:
+            raise ValueError("unknown number of samples")
+        raw_format, codec = PCM_RAW_FORMATS[info.bits_per_sample]
+
+        data_size = info.total_samples * info.channels * info.bits_per_sample // 8
+        header = wav_header(info.channels, info.sample_rate, info.bits_per_sample, data_size)
+        data_start = len(header)
+        data_end = data_start + data_size
+
+        args = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-i', full_path_in,
+                '-map', '0:a:0', '-c:a', codec, '-f', raw_format, 'pipe:1']
+        with open(path_out, 'wb+') as f:
+            f.write(header)
+            # Allocate the complete file up front, including the pad byte of an odd-sized 'data' chunk
+            file_size = data_end + data_size % 2
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, file_size)
             else:
-                for e in self.failed:
-                    print(f"Failed to process: [{e}]")
+                f.truncate(file_size)
+
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            offset = data_start
+            try:
+                with mmap.mmap(f.fileno(), file_size) as mm, memoryview(mm) as view:
+                    while offset < data_end:
+                        with view[offset:min(offset + self.block_size, data_end)] as block:
+                            nb_read = proc.stdout.readinto(block)
+                        if not nb_read:
+                            break
+                        offset += nb_read
+                    b_extra = bool(proc.stdout.read(1))
+                    mm.flush()
+            finally:
+                proc.stdout.close()
+                stderr = proc.stderr.read()
+                ret = proc.wait()
+
+        if ret != 0:
+            raise RuntimeError(f"ffmpeg exited with code {ret}: {stderr.decode(errors='replace').strip()}")
+        if offset < data_end or b_extra:
+            raise RuntimeError(f"ffmpeg decoded {'more than ' if b_extra else ''}{offset - data_start} bytes of audio, "
+                               f"while the FLAC file announces {data_size} bytes")
 
 
 if __name__ == '__main__':
     f2w = FlacToWAV()
-    f2w.parse_dir_convert(PATH_IN, PATH_IN, to_copy={'mp3', 'wav', 'jpg', 'jpeg', 'png'})
+    f2w.parse_dir_convert(PATH_IN, PATH_IN, path_out=PATH_OUT, to_copy={'mp3', 'wav', 'jpg', 'jpeg', 'png'})
     # w2f.parse_dir_update_tags(PATH_OUT, ref_path=PATH_OUT)
@@ -0,0 +1,105 @@
+"""
+Append-only journal of the jobs of a conversion run, stored in the output root, so that an interrupted run can be
+resumed where it stopped.
+
+The journal holds one JSON record per line: a header describing the run, one record per planned job, and one record
+per finished job. It is removed once the run completes; if it is still there at the start of a run, the previous run
+was interrupted. A line that was only partially written when the run was interrupted is ignored.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import json
+import os
+import threading
+import time
+
+JOURNAL_NAME = '.wavtoflac_journal.jsonl'
+# Minimal number of seconds between two flushes of the journal to the device
+FSYNC_INTERVAL = 1.
+
+
+class Journal:
+    def __init__(self, path_out):
+        """
+
+        :param path_out: the output root, in which the journal is stored.
+        """
+        self.path = os.path.join(path_out, JOURNAL_NAME)
+        self._f = None
+        self._lock = threading.Lock()
+        self._last_sync = 0.
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self):
+        """
+        Read the journal of a previous, interrupted, run.
+
+        :return: header, list of job records, dictionary mapping the source path of each finished job to its record;
+        or None if there is no (readable) journal.
+        """
+        if not self.exists():
+            return None
+        header, jobs, done = None, [], {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Line that was being written when the run was interrupted
+                    continue
+                event = record.pop('event', None)
+                if event == 'run':
+                    header = record
+                elif event == 'job':
+                    jobs.append(record)
+                elif event == 'done':
+                    done[record['path_in']] = record
+        if header is None:
+            return None
+        return header, jobs, done
+
+    def start(self, header: dict, jobs: list):
+        """
+        Start the journal of a new run, replacing any previous one.
+
+        :param header: description of the run, e.g., its source and output roots.
+        :param jobs: the records of the planned jobs, each a dictionary with at least a 'path_in' key.
+        """
+        temp_file = self.path + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(dict(header, event='run')) + '\n')
+            for job in jobs:
+                f.write(json.dumps(dict(job, event='job')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.path)
+        self._f = open(self.path, 'a', encoding='utf-8')
+
+    def done(self, path_in, b_ok, entry=None):
+        """
+        Record a finished job; may be called from any thread.
+
+        :param path_in: source path of the job.
+        :param b_ok: whether the job succeeded.
+        :param entry: the manifest entry (manifest.ManifestEntry) resulting from the job, if any.
+        """
+        record = {'event': 'done', 'path_in': path_in, 'ok': b_ok, 'entry': None if entry is None else list(entry)}
+        with self._lock:
+            self._f.write(json.dumps(record) + '\n')
+            self._f.flush()
+            now = time.monotonic()
+            if now - self._last_sync >= FSYNC_INTERVAL:
+                os.fsync(self._f.fileno())
+                self._last_sync = now
+
+    def close(self):
+        """
+        Close the journal of a completed run, and remove it.
+        """
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if self.exists():
+            os.remove(self.path)
@@ -0,0 +1,150 @@
+"""
+Persistent index of the files converted by WAVToFlac, stored as an SQLite database in the output root.
+
+For each source file, the manifest remembers what the source looked like when it was last converted, and what was
+written to the output, so that a sync can decide what to re-encode, re-tag or skip without opening a single output
+file.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+from typing import NamedTuple, Optional
+
+MANIFEST_NAME = '.wavtoflac_manifest.sqlite'
+
+
+class ManifestEntry(NamedTuple):
+    """
+    State of a converted source file. Paths are relative to the source and output roots, respectively.
+    """
+    size: int
+    mtime_ns: int
+    content_hash: Optional[str]
+    path_out: str
+    tag_hash: str
+    cover_hash: str
+
+
+class Manifest:
+    def __init__(self, path_out):
+        """
+
+        :param path_out: the output root; the manifest is stored in this directory.
+        """
+        self.path = os.path.join(path_out, MANIFEST_NAME)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                          "source TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, content_hash TEXT, "
+                          "path_out TEXT, tag_hash TEXT, cover_hash TEXT)")
+        self.conn.commit()
+
+    def load(self) -> dict:
+        """
+        Load the complete manifest in one query.
+
+        :return: dictionary mapping each source path to its ManifestEntry.
+        """
+        return {row[0]: ManifestEntry(*row[1:])
+                for row in self.conn.execute("SELECT source, size, mtime_ns, content_hash, path_out, tag_hash, "
+                                             "cover_hash FROM files")}
+
+    def load_dir(self, directory) -> dict:
+        """
+        Load the entries of the files directly in one source directory, for trees too large to load the whole
+        manifest at once.
+
+        :param directory: the directory, relative to the source root; '' for the root itself.
+        :return: dictionary mapping each source path to its ManifestEntry.
+        """
+        query = "SELECT source, size, mtime_ns, content_hash, path_out, tag_hash, cover_hash FROM files"
+        if directory:
+            prefix = os.path.join(directory, '')
+            # The sources below the directory are a range of the primary key, which is looked up in its index
+            rows = self.conn.execute(query + " WHERE source >= ? AND source < ?",
+                                     (prefix, prefix[:-1] + chr(ord(os.sep) + 1)))
+        else:
+            prefix = ''
+            rows = self.conn.execute(query + " WHERE instr(source, ?) = 0", (os.sep,))
+        return {row[0]: ManifestEntry(*row[1:]) for row in rows if os.sep not in row[0][len(prefix):]}
+
+    def sources(self):
+        """
+        Iterate over the source paths of all entries, in alphabetical order, without loading them all at once.
+        """
+        for (source,) in self.conn.execute("SELECT source FROM files ORDER BY source"):
+            yield source
+
+    def update(self, entries: dict):
+        """
+        Insert or replace entries in a single transaction.
+
+        :param entries: dictionary mapping source paths to ManifestEntry objects.
+        :return:
+        """
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [(source, *entry) for source, entry in entries.items()])
+
+    def delete(self, sources):
+        """
+        Remove entries in a single transaction.
+
+        :param sources: iterable of source paths.
+        :return:
+        """
+        with self.conn:
+            self.conn.executemany("DELETE FROM files WHERE source = ?", [(source,) for source in sources])
+
+    def close(self):
+        self.conn.close()
+
+
+def hash_file(path: str, offset: int = 0, size: Optional[int] = None, block_size: int = 1 << 20) -> str:
+    """
+    Hash (part of) a file, reading it through a memory mapping, one block at a time.
+
+    :param path: the file to hash
+    :param offset: start of the region to hash
+    :param size: size of the region to hash; defaults to the rest of the file
+    :param block_size: number of bytes hashed at a time
+    :return: hex digest
+    """
+    h = hashlib.blake2b(digest_size=16)
+    file_size = os.path.getsize(path)
+    end = file_size if size is None else min(file_size, offset + size)
+    if end <= offset:
+        return h.hexdigest()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as view:
+            for start in range(offset, end, block_size):
+                h.update(view[start:min(start + block_size, end)])
+    return h.hexdigest()
+
+
+def hash_tags(tags: dict) -> str:
+    return hashlib.blake2b(json.dumps(tags, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def hash_cover(path: Optional[str], file_info=None, root=None) -> str:
+    """
+    Cheap fingerprint of a cover image, based on its path, size and modification time.
+
+    :param path: path to the image, or None if there is no cover.
+    :param file_info: the size and modification time of the image (tree.FileInfo), if already known.
+    :param root: root of the library; the path is fingerprinted relative to it, so that moving or remounting the
+    library doesn't change the fingerprint.
+    :return: hex digest, or '' if there is no cover.
+    """
+    if path is None:
+        return ''
+    if file_info is None:
+        st = os.stat(path)
+        size, mtime_ns = st.st_size, st.st_mtime_ns
+    else:
+        size, mtime_ns = file_info
+    name = path if root is None else os.path.relpath(path, root)
+    return hashlib.blake2b(f"{name}|{size}|{mtime_ns}".encode('utf-8'), digest_size=16).hexdigest()
@@ -0,0 +1,330 @@
+"""
+Instrumentation of conversion runs: per-file stage timings and byte counts, running throughput and ETA, and
+pluggable sinks to report them (JSONL trace, end-of-run summary table, progress lines), as well as a profiler hook
+for a sampled subset of the files.
+
+Timings are recorded where the work is done, i.e., in the worker processes, and sent back to the parent process
+along with the result of each job:
+
+    metrics = FileMetrics(path)
+    with metrics.activate():
+        with stage('encode'):
+            ...
+
+stage() is a no-op when no FileMetrics is active in the current thread, so instrumented code can be called
+outside of a run as well.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import cProfile
+import json
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+# Per-thread stack of active FileMetrics
+_local = threading.local()
+
+
+def _active_stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage of the work on the FileMetrics active in the current thread, if any.
+
+    :param name: name of the stage, e.g., 'extract_tags' or 'encode'.
+    """
+    stack = _active_stack()
+    if not stack:
+        yield
+        return
+    with stack[-1].stage(name):
+        yield
+
+
+class FileMetrics:
+    def __init__(self, path, kind=None):
+        """
+
+        :param path: the file being processed.
+        :param kind: what is done to the file, e.g., 'convert', 'retag' or 'copy'.
+        """
+        self.path = path
+        self.kind = kind
+        # Stage name -> seconds spent in that stage, excluding the time spent in nested stages
+        self.stages = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.
+        # Path of the profile written for this file, if it was sampled by a Profiler
+        self.profile = None
+        # Open stages, as [name, start time, time spent in nested stages]
+        self._open = []
+
+    @contextmanager
+    def stage(self, name):
+        entry = [name, time.perf_counter(), 0.]
+        self._open.append(entry)
+        try:
+            yield
+        finally:
+            self._open.pop()
+            elapsed = time.perf_counter() - entry[1]
+            self.stages[name] = self.stages.get(name, 0.) + elapsed - entry[2]
+            if self._open:
+                self._open[-1][2] += elapsed
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this the FileMetrics to which stage() records in the current thread, and time the whole block.
+        """
+        stack = _active_stack()
+        stack.append(self)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.seconds += time.perf_counter() - start
+            stack.pop()
+
+    def as_dict(self):
+        return {'path': self.path,
+                'kind': self.kind,
+                'seconds': round(self.seconds, 6),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'stages': {k: round(v, 6) for k, v in self.stages.items()},
+                'profile': self.profile}
+
+
+class Profiler:
+    BACKENDS = ('cprofile', 'pyinstrument')
+
+    def __init__(self, out_dir, sample_every=20, backend='cprofile'):
+        """
+
+        :param out_dir: directory to which the profiles are written, one per sampled file.
+        :param sample_every: profile about one in every 'sample_every' files. Files are sampled on a hash of their
+        path, so that the same files are sampled in every worker process, and in every run.
+        :param backend: 'cprofile' (.prof files, to be read with pstats or snakeviz) or 'pyinstrument' (.html files;
+        requires the pyinstrument package).
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Argument 'backend' should be one of {self.BACKENDS}, got '{backend}' instead.")
+        if sample_every < 1:
+            raise ValueError(f"Argument 'sample_every' should be at least 1, got '{sample_every}' instead.")
+        if backend == 'pyinstrument':
+            # Fail now rather than in the worker processes
+            import pyinstrument  # noqa: F401
+        self.out_dir = out_dir
+        self.sample_every = sample_every
+        self.backend = backend
+
+    def should_profile(self, path):
+        return zlib.crc32(path.encode('utf-8')) % self.sample_every == 0
+
+    def run(self, metrics, func, *args):
+        """
+        Call func(*args) under the profiler, and store the path of the profile in metrics.
+        """
+        os.makedirs(self.out_dir, exist_ok=True)
+        name = f"{zlib.crc32(metrics.path.encode('utf-8')):08x}_{os.path.basename(metrics.path)}"
+
+        if self.backend == 'cprofile':
+            profile_path = os.path.join(self.out_dir, name + '.prof')
+            prof = cProfile.Profile()
+            prof.enable()
+            try:
+                return func(*args)
+            finally:
+                prof.disable()
+                prof.dump_stats(profile_path)
+                metrics.profile = profile_path
+        else:
+            from pyinstrument import Profiler as PyinstrumentProfiler
+            profile_path = os.path.join(self.out_dir, name + '.html')
+            prof = PyinstrumentProfiler()
+            prof.start()
+            try:
+                return func(*args)
+            finally:
+                prof.stop()
+                with open(profile_path, 'w') as f:
+                    f.write(prof.output_html())
+                metrics.profile = profile_path
+
+
+class Sink:
+    """
+    Receives the events of a run; subclasses override what they need.
+    """
+    def on_event(self, event: dict):
+        pass
+
+    def close(self, summary: dict):
+        pass
+
+
+class JsonlSink(Sink):
+    def __init__(self, path):
+        """
+
+        :param path: file to which each event, and the summary of the run, is appended as a line of JSON.
+        """
+        self.path = path
+        self._f = None
+
+    def on_event(self, event):
+        if self._f is None:
+            self._f = open(self.path, 'a')
+        self._f.write(json.dumps(event) + '\n')
+
+    def close(self, summary):
+        self.on_event(summary)
+        self._f.close()
+        self._f = None
+
+
+class ProgressSink(Sink):
+    def __init__(self, interval=5.):
+        """
+
+        :param interval: minimal number of seconds between two progress lines.
+        """
+        self.interval = interval
+        self._last = 0.
+
+    def on_event(self, event):
+        if event['event'] != 'file':
+            return
+        now = time.perf_counter()
+        if now - self._last < self.interval and event['done'] < event['total']:
+            return
+        self._last = now
+        eta = '?' if event['eta_s'] is None else time.strftime('%H:%M:%S', time.gmtime(event['eta_s']))
+        print(f"Progress: {event['done']}/{event['total']} files, {event['done_bytes'] / 1e6:.1f}/"
+              f"{event['total_bytes'] / 1e6:.1f} MB, {event['mb_per_s']:.1f} MB/s, ETA {eta}")
+
+
+class SummarySink(Sink):
+    def __init__(self):
+        # Stage name -> [number of files, total seconds, max seconds]
+        self._stages = {}
+
+    def on_event(self, event):
+        for name, seconds in event['stages'].items():
+            count, total, longest = self._stages.get(name, (0, 0., 0.))
+            self._stages[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    def close(self, summary):
+        grand_total = sum(total for _, total, _ in self._stages.values()) or 1.
+        print()
+        print(f"{'Stage':<16}{'Files':>8}{'Total (s)':>12}{'Mean (ms)':>12}{'Max (ms)':>12}{'Share':>8}")
+        for name, (count, total, longest) in sorted(self._stages.items(), key=lambda x: -x[1][1]):
+            print(f"{name:<16}{count:>8}{total:>12.3f}{1000 * total / count:>12.1f}{1000 * longest:>12.1f}"
+                  f"{100 * total / grand_total:>7.1f}%")
+        print(f"{summary['done']} files ({summary['failed']} failed), {summary['bytes_in'] / 1e6:.1f} MB in, "
+              f"{summary['bytes_out'] / 1e6:.1f} MB out, in {summary['seconds']:.1f}s "
+              f"({summary['mb_per_s']:.1f} MB/s).")
+
+
+class Recorder:
+    def __init__(self, sinks=(), profiler=None):
+        """
+        Collect the metrics of a run, and pass them on to the sinks.
+
+        Usage: w2f.parse_dir_convert(PATH_IN, PATH_OUT, recorder=Recorder([ProgressSink(), SummarySink()]))
+
+        :param sinks: the Sink objects to report to.
+        :param profiler: optional Profiler, to profile a sample of the files.
+        """
+        self.sinks = list(sinks)
+        self.profiler = profiler
+        # Stages of the run itself, e.g., scanning the source tree, as opposed to those of the individual files
+        self.run = FileMetrics(None, kind='run')
+        self._lock = threading.Lock()
+        self._start = None
+        self.total = self.total_bytes = 0
+        self.done = self.done_bytes = self.failed = 0
+        self.bytes_out = 0
+
+    def activate(self):
+        """
+        Record the stages of the run itself, for the current thread.
+        """
+        return self.run.activate()
+
+    def start(self, total, total_bytes):
+        """
+        Start timing the processing of the jobs.
+
+        :param total: number of jobs.
+        :param total_bytes: total size of the files to process, used to estimate the remaining time.
+        """
+        self._start = time.perf_counter()
+        self.total, self.total_bytes = total, total_bytes
+        self.done = self.done_bytes = self.failed = self.bytes_out = 0
+
+    def add_total(self, total, total_bytes):
+        """
+        Add jobs to the totals given to start(), for runs in which jobs are found while others are processed; the
+        progress and remaining time are then relative to the jobs found so far.
+
+        :param total: number of jobs found.
+        :param total_bytes: total size of their files.
+        """
+        with self._lock:
+            self.total += total
+            self.total_bytes += total_bytes
+
+    def record(self, metrics, b_ok):
+        """
+        Record a processed file; may be called from any thread.
+
+        :param metrics: the FileMetrics of the file, or None if none were recorded.
+        :param b_ok: whether the file was processed successfully.
+        """
+        if metrics is None:
+            metrics = FileMetrics(None)
+        with self._lock:
+            self.done += 1
+            self.failed += not b_ok
+            self.done_bytes += metrics.bytes_in
+            self.bytes_out += metrics.bytes_out
+            elapsed = time.perf_counter() - self._start
+            rate = self.done_bytes / elapsed if elapsed > 0 else 0.
+            eta = (self.total_bytes - self.done_bytes) / rate if rate > 0 else None
+            event = metrics.as_dict()
+            event.update({'event': 'file', 'ok': b_ok, 'done': self.done, 'total': self.total,
+                          'done_bytes': self.done_bytes, 'total_bytes': self.total_bytes,
+                          'files_per_s': round(self.done / elapsed, 3) if elapsed > 0 else None,
+                          'mb_per_s': round(rate / 1e6, 3), 'eta_s': None if eta is None else round(eta, 1)})
+            for sink in self.sinks:
+                sink.on_event(event)
+
+    def finish(self):
+        """
+        Report the stages of the run itself and the summary of the run to the sinks, and close them.
+
+        :return: the summary, as a dictionary.
+        """
+        elapsed = time.perf_counter() - self._start if self._start is not None else 0.
+        run = self.run.as_dict()
+        run['event'] = 'run'
+        for sink in self.sinks:
+            sink.on_event(run)
+        summary = {'event': 'summary', 'done': self.done, 'failed': self.failed, 'total': self.total,
+                   'bytes_in': self.done_bytes, 'bytes_out': self.bytes_out, 'seconds': round(elapsed, 3),
+                   'mb_per_s': round(self.done_bytes / 1e6 / elapsed, 3) if elapsed > 0 else 0.}
+        for sink in self.sinks:
+            sink.close(summary)
+        return summary
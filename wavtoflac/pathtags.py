@@ -0,0 +1,191 @@
+"""
+Derive tags from the path of a track, following the directory layouts described in WAVToFlac._extract_tags:
+
+- "Artist - Album/" or "Artist - (year) - Album/"
+- "Artist - Album/Disc x/" or "Artist - (year) - Album/Disc x/", for albums spanning multiple discs
+- "Author/Book/Disc x/", for audiobooks
+
+The tags derived from a directory are computed once, and shared by all tracks in that directory; each track only
+parses its own filename.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+import re
+from typing import NamedTuple
+
+from termcolor import cprint
+
+# Subdirectories of a multi-disc album that are named after the disc, e.g., "Disc 2" or "CD 2"
+DISC_DIR_RE = re.compile(r'disc |cd |part ')
+# Filenames starting with a two-digit track number followed by a dash, e.g., "01-Title" or "01 - Title"
+NUMBERED_RE = re.compile(r'\d\d(?:-.|.-..)', re.DOTALL)
+
+
+def extract_discnr(disc_dir: str):
+    """
+    Get the disc number from the name of a disc directory, e.g., '2' for "Disc 2"; '' if there is none.
+    """
+    res = ''
+
+    offset = 4
+    disc_dir = disc_dir.lower()
+    start_idx = disc_dir.find('disc')
+    if start_idx == -1:
+        start_idx = disc_dir.find('cd')
+        offset = 2
+    if start_idx == -1:
+        return res
+
+    for c in disc_dir[start_idx + offset:]:
+        if c == ' ':
+            continue
+        elif c.isdigit():
+            res += c
+        else:
+            break
+
+    # if disc_dir.lower().startswith('disc'):
+    #     disc_nr = disc_dir[4:].strip()
+    #     if disc_nr.isdigit():
+    #         res = disc_nr
+    #
+    # elif disc_dir.lower().startswith('cd'):
+    #     disc_nr = disc_dir[2:].strip()
+    #     if disc_nr.isdigit():
+    #         res = disc_nr
+
+    return res
+
+
+def split_album_dir(album_dir):
+    """
+    Split an "Artist - Album" or "Artist - (year) - Album" directory name.
+
+    :return: artist, album, date; album and date are None if they are not part of the name.
+    """
+    dir_parts = [x.strip() for x in album_dir.split(' - ', 2)]
+    if len(dir_parts) == 2:
+        return dir_parts[0], dir_parts[1], None
+    elif len(dir_parts) == 3:
+        return dir_parts[0], dir_parts[2], dir_parts[1][1:-1]
+    return dir_parts[0], None, None
+
+
+class DirTags(NamedTuple):
+    tags: dict
+    # False if the directory doesn't follow any of the known layouts
+    b_known: bool
+
+
+class PathTagParser:
+    def __init__(self, ref_path, tree):
+        """
+
+        :param ref_path: the root of the library; the directories below it determine the tags.
+        :param tree: tree.TreeModel of the library, used to count the discs of an album.
+        """
+        self.ref_path = ref_path
+        self.tree = tree
+        # Directory -> DirTags
+        self._dirs = {}
+
+    def parse(self, path) -> dict:
+        """
+        Get the tags derived from the path of a track.
+
+        :param path: path to the track.
+        :return: dictionary of tags
+        """
+        dir_path = os.path.dirname(path)
+        dir_tags = self._dirs.get(dir_path)
+        if dir_tags is None:
+            if self.tree.max_dirs is not None and len(self._dirs) >= self.tree.max_dirs:
+                # Bounded like the tree model; tracks come directory by directory, so older entries aren't needed
+                self._dirs.clear()
+            dir_tags = self._dirs[dir_path] = self._parse_dir(dir_path)
+        if not dir_tags.b_known:
+            album_dir = dir_path.replace(self.ref_path, '')[1:]
+            cprint(f"Don't know what to do here!\n{path}\n{album_dir}", color='cyan')
+
+        tags = dict(dir_tags.tags)
+        tags.update(self.parse_filename(path[path.rfind('/')+1:]))
+        return tags
+
+    def parse_many(self, paths) -> list:
+        """
+        Get the tags derived from the paths of many tracks at once, e.g., to precompute the tags of a whole tree.
+
+        :param paths: iterable of paths to tracks.
+        :return: list of tag dictionaries, in the same order as the paths.
+        """
+        return [self.parse(path) for path in paths]
+
+    @classmethod
+    def parse_filename(cls, elem) -> dict:
+        """
+        Get the track number and title from a filename, e.g., "01 - Title.wav".
+        """
+        # Strip extension
+        elem = elem[:elem.rfind('.')]
+        if NUMBERED_RE.match(elem):
+            song_parts = [x.strip() for x in elem.split('-', maxsplit=1)]
+        else:
+            song_parts = [x.strip() for x in elem.split(' ', maxsplit=1)]
+
+        if len(song_parts) == 2:
+            return {'tracknumber': song_parts[0], 'title': song_parts[1]}
+        elif len(song_parts) == 1:
+            return {'title': song_parts[0]}
+        else:
+            raise ValueError(f"Don't know what to do with:\n\t[{song_parts}]")
+
+    def _parse_dir(self, dir_path) -> DirTags:
+        tags = {}
+        album_dir = dir_path.replace(self.ref_path, '')[1:]  # Only the 'artist - album/disc' part
+        dir_names = album_dir.split('/')
+
+        if len(dir_names) == 1:
+            tags['totaldiscs'] = '1'
+            artist, album, date = split_album_dir(album_dir)
+            tags['artist'] = artist
+            if album is not None:
+                tags['album'] = album
+            if date is not None:
+                tags['date'] = date
+        elif len(dir_names) == 2:
+            root_dir, disc_dir = dir_names
+            # Get number of discs/collections
+            tags['totaldiscs'] = str(self._nb_discs(dir_path))
+            artist, album, date = split_album_dir(root_dir)
+            tags['artist'] = artist
+            # Situation of one album composed of multiple discs, with folders ending with "Disc X" or "CD X"
+            b_disc_dir = DISC_DIR_RE.search(disc_dir.lower()) is not None
+            if album is not None:
+                # If the subfolders don't end with "Disc"/"CD", they are part of the album name
+                tags['album'] = album if b_disc_dir else f'{album} - {disc_dir}'
+            if date is not None:
+                tags['date'] = date
+            if b_disc_dir:
+                disc_nr = extract_discnr(disc_dir)
+                if disc_nr:
+                    tags['discnumber'] = disc_nr
+        elif len(dir_names) == 3:
+            # Audiobooks
+            author_dir, book_dir, disc_dir = dir_names
+            tags['totaldiscs'] = str(self._nb_discs(dir_path))
+            tags['author'] = author_dir
+            tags['artist'] = author_dir
+            tags['album'] = book_dir
+            disc_nr = extract_discnr(disc_dir)
+            if disc_nr:
+                tags['discnumber'] = disc_nr
+        else:
+            return DirTags(tags, False)
+
+        return DirTags(tags, True)
+
+    def _nb_discs(self, dir_path) -> int:
+        # Full path to the 'artist - album' part, without the 'disc' folder
+        root_album_dir = dir_path.rsplit('/', 1)[0]
+        return len(self.tree.get(root_album_dir).subdirs)
@@ -0,0 +1,156 @@
+"""
+Run per-file conversion jobs, either serially or spread over a pool of worker processes.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+# Default number of jobs per worker process that stream_jobs keeps queued or running, so that workers never wait
+# for the next job while the producer is busy
+PENDING_PER_WORKER = 4
+
+# Converter object used by the worker processes of the pool; set once per process by _init_worker,
+# so that the converter does not need to be pickled again for every single job.
+_worker_converter = None
+
+
+def _init_worker(converter):
+    global _worker_converter
+    _worker_converter = converter
+
+
+def _process_job_in_worker(job):
+    return _worker_converter._process_job(job)
+
+
+def run_jobs(converter, jobs: list, workers=None, on_start=None, on_result=None, throttle=None):
+    """
+    Process a list of jobs with the '_process_job' method of the converter.
+
+    :param converter: the converter object (WAVToFlac or FlacToWAV instance) that knows how to process a job.
+    :param jobs: the list of jobs to process.
+    :param workers: number of worker processes to use; defaults to the number of CPUs. If 1, the jobs are
+    processed in the current process, without creating a pool.
+    :param on_start: optional function called once the worker processes have been started, e.g., to start threads
+    that should run alongside them (starting threads before forking the worker processes is not safe).
+    :param on_result: optional function called as on_result(job, result) as soon as the result of a job is known,
+    e.g., to report progress.
+    :param throttle: optional object whose 'limit' attribute is the number of jobs that may be in flight at a time,
+    e.g., a scheduler.WriteThrottle; it is read again every time a job finishes. Without throttle, all jobs are
+    queued at once. Jobs are started in the order of the list either way.
+    :return: the results of '_process_job', in the same order as the jobs.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError(f"Argument 'workers' should be at least 1, got '{workers}' instead.")
+
+    if workers == 1 or len(jobs) <= 1:
+        if on_start is not None:
+            on_start()
+        return _collect(jobs, map(converter._process_job, jobs), on_result)
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)),
+                             initializer=_init_worker, initargs=(converter,)) as executor:
+        if throttle is not None:
+            return _run_throttled(executor, jobs, min(workers, len(jobs)), throttle, on_start, on_result)
+        # Executor.map returns the results in the order of the jobs, regardless of which one finished first.
+        # All jobs are submitted, and thus all worker processes started, before it returns.
+        results = executor.map(_process_job_in_worker, jobs)
+        if on_start is not None:
+            on_start()
+        return _collect(jobs, results, on_result)
+
+
+def _collect(jobs, results, on_result):
+    if on_result is None:
+        return list(results)
+    collected = []
+    for job, result in zip(jobs, results):
+        on_result(job, result)
+        collected.append(result)
+    return collected
+
+
+def _run_throttled(executor, jobs, workers, throttle, on_start, on_result):
+    """
+    Submit the jobs to the executor as the throttle allows; on_result is called in the order in which jobs finish.
+    """
+    results = [None] * len(jobs)
+    pending = {}
+    # Submit a job per worker first, so that all worker processes are started before on_start is called
+    for idx in range(workers):
+        pending[executor.submit(_process_job_in_worker, jobs[idx])] = idx
+    next_idx = workers
+    if on_start is not None:
+        on_start()
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            idx = pending.pop(future)
+            results[idx] = future.result()
+            if on_result is not None:
+                on_result(jobs[idx], results[idx])
+        while next_idx < len(jobs) and len(pending) < max(1, throttle.limit):
+            pending[executor.submit(_process_job_in_worker, jobs[next_idx])] = next_idx
+            next_idx += 1
+    return results
+
+
+def stream_jobs(converter, jobs, workers=None, max_pending=None, on_start=None, on_result=None):
+    """
+    Process jobs with the '_process_job' method of the converter as they are produced, e.g., by a generator that
+    walks a directory tree, instead of collecting them in a list first. At most max_pending jobs are queued or
+    running at a time; the next ones are only taken from 'jobs' as earlier ones finish, so that the producer is
+    never more than max_pending jobs ahead. Results are not kept: on_result is the only way to get them.
+
+    :param converter: the converter object (WAVToFlac or FlacToWAV instance) that knows how to process a job.
+    :param jobs: iterable of jobs.
+    :param workers: number of worker processes to use; defaults to the number of CPUs. If 1, the jobs are
+    processed in the current process, without creating a pool.
+    :param max_pending: maximum number of jobs queued or running at a time; defaults to PENDING_PER_WORKER jobs
+    per worker.
+    :param on_start: see run_jobs.
+    :param on_result: optional function called as on_result(job, result) as soon as the result of a job is known, in
+    the order in which jobs finish.
+    :return: the number of jobs processed
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError(f"Argument 'workers' should be at least 1, got '{workers}' instead.")
+    if max_pending is None:
+        max_pending = PENDING_PER_WORKER * workers
+    if max_pending < 1:
+        raise ValueError(f"Argument 'max_pending' should be at least 1, got '{max_pending}' instead.")
+    jobs = iter(jobs)
+    nb_jobs = 0
+
+    if workers == 1:
+        if on_start is not None:
+            on_start()
+        for job in jobs:
+            result = converter._process_job(job)
+            nb_jobs += 1
+            if on_result is not None:
+                on_result(job, result)
+        return nb_jobs
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(converter,)) as executor:
+        # Submit a job per worker first, so that all worker processes are started before on_start is called
+        pending = {executor.submit(_process_job_in_worker, job): job for job in islice(jobs, min(workers, max_pending))}
+        if on_start is not None:
+            on_start()
+        while pending:
+            for job in islice(jobs, max_pending - len(pending)):
+                pending[executor.submit(_process_job_in_worker, job)] = job
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                nb_jobs += 1
+                if on_result is not None:
+                    on_result(job, future.result())
+    return nb_jobs
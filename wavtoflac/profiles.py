@@ -0,0 +1,142 @@
+"""
+FLAC encoder profiles, i.e., the settings ffmpeg's FLAC encoder uses, and a comparison of their speed and output
+size on a sample of a library, to choose a profile per target device: e.g., 'fast' for a quick first pass onto a
+portable player, and 'max' for the archive drive.
+
+Usage: python -m wavtoflac.profiles PATH_IN --files 10 --profiles fast balanced max
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import NamedTuple, Optional
+
+from wavtoflac.tree import TreeModel
+
+
+class EncoderProfile(NamedTuple):
+    """
+    Settings of ffmpeg's FLAC encoder. Options left to None keep the default of the compression level.
+
+    ffmpeg's FLAC encoder is single-threaded; files are encoded in parallel instead, see WAVToFlac.parse_dir_convert.
+    """
+    name: str
+    # 0 (fastest) to 12 (smallest); 5 is ffmpeg's default
+    compression_level: int = 5
+    # Number of samples per FLAC frame
+    frame_size: Optional[int] = None
+    # Maximum order of the linear predictor, 1 to 32
+    max_lpc_order: Optional[int] = None
+    # Any other option of ffmpeg's FLAC encoder, as (option, value) pairs, e.g., (('lpc_passes', 2),)
+    extra: tuple = ()
+
+    def ffmpeg_args(self) -> list:
+        """
+        The ffmpeg output options selecting this profile, to be put after '-c:a flac'.
+        """
+        args = ['-compression_level', str(self.compression_level)]
+        if self.frame_size is not None:
+            args += ['-frame_size', str(self.frame_size)]
+        if self.max_lpc_order is not None:
+            args += ['-max_prediction_order', str(self.max_lpc_order)]
+        for option, value in self.extra:
+            args += [f'-{option}', str(value)]
+        return args
+
+
+PROFILES = {'fast': EncoderProfile('fast', compression_level=0),
+            'balanced': EncoderProfile('balanced', compression_level=5),
+            'max': EncoderProfile('max', compression_level=8)}
+
+
+def get_profile(profile) -> EncoderProfile:
+    """
+    :param profile: name of one of the PROFILES, or an EncoderProfile.
+    :return: EncoderProfile
+    """
+    if isinstance(profile, EncoderProfile):
+        return profile
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown encoder profile '{profile}', should be one of {list(PROFILES)} "
+                         f"or an EncoderProfile.")
+    return PROFILES[profile]
+
+
+def compare_profiles(path_in, profiles=('fast', 'balanced', 'max'), nb_files=10, seed=0):
+    """
+    Encode a random sample of the WAV files of a library with each profile, and report the encoding time and the
+    size of the output per profile. Nothing is written outside of a temporary directory.
+
+    :param path_in: root of the library.
+    :param profiles: names of PROFILES, or EncoderProfile objects, to compare.
+    :param nb_files: number of WAV files to sample.
+    :param seed: seed of the sample, so that different runs can encode the same files.
+    :return: dictionary mapping the name of each profile to its results.
+    """
+    profiles = [get_profile(profile) for profile in profiles]
+    tree = TreeModel.scan(path_in)
+    wav_files = sorted(os.path.join(path, name) for path, dir_info in tree.dirs.items()
+                       for name in dir_info.files if name.lower().endswith('.wav'))
+    if not wav_files:
+        raise ValueError(f"No WAV files found in '{path_in}'.")
+    sample = sorted(random.Random(seed).sample(wav_files, min(nb_files, len(wav_files))))
+    sizes = {path: tree.dirs[os.path.dirname(path)].file_info(os.path.basename(path)).size for path in sample}
+
+    results = {profile.name: {'files': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.}
+               for profile in profiles}
+    temp_dir = tempfile.mkdtemp(prefix='wavtoflac_profiles_')
+    try:
+        for path in sample:
+            # Read the file once, so that the first profile doesn't pay for reading it from the device
+            with open(path, 'rb') as f:
+                while f.read(1 << 20):
+                    pass
+            for profile in profiles:
+                res = results[profile.name]
+                path_out = os.path.join(temp_dir, f'{profile.name}.flac')
+                args = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-y', '-i', path,
+                        '-map', '0:a', '-c:a', 'flac'] + profile.ffmpeg_args() + ['-f', 'flac', path_out]
+                start = time.perf_counter()
+                proc = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                seconds = time.perf_counter() - start
+                if proc.returncode != 0:
+                    print(f"Failed to encode [{path}] with profile '{profile.name}':")
+                    print(proc.stderr.decode(errors='replace').strip())
+                    res['failed'] += 1
+                    continue
+                res['files'] += 1
+                res['bytes_in'] += sizes[path]
+                res['seconds'] += seconds
+                res['bytes_out'] += os.path.getsize(path_out)
+                os.remove(path_out)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    print(f"Sample of {len(sample)} files, {sum(sizes.values()) / 1e6:.1f} MB of WAV")
+    print(f"{'Profile':<12}{'Time (s)':>10}{'MB/s':>10}{'Out (MB)':>10}{'Ratio':>8}")
+    for name, res in results.items():
+        mb_per_s = res['bytes_in'] / 1e6 / res['seconds'] if res['seconds'] > 0 else 0.
+        ratio = res['bytes_out'] / res['bytes_in'] if res['bytes_in'] > 0 else 0.
+        print(f"{name:<12}{res['seconds']:>10.2f}{mb_per_s:>10.1f}{res['bytes_out'] / 1e6:>10.1f}{ratio:>8.3f}")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the speed and output size of FLAC encoder profiles on a "
+                                                 "sample of a library.")
+    parser.add_argument('path_in', help="root of the library")
+    parser.add_argument('--files', type=int, default=10, help="number of WAV files to sample")
+    parser.add_argument('--profiles', nargs='+', default=['fast', 'balanced', 'max'], choices=list(PROFILES),
+                        help="profiles to compare")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the sample")
+    args = parser.parse_args(argv)
+    compare_profiles(args.path_in, profiles=args.profiles, nb_files=args.files, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
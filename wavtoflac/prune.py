@@ -0,0 +1,206 @@
+"""
+Find, and delete, what is on the target of a conversion but no longer in its source: directories, and files whose
+source file was deleted, taking into account that .wav and .mpga files are converted to .flac.
+
+Both trees are listed concurrently, with a thread pool per device; or, for trees too large to list completely,
+one directory at a time, while they are compared.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from wavtoflac.copier import TEMP_SUFFIX
+from wavtoflac.devices import device_id
+from wavtoflac.tree import DirInfo, TreeModel
+from wavtoflac.walk import iter_dirs
+
+# Files on the target that were not copied or converted from the source, but belong to the conversion itself, e.g.,
+# the manifest and journal
+IGNORED_PREFIX = '.wavtoflac'
+# Source formats that are converted to FLAC
+CONVERTED_EXTENSIONS = ('wav', 'mpga')
+
+
+class PruneItem(NamedTuple):
+    path: str
+    b_dir: bool
+    # Size of the file, or of all files within the directory, in bytes
+    size: int
+
+
+def expected_names(source_names):
+    """
+    Get the names of the target files that correspond to the files of a source directory.
+
+    :param source_names: names of the files in a source directory.
+    :return: set of names
+    """
+    names = set(source_names)
+    for name in source_names:
+        ext = name.rsplit('.', 1)
+        if len(ext) == 2 and ext[1].lower() in CONVERTED_EXTENSIONS:
+            # Same naming as WAVToFlac._collect_jobs
+            names.add(name[:-4] + '.flac')
+    return names
+
+
+class Pruner:
+    def __init__(self, workers=4):
+        """
+
+        :param workers: number of threads listing or deleting on a single device.
+        """
+        if workers < 1:
+            raise ValueError(f"Argument 'workers' should be at least 1, got '{workers}' instead.")
+        self.workers = workers
+        # Target tree of the last plan
+        self.out_tree = None
+        # Source tree of the last plan
+        self.tree = None
+
+    def plan(self, path_in, path_out):
+        """
+        List both trees, and find the directories and files of path_out that have no counterpart in path_in.
+
+        :param path_in: the source of the conversion.
+        :param path_out: the target of the conversion.
+        :return: list of PruneItem, in the order in which the trees are walked.
+        """
+        for path in (path_in, path_out):
+            if not os.path.isdir(path):
+                raise ValueError(f"Directory '{path}' does not exist.")
+
+        devices = {}
+        for path in (path_in, path_out):
+            dev = device_id(path)
+            if dev not in devices:
+                devices[dev] = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            with ThreadPoolExecutor(max_workers=2) as scans:
+                # Sizes are only needed on the target, to report the space that can be reclaimed
+                f_in = scans.submit(TreeModel.scan_parallel, path_in, devices[device_id(path_in)], False)
+                f_out = scans.submit(TreeModel.scan_parallel, path_out, devices[device_id(path_out)], True)
+                self.tree, self.out_tree = f_in.result(), f_out.result()
+        finally:
+            for executor in devices.values():
+                executor.shutdown()
+
+        items = []
+        stack = [(path_in, path_out)]
+        while stack:
+            dir_in, dir_out = stack.pop()
+            items.extend(self._compare(self.tree.dirs[dir_in], self.out_tree.dirs[dir_out], stack, self._dir_size))
+        return items
+
+    def iter_plan(self, path_in, path_out):
+        """
+        Find the same directories and files as plan(), listing both trees one directory at a time while they are
+        compared, instead of completely first. Memory use doesn't grow with the size of the trees, but directories
+        are listed one at a time.
+
+        :param path_in: the source of the conversion.
+        :param path_out: the target of the conversion.
+        :return: generator of PruneItem, in the order of plan().
+        """
+        for path in (path_in, path_out):
+            if not os.path.isdir(path):
+                raise ValueError(f"Directory '{path}' does not exist.")
+        self.tree = self.out_tree = None
+
+        stack = [(path_in, path_out)]
+        while stack:
+            dir_in, dir_out = stack.pop()
+            yield from self._compare(DirInfo.scan(dir_in, b_stat=False), DirInfo.scan(dir_out), stack,
+                                     self._walk_size)
+
+    @classmethod
+    def _compare(cls, dir_info_in, dir_info_out, stack, dir_size):
+        """
+        Compare a source directory with its counterpart on the target.
+
+        :param dir_info_in: tree.DirInfo of the source directory.
+        :param dir_info_out: tree.DirInfo of the target directory, with file sizes.
+        :param stack: list to which the pairs of subdirectories to compare next are appended.
+        :param dir_size: function returning the size of a target directory.
+        :return: generator of PruneItem
+        """
+        subdirs_in = set(dir_info_in.subdirs)
+        for name in sorted(dir_info_out.subdirs, reverse=True):
+            if name in subdirs_in:
+                stack.append((os.path.join(dir_info_in.path, name), os.path.join(dir_info_out.path, name)))
+            else:
+                path = os.path.join(dir_info_out.path, name)
+                yield PruneItem(path, True, dir_size(path))
+
+        expected = expected_names(dir_info_in.files)
+        for name in sorted(dir_info_out.files):
+            if name in expected or name.startswith(IGNORED_PREFIX) or name.endswith(TEMP_SUFFIX):
+                continue
+            yield PruneItem(os.path.join(dir_info_out.path, name), False, dir_info_out.files[name].size)
+
+    def _dir_size(self, path):
+        size, stack = 0, [path]
+        while stack:
+            dir_info = self.out_tree.dirs[stack.pop()]
+            size += sum(info.size for info in dir_info.files.values())
+            stack.extend(os.path.join(dir_info.path, d) for d in dir_info.subdirs)
+        return size
+
+    @classmethod
+    def _walk_size(cls, path):
+        return sum(info.size for _, dir_info in iter_dirs(path) for info in dir_info.files.values())
+
+    @classmethod
+    def report(cls, items):
+        """
+        Print the directories and files that can be deleted, and the space that would be reclaimed.
+        """
+        for item in items:
+            cls.report_item(item)
+        nb_dirs = sum(item.b_dir for item in items)
+        cls.report_total(nb_dirs, len(items) - nb_dirs, sum(item.size for item in items))
+
+    @classmethod
+    def report_item(cls, item):
+        if item.b_dir:
+            print(f"Unmatched target path: {item.path}")
+        else:
+            print(f"Unmatched target file: {item.path}")
+
+    @classmethod
+    def report_total(cls, nb_dirs, nb_files, size):
+        print(f"{nb_dirs} directories and {nb_files} files not in source, {size / 1e6:.1f} MB reclaimable.")
+
+    def delete(self, items):
+        """
+        Delete the directories and files of a plan, in parallel.
+
+        :param items: list of PruneItem, as returned by plan().
+        :return: the items that were deleted.
+        """
+        def _delete(item):
+            try:
+                if item.b_dir:
+                    shutil.rmtree(item.path)
+                else:
+                    os.remove(item.path)
+            except Exception as e:
+                print(e.__class__.__name__)
+                print(e)
+                return False
+            return True
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            deleted = [item for item, b_ok in zip(items, executor.map(_delete, items)) if b_ok]
+        if self.out_tree is not None:
+            for item in deleted:
+                if item.b_dir:
+                    self.out_tree.remove_dir(item.path)
+                else:
+                    del self.out_tree.dirs[os.path.dirname(item.path)].files[os.path.basename(item.path)]
+        print(f"Deleted {len(deleted)} directories and files from target device, "
+              f"{sum(item.size for item in deleted) / 1e6:.1f} MB reclaimed.")
+        return deleted
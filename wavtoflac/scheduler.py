@@ -0,0 +1,130 @@
+"""
+Scheduling of the encoding jobs of a conversion run, to minimize its total duration rather than to maximize its
+instantaneous parallelism.
+
+- Jobs are ordered longest first, on an estimate of their cost, so that a long track (e.g., a hi-res concert) is
+  not started last, leaving the end of the run to a single worker.
+- WriteThrottle limits the number of jobs in flight when the target device can't keep up, e.g., when the write
+  cache of an SD card is saturated, and raises it again once it does.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+from collections import deque
+from statistics import median
+
+from wavtoflac.wavinfo import read_wav_header
+
+# Fixed cost of a job, in samples: starting the encoder, reading tags and cover, renaming the output... about the
+# samples of one second of CD audio
+JOB_OVERHEAD = 2 * 44100
+# Average number of samples per byte of an MPEG audio file, e.g., 44.1 kHz stereo at 192 kbps
+MPGA_SAMPLES_PER_BYTE = 88200 / 24000
+# Cost of a job that only rewrites the tags of its output, or derives its output from another one
+LIGHT_JOB_COST = JOB_OVERHEAD
+# Rough encoding speed of a single worker, in samples per second: about 100x real time for CD audio
+ENCODE_SAMPLES_PER_SECOND = 100 * 88200
+# Rough speed at which files are copied to the target device, in bytes per second
+COPY_BYTES_PER_SECOND = 20e6
+
+
+def job_cost(job, size, b_header=True) -> int:
+    """
+    Estimate the cost of an encoding job, in number of samples to encode.
+
+    :param job: wavtoflac.ConvertJob
+    :param size: size of the source file in bytes, used if its header can't be read.
+    :param b_header: read the header of WAV files for their number of samples; if False, it is estimated from
+    their size, without opening them.
+    :return: the estimated cost
+    """
+    if job.b_retag_only or job.source_out is not None:
+        return LIGHT_JOB_COST
+    ext = os.path.splitext(job.path_in)[1].lower()
+    if ext == '.wav' and not b_header:
+        return JOB_OVERHEAD + size // 2
+    if ext == '.wav':
+        try:
+            info = read_wav_header(job.path_in)
+            return JOB_OVERHEAD + info.nb_frames * info.channels
+        except (OSError, ValueError):
+            # Assume 16 bit samples
+            return JOB_OVERHEAD + size // 2
+    return JOB_OVERHEAD + int(size * MPGA_SAMPLES_PER_BYTE)
+
+
+def estimate_seconds(job, cost) -> float:
+    """
+    Rough estimate of the duration of a job.
+
+    :param job: wavtoflac.ConvertJob
+    :param cost: the cost of the job, as returned by job_cost(), or the size in bytes of the file for copies.
+    """
+    if job.audio_format is None:
+        return cost / COPY_BYTES_PER_SECOND
+    return cost / ENCODE_SAMPLES_PER_SECOND
+
+
+def order_longest_first(jobs: list, costs: dict) -> list:
+    """
+    Sort jobs on decreasing cost; jobs of equal cost keep their order.
+
+    :param jobs: list of jobs
+    :param costs: dictionary mapping the source path of each job to its cost
+    :return: the sorted list
+    """
+    return sorted(jobs, key=lambda job: -costs[job.path_in])
+
+
+class WriteThrottle:
+    def __init__(self, max_jobs, min_jobs=1, slowdown=1.5, window=8):
+        """
+        Additive increase/multiplicative decrease of the number of jobs in flight, driven by their latency.
+
+        The latency of a job is its duration divided by its estimated cost. As long as the workers are the
+        bottleneck, it stays about constant; when the target device can't absorb the output any more, writes block
+        and it rises. The limit is then halved, and raised again by one for every window of jobs that runs at the
+        normal latency.
+
+        :param max_jobs: maximum number of jobs in flight, i.e., the number of worker processes.
+        :param min_jobs: minimum number of jobs in flight.
+        :param slowdown: latency, relative to the lowest latency seen, above which the limit is lowered.
+        :param window: number of finished jobs over which the latency is measured (median).
+        """
+        if min_jobs < 1 or max_jobs < min_jobs:
+            raise ValueError(f"Arguments should satisfy 1 <= min_jobs <= max_jobs, got min_jobs='{min_jobs}' and "
+                             f"max_jobs='{max_jobs}' instead.")
+        if slowdown <= 1.:
+            raise ValueError(f"Argument 'slowdown' should be larger than 1, got '{slowdown}' instead.")
+        self.max_jobs = max_jobs
+        self.min_jobs = min_jobs
+        self.slowdown = slowdown
+        # Number of jobs that may currently be in flight
+        self.limit = max_jobs
+        # Lowest latency seen, in seconds per unit of cost
+        self.baseline = None
+        self._recent = deque(maxlen=window)
+
+    def observe(self, cost, seconds):
+        """
+        Record a finished job, and adapt the limit.
+
+        :param cost: the estimated cost of the job, see job_cost().
+        :param seconds: how long the job took.
+        """
+        if cost <= 0 or seconds <= 0:
+            return
+        self._recent.append(seconds / cost)
+        if len(self._recent) < self._recent.maxlen:
+            return
+        latency = median(self._recent)
+        self._recent.clear()
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        if latency > self.slowdown * self.baseline:
+            limit = max(self.min_jobs, self.limit // 2)
+            if limit < self.limit:
+                print(f"Target device is falling behind, lowering the number of parallel jobs to {limit}.")
+            self.limit = limit
+        elif self.limit < self.max_jobs:
+            self.limit += 1
@@ -0,0 +1,186 @@
+"""
+In-memory model of a directory tree, built with os.scandir.
+
+Each directory is listed once per run; all methods that need to know what a directory contains (files, sizes,
+subdirectories, number of tracks of a given format...) read it from the model instead of listing it again.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import NamedTuple, Optional
+
+
+class FileInfo(NamedTuple):
+    size: int
+    mtime_ns: int
+
+
+# FileInfo of files that are listed but can't be stat'ed, e.g., dangling symbolic links; they are kept in the model,
+# so that only the job of such a file fails, when it is opened
+UNREADABLE = FileInfo(0, 0)
+
+
+class DirInfo:
+    def __init__(self, path):
+        self.path = path
+        # File name -> FileInfo, or None if the directory was scanned without b_stat
+        self.files = {}
+        # Names of the subdirectories
+        self.subdirs = []
+        # File extension, as written in the file name (e.g., '.wav') -> number of files with that extension
+        self.ext_counts = {}
+
+    @classmethod
+    def scan(cls, path, b_stat=True):
+        """
+        List a single directory.
+
+        :param path: the directory to list
+        :param b_stat: also retrieve the size and modification time of each file
+        :return: DirInfo
+        """
+        res = cls(path)
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    res.subdirs.append(entry.name)
+                    continue
+                if b_stat:
+                    try:
+                        st = entry.stat()
+                        res.files[entry.name] = FileInfo(st.st_size, st.st_mtime_ns)
+                    except OSError:
+                        res.files[entry.name] = UNREADABLE
+                else:
+                    res.files[entry.name] = None
+                ext = os.path.splitext(entry.name)[1]
+                res.ext_counts[ext] = res.ext_counts.get(ext, 0) + 1
+        return res
+
+    def file_info(self, name) -> FileInfo:
+        info = self.files[name]
+        if info is None:
+            try:
+                st = os.stat(os.path.join(self.path, name))
+                info = self.files[name] = FileInfo(st.st_size, st.st_mtime_ns)
+            except OSError:
+                info = self.files[name] = UNREADABLE
+        return info
+
+
+class TreeModel:
+    def __init__(self, b_stat=True, max_dirs=None):
+        """
+
+        :param b_stat: retrieve the size and modification time of each file while scanning directories.
+        :param max_dirs: optional maximum number of directories kept in the model; the least recently used ones are
+        forgotten, and listed again if they are needed again. This keeps the memory use of a model that is filled
+        while walking a very large tree flat.
+        """
+        self.b_stat = b_stat
+        self.max_dirs = max_dirs
+        self.dirs = {} if max_dirs is None else OrderedDict()
+
+    @classmethod
+    def scan(cls, root, b_stat=True):
+        """
+        Scan a complete directory tree.
+
+        :param root: root of the tree
+        :param b_stat: retrieve the size and modification time of each file
+        :return: TreeModel
+        """
+        model = cls(b_stat=b_stat)
+        if os.path.isdir(root):
+            stack = [root]
+            while stack:
+                path = stack.pop()
+                dir_info = model.dirs[path] = DirInfo.scan(path, b_stat=b_stat)
+                stack.extend(os.path.join(path, d) for d in reversed(dir_info.subdirs))
+        return model
+
+    @classmethod
+    def scan_parallel(cls, root, executor, b_stat=True):
+        """
+        Scan a complete directory tree, listing several directories at the same time, which pays off on devices
+        with a high latency per request, such as SD cards or network shares.
+
+        :param root: root of the tree
+        :param executor: concurrent.futures.Executor (e.g., a ThreadPoolExecutor) in which directories are listed
+        :param b_stat: retrieve the size and modification time of each file
+        :return: TreeModel
+        """
+        model = cls(b_stat=b_stat)
+        if not os.path.isdir(root):
+            return model
+        pending = {executor.submit(DirInfo.scan, root, b_stat)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_info = future.result()
+                model.dirs[dir_info.path] = dir_info
+                pending |= {executor.submit(DirInfo.scan, os.path.join(dir_info.path, d), b_stat)
+                            for d in dir_info.subdirs}
+        return model
+
+    def get(self, path) -> Optional[DirInfo]:
+        """
+        Get a directory from the model. Directories that are not in the model yet are scanned (but not their
+        subdirectories).
+
+        :param path: the directory
+        :return: DirInfo, or None if the directory does not exist
+        """
+        dir_info = self.dirs.get(path)
+        if dir_info is None:
+            try:
+                dir_info = DirInfo.scan(path, b_stat=self.b_stat)
+            except (FileNotFoundError, NotADirectoryError):
+                return None
+            self.put(dir_info)
+        elif self.max_dirs is not None:
+            self.dirs.move_to_end(path)
+        return dir_info
+
+    def put(self, dir_info):
+        """
+        Add a directory that was listed elsewhere, e.g., by walk.iter_dirs.
+        """
+        self.dirs[dir_info.path] = dir_info
+        if self.max_dirs is not None:
+            self.dirs.move_to_end(dir_info.path)
+            while len(self.dirs) > self.max_dirs:
+                self.dirs.popitem(last=False)
+
+    def add_dir(self, path):
+        """
+        Register a directory that was just created, and is therefore empty.
+        """
+        self.put(DirInfo(path))
+
+    def remove_dir(self, path):
+        """
+        Forget a directory that was just deleted, along with all of its subdirectories.
+        """
+        prefix = os.path.join(path, '')
+        for p in [p for p in self.dirs if p == path or p.startswith(prefix)]:
+            del self.dirs[p]
+        parent = self.dirs.get(os.path.dirname(path))
+        if parent is not None and os.path.basename(path) in parent.subdirs:
+            parent.subdirs.remove(os.path.basename(path))
+
+    def isdir(self, path):
+        return self.get(path) is not None
+
+    def isfile(self, path):
+        dir_info = self.get(os.path.dirname(path))
+        return dir_info is not None and os.path.basename(path) in dir_info.files
+
+    def exists(self, path):
+        dir_info = self.get(os.path.dirname(path))
+        if dir_info is None:
+            return False
+        name = os.path.basename(path)
+        return name in dir_info.files or name in dir_info.subdirs
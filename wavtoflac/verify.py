@@ -0,0 +1,468 @@
+"""
+Verify that converted files hold the audio of their source, e.g., after a sync to an SD card.
+
+The MD5 of the samples of the WAV file (its 'data' chunk, read through mmap) is compared with the MD5 of the FLAC file:
+either the one stored in its STREAMINFO block by the encoder, which only reads the header of the FLAC file, or, with
+b_decode, the MD5 of the samples ffmpeg decodes from it, which checks every frame of the FLAC file. Both are
+hashed at the speed at which the devices can be read; files are verified in parallel, with a limited number of
+files read at a time from any one device.
+
+Verified files are recorded in a small database in the root of the converted files, so that a run can skip the
+files that were verified before and didn't change since, and a nightly run can re-verify the files that were verified
+longest ago, as far as its time limit allows.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import hashlib
+import mmap
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import NamedTuple, Optional
+
+from wavtoflac.devices import DeviceSemaphores
+from wavtoflac.tree import TreeModel
+from wavtoflac.wavinfo import WAVE_FORMAT_PCM, read_wav_header
+
+VERIFY_LOG_NAME = '.wavtoflac_verified.sqlite'
+# Size of the blocks that are hashed at a time
+BLOCK_SIZE = 1 << 20
+# FLAC hashes 8 bit samples as signed values, WAV files store them unsigned
+SIGNED_8BIT = bytes(b ^ 0x80 for b in range(256))
+# ffmpeg raw output format for each number of bits per sample
+RAW_FORMATS = {8: 'u8', 16: 's16le', 24: 's24le', 32: 's32le'}
+# Number of bytes at the end of a FLAC file searched for its last frame, if STREAMINFO doesn't give the maximum frame
+# size
+MAX_FRAME_SEARCH = 1 << 20
+
+
+def _crc_table(poly, width):
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & mask if crc & top else (crc << 1) & mask
+        table.append(crc)
+    return table
+
+
+# Checksums of FLAC frames: CRC-8 of the frame header, CRC-16 of the whole frame
+CRC8_TABLE = _crc_table(0x07, 8)
+CRC16_TABLE = _crc_table(0x8005, 16)
+
+
+class Status(Enum):
+    OK = 'ok'
+    # The audio differs
+    MISMATCH = 'mismatch'
+    # The converted file doesn't exist
+    MISSING = 'missing'
+    # A file couldn't be read or decoded
+    ERROR = 'error'
+
+
+class StreamInfo(NamedTuple):
+    sample_rate: int
+    channels: int
+    bits_per_sample: int
+    total_samples: int
+    # MD5 of the samples, as a hexadecimal string; all zeros if the encoder didn't compute it
+    md5: str
+
+
+class VerifyJob(NamedTuple):
+    # The WAV and FLAC files that should hold the same audio
+    path_wav: str
+    path_flac: str
+    # Path of the converted file (one of the two), relative to the root of the converted files; verifications are
+    # recorded under this key
+    key: str
+    # Sizes and modification times of both files, to tell whether they changed since they were last verified; None if
+    # the converted file doesn't exist
+    state: Optional[tuple]
+
+
+class VerifyResult(NamedTuple):
+    job: VerifyJob
+    status: Status
+    message: str = ''
+
+
+def read_streaminfo(path) -> StreamInfo:
+    """
+    Read the STREAMINFO block, which is always the first metadata block, of a FLAC file.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(42)
+    if len(head) < 42 or head[:4] != b'fLaC' or head[4] & 0x7F != 0:
+        raise ValueError(f"No FLAC STREAMINFO block found: [{path}]")
+    block = head[8:]
+    return StreamInfo(sample_rate=int.from_bytes(block[10:13], 'big') >> 4,
+                      channels=((block[12] >> 1) & 0x7) + 1,
+                      bits_per_sample=(((block[12] & 0x1) << 4) | (block[13] >> 4)) + 1,
+                      total_samples=((block[13] & 0xF) << 32) | int.from_bytes(block[14:18], 'big'),
+                      md5=block[18:34].hex())
+
+
+def _crc8(data) -> int:
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def _crc16(data) -> int:
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def _parse_frame_header(data, pos):
+    """
+    Parse the header of a FLAC frame.
+
+    :param data: bytes holding the frame.
+    :param pos: offset of the frame in data.
+    :return: (frame number or, for variable block sizes, number of the first sample; True if variable; block size),
+    or None if there is no valid header at pos.
+    """
+    end = len(data)
+    if pos + 6 > end or data[pos] != 0xFF or data[pos + 1] not in (0xF8, 0xF9):
+        return None
+    b_variable = data[pos + 1] == 0xF9
+    block_code, rate_code = data[pos + 2] >> 4, data[pos + 2] & 0xF
+    if block_code == 0 or rate_code == 0xF or data[pos + 3] >> 4 >= 11 or data[pos + 3] & 0x1:
+        return None
+    # Frame or sample number, coded like UTF-8
+    first = data[pos + 4]
+    for nb_bytes, mark in enumerate((0x80, 0xE0, 0xF0, 0xF8, 0xFC, 0xFE, 0xFF), start=1):
+        if first & mark == (mark << 1) & 0xFF:
+            break
+    else:
+        return None
+    if nb_bytes == 7:
+        number = 0
+    else:
+        number = first & (0xFF >> (nb_bytes + 1) if nb_bytes > 1 else 0x7F)
+    idx = pos + 5
+    for _ in range(nb_bytes - 1):
+        if idx >= end or data[idx] & 0xC0 != 0x80:
+            return None
+        number = (number << 6) | (data[idx] & 0x3F)
+        idx += 1
+    if block_code == 6:
+        block_size, idx = (data[idx] if idx < end else -1) + 1, idx + 1
+    elif block_code == 7:
+        block_size, idx = int.from_bytes(data[idx:idx + 2], 'big') + 1, idx + 2
+    elif block_code == 1:
+        block_size = 192
+    elif block_code <= 5:
+        block_size = 576 << (block_code - 2)
+    else:
+        block_size = 256 << (block_code - 8)
+    idx += {12: 1, 13: 2, 14: 2}.get(rate_code, 0)
+    if idx >= end or _crc8(data[pos:idx]) != data[idx]:
+        return None
+    return number, b_variable, block_size
+
+
+def flac_end_sample(path) -> Optional[int]:
+    """
+    Find the last frame of a FLAC file, i.e., the frame with valid checksums that ends exactly at the end of the file,
+    and return the number of samples (per channel) up to its end. Unlike the STREAMINFO block, written at the start of
+    the file, this tells a complete file from one that was cut off.
+
+    :return: the number of samples, or None if the file doesn't end with a complete frame
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(42)
+        if len(head) < 42 or head[:4] != b'fLaC':
+            return None
+        # Block size of all frames but the last one, for fixed block sizes
+        nominal_block_size = int.from_bytes(head[10:12], 'big')
+        max_frame_size = int.from_bytes(head[15:18], 'big')
+        tail_size = min(size, max_frame_size + 16 if max_frame_size else MAX_FRAME_SEARCH)
+        f.seek(size - tail_size)
+        tail = f.read(tail_size)
+
+    pos = len(tail)
+    while True:
+        pos = tail.rfind(b'\xff', 0, pos)
+        if pos < 0:
+            return None
+        header = _parse_frame_header(tail, pos)
+        if header is not None and _crc16(tail[pos:-2]) == int.from_bytes(tail[-2:], 'big'):
+            number, b_variable, block_size = header
+            return (number if b_variable else number * nominal_block_size) + block_size
+
+
+def flac_samples(block, bits_per_sample, flac_bits_per_sample):
+    """
+    Get the samples of a block of PCM data of a WAV file as a FLAC encoder hashes them: 8 bit samples are signed in
+    FLAC files, and ffmpeg, whose FLAC encoder has no 8 bit format, stores them as 16 bit samples.
+
+    :param block: the PCM data.
+    :param bits_per_sample: bits per sample of the WAV file.
+    :param flac_bits_per_sample: bits per sample of the FLAC file; 8 or 16 for 8 bit WAV files.
+    :return: bytes-like object
+    """
+    if bits_per_sample != 8:
+        return block
+    signed = bytes(block).translate(SIGNED_8BIT)
+    if flac_bits_per_sample == 8:
+        return signed
+    widened = bytearray(2 * len(signed))
+    widened[1::2] = signed
+    return widened
+
+
+def wav_md5(path, wav_info, block_size=BLOCK_SIZE, flac_bits_per_sample=None) -> str:
+    """
+    MD5 of the samples of a WAV file, as a FLAC encoder computes it, reading its 'data' chunk through mmap.
+
+    :param flac_bits_per_sample: bits per sample of the FLAC file, see flac_samples; defaults to those of the WAV
+    file.
+    """
+    flac_bits = wav_info.bits_per_sample if flac_bits_per_sample is None else flac_bits_per_sample
+    md5 = hashlib.md5()
+    data_start = wav_info.data_offset
+    data_end = wav_info.data_offset + wav_info.data_size
+    if data_end > data_start:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                for offset in range(data_start, data_end, block_size):
+                    with view[offset:min(offset + block_size, data_end)] as block:
+                        md5.update(flac_samples(block, wav_info.bits_per_sample, flac_bits))
+    return md5.hexdigest()
+
+
+def decoded_md5(path, bits_per_sample, block_size=BLOCK_SIZE) -> str:
+    """
+    MD5 of the samples ffmpeg decodes from a FLAC file. Frames that fail their checksum make ffmpeg fail.
+    """
+    if bits_per_sample not in RAW_FORMATS:
+        raise ValueError(f"unsupported FLAC format, {bits_per_sample} bit")
+    args = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-err_detect', 'crccheck', '-xerror',
+            '-i', path, '-map', '0:a:0', '-f', RAW_FORMATS[bits_per_sample], 'pipe:1']
+    md5 = hashlib.md5()
+    buffer = bytearray(block_size)
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        with memoryview(buffer) as view:
+            while True:
+                nb_read = proc.stdout.readinto(view)
+                if not nb_read:
+                    break
+                with view[:nb_read] as block:
+                    md5.update(block if bits_per_sample != 8 else bytes(block).translate(SIGNED_8BIT))
+    finally:
+        proc.stdout.close()
+        stderr = proc.stderr.read()
+        ret = proc.wait()
+    if ret != 0:
+        raise RuntimeError(f"ffmpeg exited with code {ret}: {stderr.decode(errors='replace').strip()}")
+    return md5.hexdigest()
+
+
+def collect_jobs(path_in, path_out, name_out, b_wav_in):
+    """
+    List the source files below path_in and the files they were converted to, mirrored below path_out.
+
+    :param path_in: root of the source files.
+    :param path_out: root of the converted files.
+    :param name_out: function returning the name of the converted file of a file in path_in, or None for files that
+    aren't converted.
+    :param b_wav_in: whether the source files are the WAV files, or the converted ones.
+    :return: list of VerifyJob
+    """
+    tree = TreeModel.scan(path_in)
+    # Output directories are listed one at a time, as they are needed
+    out_tree = TreeModel()
+    jobs = []
+    for dir_in, dir_info in tree.dirs.items():
+        dir_out = path_out + dir_in[len(path_in):]
+        dir_info_out = None
+        for elem in dir_info.files:
+            elem_out = name_out(elem)
+            if elem_out is None:
+                continue
+            if dir_info_out is None:
+                dir_info_out = out_tree.get(dir_out) or False
+            full_path_in, full_path_out = os.path.join(dir_in, elem), os.path.join(dir_out, elem_out)
+            state = None
+            if dir_info_out and elem_out in dir_info_out.files:
+                info_in, info_out = dir_info.file_info(elem), dir_info_out.file_info(elem_out)
+                state = (info_in.size, info_in.mtime_ns, info_out.size, info_out.mtime_ns)
+            key = os.path.relpath(full_path_out, path_out)
+            if b_wav_in:
+                jobs.append(VerifyJob(full_path_in, full_path_out, key, state))
+            else:
+                jobs.append(VerifyJob(full_path_out, full_path_in, key, state))
+    return jobs
+
+
+class VerifyLog:
+    def __init__(self, root):
+        """
+        Record of the files verified below a root directory, stored as an SQLite database in that directory.
+
+        :param root: root of the converted files.
+        """
+        self.path = os.path.join(root, VERIFY_LOG_NAME)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS verified (key TEXT PRIMARY KEY, state TEXT NOT NULL, "
+                          "verified_ns INTEGER NOT NULL)")
+        self.conn.commit()
+
+    def load(self) -> dict:
+        """
+        :return: dictionary mapping each key to (state, verified_ns)
+        """
+        return {key: (tuple(int(v) for v in state.split(',')), verified_ns)
+                for key, state, verified_ns in self.conn.execute("SELECT key, state, verified_ns FROM verified")}
+
+    def update(self, verified, failed):
+        """
+        Record verifications in a single transaction.
+
+        :param verified: list of (key, state, verified_ns) tuples of files that were verified successfully.
+        :param failed: keys of files that failed verification, and should be verified again by the next run.
+        """
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO verified (key, state, verified_ns) VALUES (?, ?, ?)",
+                                  [(key, ','.join(str(v) for v in state), verified_ns)
+                                   for key, state, verified_ns in verified])
+            self.conn.executemany("DELETE FROM verified WHERE key = ?", [(key,) for key in failed])
+
+    def close(self):
+        self.conn.close()
+
+
+class Verifier:
+    def __init__(self, workers=None, device_streams=2, device_limits=None, b_decode=False, block_size=BLOCK_SIZE):
+        """
+
+        :param workers: number of threads verifying files; defaults to the number of CPUs.
+        :param device_streams: maximum number of files read at the same time from a single device.
+        :param device_limits: optional dictionary mapping a path to the maximum number of files read at the same
+        time from the device holding that path, e.g., {PATH_OUT: 1} for an SD card.
+        :param b_decode: decode the FLAC files, instead of comparing the MD5 stored in their STREAMINFO block. Only
+        decoding reads the complete FLAC file, and thus checks what is actually stored on its device.
+        :param block_size: size in bytes of the blocks that are hashed at a time.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.devices = DeviceSemaphores(device_streams, limits=device_limits, factory=threading.Semaphore)
+        self.b_decode = b_decode
+        self.block_size = block_size
+
+    def run(self, jobs, root, since_ns=None, time_limit=None, b_full=False):
+        """
+        Verify files, skipping the ones that were verified before, and didn't change since.
+
+        Files that were never verified, or changed since, come first; then the ones that were verified longest ago.
+
+        :param jobs: list of VerifyJob.
+        :param root: root of the converted files, where verifications are recorded.
+        :param since_ns: also verify the files that were last verified before this time (time.time_ns()), e.g., to
+        verify every file at least once a month.
+        :param time_limit: number of seconds after which no more files are started; the files left are verified
+        by the next run.
+        :param b_full: verify all files, regardless of when they were last verified.
+        :return: list of VerifyResult, for the files that were verified or are missing; number of files left
+        """
+        log = VerifyLog(root)
+        try:
+            previous = log.load()
+            results = [VerifyResult(job, Status.MISSING, "converted file not found") for job in jobs
+                       if job.state is None]
+            todo = []
+            for job in jobs:
+                if job.state is None:
+                    continue
+                state, verified_ns = previous.get(job.key, (None, -1))
+                if state != job.state:
+                    verified_ns = -1
+                if b_full or verified_ns < 0 or (since_ns is not None and verified_ns < since_ns):
+                    todo.append((verified_ns, job))
+            todo = [job for _, job in sorted(todo, key=lambda item: item[0])]
+            print(f"Verifying {len(todo)} of {len(jobs)} files.")
+
+            deadline = None if time_limit is None else time.monotonic() + time_limit
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                verified = list(executor.map(lambda job: self._verify(job, deadline), todo))
+            left = sum(1 for result in verified if result is None)
+            verified = [result for result in verified if result is not None]
+            now = time.time_ns()
+            log.update([(result.job.key, result.job.state, now) for result in verified if result.status == Status.OK],
+                       [result.job.key for result in verified + results if result.status != Status.OK])
+        finally:
+            log.close()
+        return results + verified, left
+
+    def _verify(self, job, deadline):
+        """
+        Verify a single file, unless the deadline passed.
+
+        :return: VerifyResult, or None if the file was not verified
+        """
+        semaphores = self.devices.for_paths(job.path_wav, job.path_flac)
+        for sem in semaphores:
+            sem.acquire()
+        try:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            return self._compare(job)
+        except Exception as e:
+            return VerifyResult(job, Status.ERROR, f"{e.__class__.__name__}: {e}")
+        finally:
+            for sem in reversed(semaphores):
+                sem.release()
+
+    def _compare(self, job):
+        info = read_streaminfo(job.path_flac)
+        wav_info = read_wav_header(job.path_wav)
+        if wav_info.format_tag != WAVE_FORMAT_PCM:
+            return VerifyResult(job, Status.ERROR, f"unsupported WAV format {wav_info.format_tag}")
+        # ffmpeg encodes 8 bit audio to 16 bit FLAC files
+        bits = 16 if (wav_info.bits_per_sample, info.bits_per_sample) == (8, 16) else wav_info.bits_per_sample
+        wav_format = (wav_info.sample_rate, wav_info.channels, bits, wav_info.nb_frames)
+        flac_format = (info.sample_rate, info.channels, info.bits_per_sample, info.total_samples)
+        if wav_format != flac_format:
+            return VerifyResult(job, Status.MISMATCH, f"format or length differs: WAV {wav_format}, FLAC {flac_format} "
+                                                      f"(rate, channels, bits, samples)")
+        if self.b_decode or not int(info.md5, 16):
+            flac_md5 = decoded_md5(job.path_flac, info.bits_per_sample, block_size=self.block_size)
+        else:
+            flac_md5 = info.md5
+        if wav_md5(job.path_wav, wav_info, block_size=self.block_size, flac_bits_per_sample=bits) != flac_md5:
+            return VerifyResult(job, Status.MISMATCH, "MD5 of the audio differs")
+        return VerifyResult(job, Status.OK)
+
+
+def report(results, left):
+    """
+    Print the outcome of Verifier.run().
+
+    :return: True if all files verified were OK
+    """
+    counts = {status: 0 for status in Status}
+    for result in results:
+        counts[result.status] += 1
+    print(", ".join(f"{counts[status]} {status.value}" for status in Status) + ".")
+    for result in results:
+        if result.status != Status.OK:
+            print(f"{result.status.value.upper()}: [{result.job.path_wav}] / [{result.job.path_flac}]: "
+                  f"{result.message}")
+    if left:
+        print(f"Time limit reached, {left} files left for the next run.")
+    return counts[Status.OK] == len(results)
@@ -0,0 +1,73 @@
+"""
+Walk a directory tree one directory at a time, without recursion, in a chosen order.
+
+Only the directories that were found but not visited yet are kept in memory (their path and sort key), never the
+listing of the whole tree, so that walking a library of millions of files takes about as little memory as walking
+a single album.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import heapq
+import os
+
+from wavtoflac.tree import DirInfo
+
+ORDERS = ('name', 'newest', 'oldest')
+
+
+def _sort_key(order):
+    """
+    Get the function giving the sort key (lowest first) of a directory, or None for alphabetical order.
+    """
+    if order == 'name':
+        return None
+    if order == 'newest':
+        return lambda path, st: -st.st_mtime_ns
+    if order == 'oldest':
+        return lambda path, st: st.st_mtime_ns
+    if callable(order):
+        return order
+    raise ValueError(f"Argument 'order' should be one of {ORDERS} or a function, got '{order}' instead.")
+
+
+def iter_dirs(root, order='name', b_stat=True):
+    """
+    Iterate over the directories of a tree, listing each one when it is reached. A directory always comes before
+    its subdirectories.
+
+    With 'name', the tree is walked depth-first, in alphabetical order. With any other order, the directory with the
+    lowest key among all directories found so far, at any depth, is visited next; e.g., with 'newest', a recently
+    modified album comes before older ones, wherever it is in the tree. The modification time of a directory changes
+    when files or directories are added to it, or removed from it.
+
+    :param root: root of the tree; nothing is yielded if it doesn't exist.
+    :param order: 'name', 'newest' (most recently modified directories first), 'oldest', or a function
+    key(path, os.stat_result) returning the sort key of a directory, lowest first.
+    :param b_stat: retrieve the size and modification time of each file, see tree.DirInfo.scan.
+    :return: generator of (path, tree.DirInfo) tuples
+    """
+    key = _sort_key(order)
+    if not os.path.isdir(root):
+        return
+    # Alphabetical order only needs a stack; other orders a heap of (key, sequence number, path) tuples, in which
+    # the sequence number keeps directories with the same key in the order in which they were found
+    frontier = [root] if key is None else [(0, 0, root)]
+    seq = 1
+    while frontier:
+        path = frontier.pop() if key is None else heapq.heappop(frontier)[2]
+        try:
+            dir_info = DirInfo.scan(path, b_stat=b_stat)
+        except (FileNotFoundError, NotADirectoryError):
+            # Removed since it was found
+            continue
+        if key is None:
+            frontier.extend(os.path.join(path, d) for d in sorted(dir_info.subdirs, reverse=True))
+        else:
+            for d in dir_info.subdirs:
+                sub_path = os.path.join(path, d)
+                try:
+                    heapq.heappush(frontier, (key(sub_path, os.stat(sub_path)), seq, sub_path))
+                except FileNotFoundError:
+                    continue
+                seq += 1
+        yield path, dir_info
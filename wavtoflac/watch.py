@@ -0,0 +1,235 @@
+"""
+Keep the target of a conversion in sync with its source while the source changes, e.g., while albums are ripped.
+
+The source tree is watched with inotify (Linux only). Events are collected until the source has been quiet for a
+few seconds, as ripping an album writes dozens of files, and only the albums they touch, i.e., the directories
+directly below the source root, are then pruned on the target and converted again. Tags that depend on the other
+tracks of an album, such as 'totaltracks', are rewritten through the manifest, as in any other run.
+
+Usage:
+    w2f = WAVToFlac()
+    Watcher(w2f, PATH_IN, PATH_OUT, b_add_cover=True, to_copy={'jpg'}).run()
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+# inotify event flags, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# Events that change what a source directory contains
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    def __init__(self):
+        """
+        Recursive inotify watch, through the C library.
+        """
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("inotify is not available: C library not found.")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify is not available on this system.")
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # Watch descriptor -> watched directory
+        self.paths = {}
+
+    def add_tree(self, root):
+        """
+        Watch a directory and all directories below it.
+        """
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK | IN_ONLYDIR)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    # Removed in the meantime
+                    continue
+                raise OSError(err, f"Can't watch [{path}]: {os.strerror(err)}")
+            self.paths[wd] = path
+            try:
+                with os.scandir(path) as it:
+                    stack.extend(entry.path for entry in it if entry.is_dir(follow_symlinks=False))
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+    def read(self, timeout=None):
+        """
+        Wait for events.
+
+        :param timeout: maximum number of seconds to wait; None to wait until there is an event.
+        :return: list of (path, mask) tuples, empty if the timeout expired. path is None for IN_Q_OVERFLOW.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            dir_path = self.paths.get(wd)
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            if dir_path is None:
+                continue
+            path = os.path.join(dir_path, name) if name else dir_path
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            events.append((path, mask))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class Watcher:
+    def __init__(self, converter, path_in, path_out, b_add_cover=False, to_copy=None, workers=None, settle=5.,
+                 max_delay=60.):
+        """
+
+        :param converter: the WAVToFlac object doing the conversions. A manifest is used, so that the tags of the
+        tracks already on the target are updated when tracks are added to an album.
+        :param path_in: the source root to watch.
+        :param path_out: the output path in which the folder structure found within path_in is mirrored.
+        :param b_add_cover: try to add cover to converted FLAC files
+        :param to_copy: an optional set of file extensions that should be copied from path_in to path_out.
+        :param workers: number of worker processes used to convert files, see WAVToFlac.parse_dir_convert.
+        :param settle: number of seconds without events after which the albums they touched are synced.
+        :param max_delay: maximum number of seconds between an event and the sync of its album, even if events
+        keep coming.
+        """
+        if settle < 0 or max_delay < settle:
+            raise ValueError(f"Arguments should satisfy 0 <= settle <= max_delay, got settle='{settle}' and "
+                             f"max_delay='{max_delay}' instead.")
+        self.converter = converter
+        self.path_in = path_in
+        self.path_out = path_out
+        self.b_add_cover = b_add_cover
+        self.to_copy = to_copy
+        self.workers = workers
+        self.settle = settle
+        self.max_delay = max_delay
+
+    def album_dir(self, path, b_dir):
+        """
+        Get the album directory, i.e., the directory directly below the source root, a path belongs to.
+
+        :param path: a path below the source root.
+        :param b_dir: whether path is (or was, if it was removed) a directory.
+        :return: the album directory, or None for files in the source root itself.
+        """
+        rel_path = os.path.relpath(path, self.path_in)
+        if rel_path == '.' or rel_path.startswith(os.pardir):
+            return None
+        parts = rel_path.split(os.sep, 1)
+        if len(parts) == 1 and not b_dir:
+            return None
+        return os.path.join(self.path_in, parts[0])
+
+    def run(self, b_initial_sync=False, inotify=None):
+        """
+        Watch the source, and sync the albums that change, until interrupted (Ctrl+C).
+
+        :param b_initial_sync: first bring the whole target up to date with a full run.
+        :param inotify: the Inotify object (or any object with the same add_tree, read and close methods) to get the
+        events from; defaults to a new Inotify object. It is closed when the watch stops.
+        """
+        if not os.path.isdir(self.path_in):
+            raise ValueError(f"Directory '{self.path_in}' does not exist.")
+        if inotify is None:
+            inotify = Inotify()
+        try:
+            # Watch first, so that nothing that changes during the initial sync is missed
+            inotify.add_tree(self.path_in)
+            if b_initial_sync:
+                self.sync()
+            print(f"Watching [{self.path_in}] for changes...")
+
+            pending, first, last = set(), None, None
+            while True:
+                timeout = None
+                if pending:
+                    timeout = max(0., min(last + self.settle, first + self.max_delay) - time.monotonic())
+                events = inotify.read(timeout)
+                now = time.monotonic()
+                if events:
+                    for path, mask in events:
+                        if path is None:
+                            print("Too many changes to keep track of, syncing everything.")
+                            pending.add(self.path_in)
+                        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF) and path == self.path_in:
+                            raise RuntimeError(f"Watched directory [{self.path_in}] was removed.")
+                        else:
+                            album_dir = self.album_dir(path, b_dir=bool(mask & IN_ISDIR))
+                            if album_dir is not None:
+                                pending.add(album_dir)
+                    if pending and first is None:
+                        first = now
+                    last = now
+                # Synced once the source is quiet, or max_delay after the first event, even if events keep coming
+                if pending and (now >= last + self.settle or now >= first + self.max_delay):
+                    self.sync(None if self.path_in in pending else sorted(pending))
+                    pending, first, last = set(), None, None
+        except KeyboardInterrupt:
+            print("Stopped watching.")
+        finally:
+            inotify.close()
+
+    def sync(self, album_dirs=None):
+        """
+        Prune and convert some albums, or the whole source.
+
+        :param album_dirs: list of directories directly below the source root; None for the whole source.
+        """
+        if album_dirs is None:
+            print(f"Syncing [{self.path_in}]")
+        else:
+            for album_dir in album_dirs:
+                print(f"Syncing [{album_dir}]")
+        if os.path.isdir(self.path_out):
+            self.converter.check_dirs_out_to_in(self.path_in, self.path_out, b_delete=True, subdirs=album_dirs)
+        if album_dirs is not None:
+            album_dirs = [d for d in album_dirs if os.path.isdir(d)]
+            if not album_dirs:
+                return
+        self.converter.parse_dir_convert(self.path_in, self.path_out, b_add_cover=self.b_add_cover,
+                                         to_copy=self.to_copy, workers=self.workers, subdirs=album_dirs)
@@ -0,0 +1,130 @@
+"""
+Read the header of a WAV file, without loading any of its audio data, and build the header of a new one.
+
+.. codeauthor:: Laurent Mertens <laurent.mertens@outlook.com>
+"""
+import os
+import struct
+from typing import NamedTuple
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Rest of the KSDATAFORMAT_SUBTYPE_PCM GUID, after its first two bytes (the format tag)
+SUBFORMAT_GUID_TAIL = b'\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71'
+# Speaker positions for each number of channels, following the channel assignments of FLAC streams
+CHANNEL_MASKS = {1: 0x4, 2: 0x3, 3: 0x7, 4: 0x33, 5: 0x37, 6: 0x3F, 7: 0x70F, 8: 0x63F}
+
+
+class WavInfo(NamedTuple):
+    """
+    Properties of a WAV file, as read from its header.
+
+    data_offset and data_size locate the raw PCM data ('data' chunk) within the file.
+    """
+    format_tag: int
+    channels: int
+    sample_rate: int
+    bits_per_sample: int
+    block_align: int
+    data_offset: int
+    data_size: int
+    # The file ends before the end of the 'data' chunk given in its header; data_size is what is left
+    b_truncated: bool = False
+
+    @property
+    def nb_frames(self):
+        return self.data_size // self.block_align
+
+    @property
+    def duration(self):
+        return self.nb_frames / self.sample_rate
+
+
+def read_wav_header(path: str) -> WavInfo:
+    """
+    Parse the RIFF chunks of a WAV file until the 'data' chunk is found.
+
+    WAVE_FORMAT_EXTENSIBLE files are resolved to the format of their sub-format GUID, so that format_tag is
+    always either WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT or some other (unsupported) format.
+
+    :param path: path to the WAV file
+    :return: WavInfo
+    """
+    file_size = os.path.getsize(path)
+    fmt = None
+    with open(path, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise ValueError(f"Not a RIFF/WAVE file: [{path}]")
+
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(f"No 'data' chunk found in WAV file: [{path}]")
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+
+            if chunk_id == b'fmt ':
+                chunk = f.read(chunk_size)
+                if len(chunk) < 16:
+                    raise ValueError(f"Invalid 'fmt ' chunk in WAV file: [{path}]")
+                format_tag, channels, sample_rate, _, block_align, bits_per_sample = \
+                    struct.unpack('<HHIIHH', chunk[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(chunk) >= 40:
+                    # The first two bytes of the sub-format GUID hold the actual format tag
+                    format_tag = struct.unpack('<H', chunk[24:26])[0]
+                fmt = (format_tag, channels, sample_rate, bits_per_sample, block_align)
+                # Chunks are word-aligned
+                if chunk_size % 2:
+                    f.seek(1, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(f"'data' chunk found before 'fmt ' chunk in WAV file: [{path}]")
+                data_offset = f.tell()
+                # Files written by streaming recorders sometimes leave the size unset (0 or 0xFFFFFFFF)
+                data_size = chunk_size
+                b_truncated = False
+                if data_size == 0 or data_offset + data_size > file_size:
+                    b_truncated = data_size not in (0, 0xFFFFFFFF)
+                    data_size = file_size - data_offset
+                format_tag, channels, sample_rate, bits_per_sample, block_align = fmt
+                if not channels or not sample_rate or not block_align:
+                    raise ValueError(f"Invalid 'fmt ' chunk in WAV file: [{path}]")
+                return WavInfo(format_tag=format_tag, channels=channels, sample_rate=sample_rate,
+                               bits_per_sample=bits_per_sample, block_align=block_align,
+                               data_offset=data_offset, data_size=data_size, b_truncated=b_truncated)
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def wav_header(channels: int, sample_rate: int, bits_per_sample: int, data_size: int) -> bytes:
+    """
+    Build the header of an integer PCM WAV file, up to and including the header of its 'data' chunk.
+
+    Files with more than two channels or more than 16 bits per sample get a WAVE_FORMAT_EXTENSIBLE 'fmt ' chunk,
+    as the format requires.
+
+    :param channels: number of channels
+    :param sample_rate: number of frames per second
+    :param bits_per_sample: 8, 16, 24 or 32
+    :param data_size: size in bytes of the PCM data that will follow the header
+    :return: the header, as bytes; the PCM data starts right after it
+    """
+    if bits_per_sample not in (8, 16, 24, 32):
+        raise ValueError(f"Unsupported number of bits per sample: {bits_per_sample}")
+    block_align = channels * bits_per_sample // 8
+    if channels > 2 or bits_per_sample > 16:
+        fmt = struct.pack('<HHIIHHHHI2s14s', WAVE_FORMAT_EXTENSIBLE, channels, sample_rate,
+                          sample_rate * block_align, block_align, bits_per_sample, 22, bits_per_sample,
+                          CHANNEL_MASKS.get(channels, 0), struct.pack('<H', WAVE_FORMAT_PCM), SUBFORMAT_GUID_TAIL)
+    else:
+        fmt = struct.pack('<HHIIHH', WAVE_FORMAT_PCM, channels, sample_rate, sample_rate * block_align,
+                          block_align, bits_per_sample)
+    # RIFF size: 'WAVE', both chunk headers, and both chunks, data chunk padded to an even size
+    riff_size = 4 + 8 + len(fmt) + 8 + data_size + data_size % 2
+    if riff_size > 0xFFFFFFFF:
+        raise ValueError(f"Too much audio data for a WAV file: {data_size} bytes")
+    return (struct.pack('<4sI4s', b'RIFF', riff_size, b'WAVE') +
+            struct.pack('<4sI', b'fmt ', len(fmt)) + fmt +
+            struct.pack('<4sI', b'data', data_size))
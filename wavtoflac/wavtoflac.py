@@ -1,14 +1,37 @@
+import asyncio
+import hashlib
 import math
+import mmap
 import os
 import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-
-from PIL import Image
-from mutagen import id3
-from ffmpeg import FFmpeg
-from mutagen.flac import FLAC, Picture
-from pydub import AudioSegment
-from termcolor import cprint
+from typing import NamedTuple, Optional
+
+from wavtoflac.analysis import (ALBUM_ANALYSIS_TAGS, ANALYSIS_TAGS, PCMAnalyzer, TrackAnalysis, album_tags,
+                                analyze_file, require_numpy)
+from wavtoflac.budget import estimate_albums, parse_size, report, select_albums
+from wavtoflac.copier import TEMP_SUFFIX, BulkCopier, clone_file, copy_file, needs_copy
+from wavtoflac.covercache import CoverCache
+from wavtoflac.devices import DeviceSemaphores
+from wavtoflac.journal import Journal
+from wavtoflac.manifest import MANIFEST_NAME, Manifest, ManifestEntry, hash_cover, hash_file, hash_tags
+from wavtoflac.metrics import FileMetrics, Recorder, stage
+from wavtoflac.pathtags import PathTagParser, extract_discnr
+from wavtoflac.pool import run_jobs, stream_jobs
+from wavtoflac.profiles import get_profile
+from wavtoflac.prune import PruneItem, Pruner
+from wavtoflac.scheduler import WriteThrottle, estimate_seconds, job_cost, order_longest_first
+from wavtoflac.tree import TreeModel
+from wavtoflac.verify import Status, Verifier, collect_jobs, flac_end_sample, read_streaminfo
+from wavtoflac.verify import report as report_verify
+from wavtoflac.walk import iter_dirs
+from wavtoflac.wavinfo import WAVE_FORMAT_PCM, read_wav_header
+
+# Codec and tagging libraries (mutagen, pydub, python-ffmpeg) are only imported by the methods that use them, so that
+# planning or pruning doesn't pay for importing them
 
 # Defaults
 HOME = os.path.expanduser("~")
@@ -19,6 +42,29 @@ PATH_OUT = os.path.join(HOME, "../../media/lmertens/3039-3962/MUSIC")
 MODE_TO_BPP = {"1": 1, "L": 8, "P": 8, "RGB": 24, "RGBA": 32, "CMYK": 32, "YCbCr": 24, "LAB": 24,
                "HSV": 24, "I": 32, "F": 32}
 
+# Size of the blocks of PCM data that are fed to the encoder when streaming a WAV file
+BLOCK_SIZE = 1 << 20
+
+# ffmpeg raw input format for each (WAV format tag, bits per sample) combination that can be streamed
+PCM_RAW_FORMATS = {(WAVE_FORMAT_PCM, 8): 'u8',
+                   (WAVE_FORMAT_PCM, 16): 's16le',
+                   (WAVE_FORMAT_PCM, 24): 's24le',
+                   (WAVE_FORMAT_PCM, 32): 's32le'}
+
+# Suffix of the temporary file the cover is added to, before it replaces the encoded temporary file
+COVER_TEMP_SUFFIX = '.cover' + TEMP_SUFFIX
+
+# Size in bytes of the PADDING block reserved in encoded files, so that tags can later be rewritten in place
+TAG_PADDING = 8192
+# Vorbis comments added by the encoder itself or by the analysis, that are not derived from the path of the file
+IGNORED_TAGS = {'encoder'} | ANALYSIS_TAGS
+
+# Number of directory listings the tree models of a streaming run keep, in the main process and in each worker
+STREAM_CACHED_DIRS = 1024
+# Number of converted files, or of pruned paths, after which a streaming run updates the manifest, or deletes them
+STREAM_BATCH = 1000
+
+
 class Format(Enum):
     AAC = '.aac'
     FLAC = '.flac'
@@ -27,14 +73,84 @@ class Format(Enum):
     WAV = '.wav'
 
 
+class ConvertJob(NamedTuple):
+    """
+    A single file to be processed by WAVToFlac._process_job.
+
+    audio_format is the format of the file to convert to FLAC, or None if the file should simply be copied.
+    """
+    path_in: str
+    path_out: str
+    audio_format: Optional[Format]
+    # Only update the tags of the existing output file
+    b_retag_only: bool = False
+    # Planned manifest entry for the file; None if no manifest is used
+    entry: Optional[ManifestEntry] = None
+    # Content hash of the source when it was last converted; if set, the file is only re-encoded if its content
+    # changed
+    prev_hash: Optional[str] = None
+    # Encoded FLAC file holding the same audio as the source; if set, the output is derived from it instead of
+    # encoding the source
+    source_out: Optional[str] = None
+
+
+class JobResult(NamedTuple):
+    b_ok: bool
+    # Manifest entry to store for the file, if a manifest is used
+    entry: Optional[ManifestEntry] = None
+    # Stage timings and byte counts of the job
+    metrics: Optional[FileMetrics] = None
+    # Loudness, peak and MD5 of the source, if it was analysed
+    analysis: Optional[TrackAnalysis] = None
+
+
+class Encoder(Enum):
+    # Load the full WAV file in memory with pydub, and export it to FLAC
+    PYDUB = 'pydub'
+    # Stream the PCM data of the WAV file, one block at a time, to an ffmpeg process that writes the final FLAC file,
+    # tags and cover included
+    STREAM = 'stream'
+
+
 class WAVToFlac:
-    def __init__(self):
+    def __init__(self, encoder: Encoder = Encoder.STREAM, block_size: int = BLOCK_SIZE, cover_cache=None,
+                 padding: int = TAG_PADDING, profile='balanced'):
+        """
+
+        :param encoder: how WAV files are encoded to FLAC. Encoder.STREAM keeps memory use bounded by block_size,
+        regardless of the length of the track; files it can't handle are encoded with Encoder.PYDUB instead.
+        :param block_size: size in bytes of the blocks of PCM data fed to the encoder when using Encoder.STREAM.
+        :param cover_cache: CoverCache in which resized cover images are kept; defaults to a cache in the user's
+        cache directory.
+        :param padding: size in bytes of the padding reserved in the metadata of the FLAC files that are written.
+        Tags that fit in this padding are updated in place, without rewriting the audio data.
+        :param profile: settings of the FLAC encoder: 'fast', 'balanced' or 'max' (see profiles.PROFILES), or a
+        profiles.EncoderProfile with custom settings. Only applies to the files that are encoded, files converted
+        by previous runs are not encoded again when the profile changes. See profiles.compare_profiles to choose one.
+        """
         self.failed = []
+        # Files of which the tags were changed by the last tag update
+        self.retagged = []
+        self.encoder = encoder
+        self.block_size = block_size
+        self.cover_cache = CoverCache() if cover_cache is None else cover_cache
+        self.padding = padding
+        self.profile = get_profile(profile)
         # ref_path: this is the path you will first call the method with. After the initial call, the method
         # will recursively traverse subpaths, and use this 'original' path to extract the names of the directories
         # specific to the music being parsed. If this doesn't make any sense, read the code.
         self.ref_path = None
         self.b_add_cover = False
+        self.b_analyze = False
+        # Models of the source and output trees, so that each directory is only listed once per run
+        self.tree = TreeModel()
+        self.out_tree = TreeModel(b_stat=False)
+        # Parser deriving tags from the paths of the tracks, see _path_tags
+        self._path_parser = None
+        # metrics.Profiler used by the worker processes to profile a sample of the files, if any
+        self.profiler = None
+        # Analyses of the files encoded in this run, by output path, for the duplicates derived from them
+        self._analyses = {}
 
         print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         print("To expand code to allow loading folder pictures, check comments in code.")
@@ -55,212 +171,1518 @@ class WAVToFlac:
         #
         #  flac_object.add_picture(picture)
 
-    def check_dirs_out_to_in(self, path_in, path_out, b_delete=False):
+    def check_dirs_out_to_in(self, path_in, path_out, b_delete=False, workers=4, subdirs=None, b_stream=False):
         """
-        Check which directories present on target device or path (path_out) are NOT present on source device or path (path_in).
+        Check which directories and files present on target device or path (path_out) are NOT present on source
+        device or path (path_in). FLAC files on the target match the WAV/MPGA files they were converted from.
+
+        Without b_delete, this is a dry run that reports what would be deleted, and how much space that would free.
 
         :param path_in: the path to parse.
         :param path_out: the output path in which the folder structure found within path_in will be mirrored.
-        :param b_delete: delete path on target device if it does not exist on source device.
-        :return:
+        :param b_delete: delete paths and files on target device if they do not exist on source device.
+        :param workers: number of threads listing or deleting directories on a single device.
+        :param subdirs: optional list of directories below path_in (e.g., albums); if given, only these directories,
+        and their counterparts on the target, are checked. Directories that no longer exist on the source device are
+        unmatched as a whole.
+        :param b_stream: for trees too large to list completely: walk both trees one directory at a time, and report
+        (and, with b_delete, delete every STREAM_BATCH items) the unmatched directories and files as they are found,
+        without keeping them; see prune.Pruner.iter_plan. Can't be combined with subdirs.
+        :return: list of prune.PruneItem, the unmatched directories and files; with b_stream, only their number.
         """
-        for elem in sorted(os.listdir(path_out)):
-            full_path_target = os.path.join(path_out, elem)
-            if os.path.isdir(full_path_target):
-                full_path_source = os.path.join(path_in, elem)
-                if not os.path.exists(full_path_source):
-                    print(f"Unmatched target path: {full_path_target}")
-                    # print(f"\tFull path: {full_path_target}")
-                    if b_delete:
-                        shutil.rmtree(full_path_target)
-                        print("\tPath deleted from target device.")
-                else:
-                    self.check_dirs_out_to_in(path_in=full_path_source, path_out=full_path_target, b_delete=b_delete)
+        pruner = Pruner(workers=workers)
+        if b_stream:
+            if subdirs is not None:
+                raise ValueError("Arguments 'subdirs' and 'b_stream' can't be combined.")
+            return self._prune_stream(pruner, path_in, path_out, b_delete)
+        if subdirs is None:
+            items = pruner.plan(path_in, path_out)
+            self.tree, self.out_tree = pruner.tree, pruner.out_tree
+        else:
+            if not os.path.isdir(path_in):
+                raise ValueError(f"Directory '{path_in}' does not exist.")
+            items = []
+            for dir_in in self._check_subdirs(path_in, subdirs):
+                dir_out = dir_in.replace(path_in, path_out, 1)
+                if os.path.isdir(dir_in) and os.path.isdir(dir_out):
+                    items += pruner.plan(dir_in, dir_out)
+                elif os.path.isdir(dir_out):
+                    out_tree = TreeModel.scan(dir_out)
+                    items.append(PruneItem(dir_out, True, sum(info.size for dir_info in out_tree.dirs.values()
+                                                              for info in dir_info.files.values())))
+            # Only the directories that are needed are listed
+            self.tree, self.out_tree = TreeModel(b_stat=False), TreeModel(b_stat=False)
+        pruner.report(items)
+        if not b_delete:
+            return items
+
+        pruner.delete(items)
+        self._forget_deleted_sources(path_in, path_out, subdirs)
+        return items
+
+    def _prune_stream(self, pruner, path_in, path_out, b_delete):
+        """
+        check_dirs_out_to_in with b_stream.
+
+        :return: the number of unmatched directories and files
+        """
+        nb_dirs, nb_files, size, batch = 0, 0, 0, []
+        for item in pruner.iter_plan(path_in, path_out):
+            pruner.report_item(item)
+            nb_dirs += item.b_dir
+            nb_files += not item.b_dir
+            size += item.size
+            if b_delete:
+                batch.append(item)
+                if len(batch) >= STREAM_BATCH:
+                    pruner.delete(batch)
+                    batch = []
+        pruner.report_total(nb_dirs, nb_files, size)
+        if b_delete:
+            if batch:
+                pruner.delete(batch)
+            # Sources are checked in alphabetical order, so that the listings of a few directories suffice
+            self.tree = TreeModel(b_stat=False, max_dirs=STREAM_CACHED_DIRS)
+            self.out_tree = TreeModel(b_stat=False, max_dirs=STREAM_CACHED_DIRS)
+            self._forget_deleted_sources(path_in, path_out)
+        return nb_dirs + nb_files
+
+    def _forget_deleted_sources(self, path_in, path_out, subdirs=None):
+        """
+        Remove the converted files whose source no longer exists from the manifest, if any.
+        """
+        if self.out_tree.isfile(os.path.join(path_out, MANIFEST_NAME)):
+            prefixes = None if subdirs is None else \
+                tuple(os.path.join(os.path.relpath(d, path_in), '') for d in subdirs)
+            manifest = Manifest(path_out)
+            manifest.delete([source for source in manifest.sources()
+                             if (prefixes is None or source.startswith(prefixes))
+                             and not self.tree.exists(os.path.join(path_in, source))])
+            manifest.close()
 
-    def parse_dir_convert(self, path_in, path_out, b_add_cover=False, to_copy=None, _b_initial=True):
+    @classmethod
+    def _check_subdirs(cls, path_in, subdirs):
+        """
+        Make sure all subdirs are directories below path_in.
+        """
+        for d in subdirs:
+            if os.path.commonpath([path_in, d]) != path_in or d == path_in:
+                raise ValueError(f"Directory '{d}' is not below '{path_in}'.")
+        return subdirs
+
+    def parse_dir_convert(self, path_in, path_out, b_add_cover=False, to_copy=None, workers=None, b_manifest=True,
+                          copy_workers=4, copy_device_workers=None, b_fsync=False, recorder=None, b_resume=False,
+                          b_dedupe=False, b_throttle=False, subdirs=None, b_longest_first=True, b_analyze=False):
         """
         Parse a directory to convert the WAV files to FLAC.
 
+        The directory tree is walked first, to collect all files that need to be converted or copied. These jobs
+        are then processed by a pool of worker processes.
+
+        :param path_in: the path to parse
+        :param path_out: the output path in which the folder structure found within path_in will be mirrored.
+        :param b_add_cover: try to add cover to converted FLAC files
+        :param to_copy: an optional set of file extensions that should be copied from PATH_IN to PATH_OUT.
+        :param workers: number of worker processes used to convert files in parallel; defaults to the number of CPUs.
+        Use 1 to convert the files one at a time, in the current process.
+        :param b_manifest: keep track of converted files in a manifest stored in path_out. Source files that were
+        modified since they were converted are then re-encoded, files of which only the tags changed are re-tagged,
+        and files that were only partially written are converted again. If False, every file for which an output
+        file exists is skipped.
+        :param copy_workers: number of threads copying the to_copy files to the target device. Copies run alongside
+        the conversions. Files are only copied again if their size or modification time changed.
+        :param copy_device_workers: optional dictionary mapping a path to the number of copy threads for the device
+        holding that path, overriding copy_workers for that device.
+        :param b_fsync: flush the copied files to the target device at the end of the run.
+        :param recorder: optional metrics.Recorder that receives the stage timings and byte counts of each file,
+        e.g., to write a trace, report progress or print a summary table at the end of the run.
+        :param b_resume: if the previous run on path_in was interrupted, only process the files it didn't finish,
+        as listed in its journal, instead of scanning path_in again.
+        :param b_dedupe: encode WAV files holding identical audio (e.g., the same track on an album and on a
+        compilation) only once. The other outputs are derived from the encoded file, with their own tags and cover.
+        :param b_throttle: lower the number of files encoded in parallel when the target device can't keep up with
+        the writes (e.g., an SD card of which the write cache is full), see scheduler.WriteThrottle.
+        :param subdirs: optional list of directories below path_in (e.g., albums); if given, only these directories
+        are scanned and converted, instead of the whole of path_in. Tags are still derived relative to path_in.
+        :param b_longest_first: start the longest jobs first; if False, jobs are started in the order of subdirs,
+        e.g., so that the albums that matter most land on the target first.
+        :param b_analyze: compute the loudness (EBU R128) and peak of each encoded WAV file from the blocks of PCM
+        data the encoder reads, and write them as ReplayGain tags; album tags are computed per directory, once all
+        its WAV files were encoded in the run. Truncated WAV files fail, and streamed files fail if the MD5 of their
+        PCM data doesn't match the one of the FLAC file. Requires NumPy; see analysis.py.
+        :return:
+        """
+        if b_analyze:
+            require_numpy()
+        recorder = Recorder() if recorder is None else recorder
+        with recorder.activate():
+            jobs, manifest, adopted, journal = self._start_run(path_in, path_out, b_add_cover=b_add_cover,
+                                                               to_copy=to_copy, b_manifest=b_manifest,
+                                                               b_resume=b_resume, subdirs=subdirs,
+                                                               b_analyze=b_analyze)
+
+        # Files that are simply copied go to a dedicated copy stage, that runs alongside the conversions
+        copies = [job for job in jobs if job.audio_format is None]
+        jobs = [job for job in jobs if job.audio_format is not None]
+        duplicates = []
+        if b_dedupe:
+            with recorder.activate(), stage('dedupe'):
+                jobs, duplicates = self._plan_dedupe(jobs, manifest, path_out, workers=workers)
+        # Start the longest jobs first, so that the end of the run isn't left to a single worker
+        with recorder.activate(), stage('schedule'):
+            costs = {job.path_in: job_cost(job, self._job_bytes(job)) for job in jobs}
+            if b_longest_first:
+                jobs = order_longest_first(jobs, costs)
+        throttle = WriteThrottle(max_jobs=workers or os.cpu_count() or 1) if b_throttle else None
+        recorder.start(len(jobs) + len(duplicates) + len(copies),
+                       sum(self._job_bytes(job) for job in jobs + copies + [job for job, _ in duplicates]))
+        self.profiler = recorder.profiler
+
+        def on_result(job, result):
+            if throttle is not None and result.metrics is not None and job.path_in in costs:
+                throttle.observe(costs[job.path_in], result.metrics.seconds)
+            recorder.record(result.metrics, result.b_ok)
+            journal.done(job.path_in, result.b_ok, result.entry)
+
+        def on_copy(metrics, b_ok):
+            recorder.record(metrics, b_ok)
+            journal.done(metrics.path, b_ok)
+
+        copier = BulkCopier(workers=copy_workers, device_workers=copy_device_workers, b_fsync=b_fsync,
+                            on_copy=on_copy)
+        results = run_jobs(self, jobs, workers=workers, on_start=lambda: copier.submit(copies), on_result=on_result,
+                           throttle=throttle)
+        if duplicates:
+            # Duplicates of files encoded in this run are derived from them once they are done. This is mostly I/O,
+            # and new worker processes can't be forked safely while the copy threads run, so it is done here.
+            b_ok = {job.path_in: result.b_ok for job, result in zip(jobs, results)}
+            derived = [job._replace(source_out=leader.path_out) if b_ok[leader.path_in] else job
+                       for job, leader in duplicates]
+            # Derived files hold the same audio, and thus get the same analysis, as the file they are derived from
+            self._analyses = {job.path_out: result.analysis for job, result in zip(jobs, results)
+                              if result.analysis is not None}
+            results += run_jobs(self, derived, workers=1, on_result=on_result)
+            self._analyses = {}
+            jobs += derived
+        if b_dedupe:
+            deduped = [job for job, result in zip(jobs, results)
+                       if result.b_ok and job.source_out not in (None, job.path_out)]
+            print(f"Deduplicated {len(deduped)} files: "
+                  f"{sum(self._job_bytes(job) for job in deduped) / 1e6:.1f} MB of audio not encoded again.")
+        results += [JobResult(b_ok) for b_ok in copier.finish()]
+        if b_analyze:
+            with recorder.activate(), stage('album_gain'):
+                self._write_album_gains(jobs, results)
+
+        with recorder.activate():
+            self._finish_run(path_in, jobs + copies, results, manifest=manifest, adopted=adopted, journal=journal)
+        recorder.finish()
+
+    def parse_dir_convert_stream(self, path_in, path_out, b_add_cover=False, to_copy=None, workers=None,
+                                 b_manifest=True, recorder=None, order='name', max_pending=None):
+        """
+        Convert a directory as parse_dir_convert does, for trees too large to collect all of their jobs first: the
+        source tree is walked one directory at a time (see walk.iter_dirs), and the jobs of each directory are handed
+        to the worker processes as they are found, with at most max_pending jobs queued or running at a time. Memory
+        use doesn't grow with the size of the tree: only the directories still to be visited, the listings of the
+        last STREAM_CACHED_DIRS directories, the manifest entries of the current directory and the failed files are
+        kept.
+
+        Unlike parse_dir_convert, files to copy are copied by the worker processes, jobs are started in the order of
+        the walk instead of longest first, and files are neither deduplicated nor analysed. There is no journal: the
+        manifest is updated every STREAM_BATCH files, so that the next run skips the files this one converted, even
+        if it was interrupted.
+
         :param path_in: the path to parse
         :param path_out: the output path in which the folder structure found within path_in will be mirrored.
         :param b_add_cover: try to add cover to converted FLAC files
         :param to_copy: an optional set of file extensions that should be copied from PATH_IN to PATH_OUT.
-        :param _b_initial: boolean indicating that this call did not originate from within the method itself. Should
-        not be specified by the user.
+        :param workers: number of worker processes; defaults to the number of CPUs.
+        :param b_manifest: see parse_dir_convert.
+        :param recorder: see parse_dir_convert; the progress it reports is relative to the files found so far.
+        :param order: in which order directories are converted: 'name', 'newest' (most recently modified directories
+        first, e.g., so that new albums land on the target first), 'oldest', or a function, see walk.iter_dirs.
+        :param max_pending: maximum number of jobs queued or running at a time; defaults to
+        pool.PENDING_PER_WORKER per worker.
         :return:
         """
+        to_copy = self._check_to_copy(to_copy)
+        if not os.path.isdir(path_in):
+            raise ValueError(f"Directory '{path_in}' does not exist.")
+        self.failed = []
+        self.ref_path = path_in
+        self.b_add_cover = b_add_cover
+        self.b_analyze = False
+        # The worker processes get a copy of both models, and thus keep as few listings
+        self.tree = TreeModel(max_dirs=STREAM_CACHED_DIRS)
+        self.out_tree = TreeModel(b_stat=False, max_dirs=STREAM_CACHED_DIRS)
+        if not os.path.exists(path_out):
+            os.makedirs(path_out)
+        manifest = Manifest(path_out) if b_manifest else None
+        recorder = Recorder() if recorder is None else recorder
+        recorder.start(0, 0)
+        self.profiler = recorder.profiler
+
+        def found_jobs():
+            for job in self._iter_jobs(path_in, path_out, to_copy, manifest=manifest, order=order):
+                recorder.add_total(1, self._job_bytes(job))
+                yield job
+
+        # Only failed jobs, and the manifest entries not written yet, are kept
+        failed, entries = [], {}
+
+        def on_result(job, result):
+            recorder.record(result.metrics, result.b_ok)
+            if not result.b_ok:
+                failed.append(job)
+            elif manifest is not None and result.entry is not None:
+                entries[self._relpath(job.path_in, path_in)] = result.entry
+                if len(entries) >= STREAM_BATCH:
+                    manifest.update(entries)
+                    entries.clear()
+
+        stream_jobs(self, found_jobs(), workers=workers, max_pending=max_pending, on_result=on_result)
+        with recorder.activate():
+            self._finish_run(path_in, failed, [JobResult(False)] * len(failed), manifest=manifest, adopted=entries,
+                             journal=None)
+        recorder.finish()
+
+    def _start_run(self, path_in, path_out, b_add_cover, to_copy, b_manifest, b_resume=False, subdirs=None,
+                   b_analyze=False):
+        """
+        Scan the source tree and collect the jobs of a conversion run, or get the jobs left by an interrupted run
+        from its journal; see parse_dir_convert for the parameters.
+
+        :return: jobs, manifest (or None), adopted manifest entries, journal
+        """
+        to_copy = self._check_to_copy(to_copy)
+
+        # Reset container for failed files
+        self.failed = []
+        self.ref_path = path_in
+        self.b_add_cover = b_add_cover
+        self.b_analyze = b_analyze
+        # Output directories are only listed when they are needed, i.e., when no manifest is used, or to copy files
+        self.out_tree = TreeModel(b_stat=False)
+        if not os.path.exists(path_out):
+            os.makedirs(path_out)
+
+        journal = Journal(path_out)
+        previous = journal.load()
+        if previous is not None and previous[0].get('path_in') != path_in:
+            previous = None
+        if previous is not None:
+            self._remove_orphans(previous)
+
+        if b_resume and previous is not None:
+            # Source directories are only listed when a remaining job needs them, e.g., to count tracks
+            self.tree = TreeModel()
+            jobs, adopted = self._resume_jobs(previous)
+            manifest = Manifest(path_out) if b_manifest else None
+            print(f"Resuming interrupted run, {len(jobs)} files left to process.")
+        else:
+            with stage('scan'):
+                if subdirs is None:
+                    self.tree = TreeModel.scan(path_in)
+                else:
+                    # Other directories, e.g., the parent of a disc directory to count the discs of an album, are
+                    # listed when needed
+                    self.tree = TreeModel()
+                    for d in self._check_subdirs(path_in, subdirs):
+                        self.tree.dirs.update(TreeModel.scan(d).dirs)
+
+            manifest, rows, adopted = None, None, {}
+            if b_manifest:
+                with stage('manifest'):
+                    manifest = Manifest(path_out)
+                    rows = manifest.load()
+
+            jobs = []
+            with stage('plan'):
+                for d in ([path_in] if subdirs is None else subdirs):
+                    if self.tree.isdir(d):
+                        self._collect_jobs(d, path_out, to_copy=to_copy, jobs=jobs, rows=rows, adopted=adopted)
+
+        journal.start({'path_in': path_in, 'adopted': {k: list(v) for k, v in adopted.items()}},
+                      [self._job_record(job) for job in jobs])
+
+        return jobs, manifest, adopted, journal
+
+    @classmethod
+    def _check_to_copy(cls, to_copy):
         if to_copy is None:
-            to_copy = set()
-        elif not isinstance(to_copy, set):
+            return set()
+        if not isinstance(to_copy, set):
             raise ValueError(f"Argument 'to_copy' should be of type 'set', got '{to_copy.__class__.__name__}' instead.")
+        return to_copy
 
-        # Reset container for failed files
-        if _b_initial:
-            self.failed = []
-            self.ref_path = path_in
-            self.b_add_cover = b_add_cover
+    def plan(self, path_in, path_out, b_add_cover=False, to_copy=None, workers=None, b_manifest=True,
+             copy_workers=4):
+        """
+        Dry run of parse_dir_convert: print the jobs it would run, in the order in which they would be started, with
+        the number of bytes each one reads and an estimate of its duration. Nothing is written, and no audio is read;
+        only the source tree, the manifest and, for files converted before the manifest was used, the headers of
+        the existing FLAC files are.
+
+        :param path_in: the path to parse
+        :param path_out: the output path in which the folder structure found within path_in would be mirrored.
+        :param b_add_cover: try to add cover to converted FLAC files
+        :param to_copy: an optional set of file extensions that should be copied from PATH_IN to PATH_OUT.
+        :param workers: number of worker processes, used to estimate the duration of the run; defaults to the number
+        of CPUs.
+        :param b_manifest: plan as parse_dir_convert would with or without manifest.
+        :param copy_workers: number of copy threads, used to estimate the duration of the run.
+        :return: list of ConvertJob
+        """
+        to_copy = self._check_to_copy(to_copy)
+        workers = workers or os.cpu_count() or 1
+        self.failed = []
+        self.ref_path = path_in
+        self.b_add_cover = b_add_cover
+        self.tree = TreeModel.scan(path_in)
+        self.out_tree = TreeModel(b_stat=False)
+
+        rows = None
+        if b_manifest:
+            rows = {}
+            if os.path.isfile(os.path.join(path_out, MANIFEST_NAME)):
+                manifest = Manifest(path_out)
+                rows = manifest.load()
+                manifest.close()
+        jobs = []
+        self._collect_jobs(path_in, path_out, to_copy=to_copy, jobs=jobs, rows=rows, adopted={}, b_dry_run=True)
+
+        copies = [job for job in jobs if job.audio_format is None]
+        jobs = [job for job in jobs if job.audio_format is not None]
+        sizes = {job.path_in: self._job_bytes(job) for job in jobs + copies}
+        costs = {job.path_in: job_cost(job, sizes[job.path_in], b_header=False) for job in jobs}
+        jobs = order_longest_first(jobs, costs)
+
+        seconds = {job.path_in: estimate_seconds(job, costs.get(job.path_in, sizes[job.path_in]))
+                   for job in jobs + copies}
+        for job in jobs + copies:
+            if job.audio_format is None:
+                action = 'copy'
+            else:
+                action = 'retag' if job.b_retag_only else 'convert'
+            print(f"{action:<8}{sizes[job.path_in] / 1e6:>10.1f} MB{seconds[job.path_in]:>9.1f}s  {job.path_in}")
+
+        encode_seconds = sum(seconds[job.path_in] for job in jobs)
+        copy_seconds = sum(seconds[job.path_in] for job in copies)
+        # Longest first: the run can't be shorter than its longest job
+        wall_clock = max(encode_seconds / workers, max((seconds[job.path_in] for job in jobs), default=0.),
+                         copy_seconds / copy_workers)
+        print(f"{len(jobs)} files to convert or retag ({sum(sizes[job.path_in] for job in jobs) / 1e6:.1f} MB), "
+              f"{len(copies)} files to copy ({sum(sizes[job.path_in] for job in copies) / 1e6:.1f} MB); "
+              f"estimated duration {time.strftime('%H:%M:%S', time.gmtime(wall_clock))} with {workers} workers.")
+        return jobs + copies
+
+    def parse_dir_convert_budget(self, path_in, path_out, budget, priority='recent', to_copy=None, b_manifest=True,
+                                 b_dry_run=False, **kwargs):
+        """
+        Convert the albums, i.e., the directories directly below path_in, that fit in a given number of bytes on the
+        target, in order of priority, instead of the whole of path_in. See budget.py for how sizes are estimated.
+
+        Albums already on the target that are not selected are left in place, and are not counted in the budget.
+
+        :param path_in: the path to parse
+        :param path_out: the output path in which the folder structure found within path_in will be mirrored.
+        :param budget: number of bytes the converted library may take on the target, or a size such as '256G'.
+        :param priority: 'recent' (most recently modified albums first), 'name', or a function returning the
+        priority of an album directory (highest first), see budget.select_albums.
+        :param to_copy: an optional set of file extensions that should be copied from PATH_IN to PATH_OUT.
+        :param b_manifest: see parse_dir_convert; the manifest is also used to calibrate the size estimates.
+        :param b_dry_run: only report the selection.
+        :param kwargs: other arguments of parse_dir_convert.
+        :return: the selected album directories, in order of priority
+        """
+        budget = parse_size(budget)
+        to_copy = self._check_to_copy(to_copy)
+        if not os.path.isdir(path_in):
+            raise ValueError(f"Directory '{path_in}' does not exist.")
+        tree = TreeModel.scan(path_in)
+        rows = None
+        if b_manifest and os.path.isfile(os.path.join(path_out, MANIFEST_NAME)):
+            manifest = Manifest(path_out)
+            rows = manifest.load()
+            manifest.close()
+        # Target directories are only listed when an album needs them
+        albums, model = estimate_albums(tree, TreeModel(), path_in, path_out, to_copy, rows=rows)
+        if model.ratios:
+            print("Compression ratios: " + ", ".join(f"{bits} bit {ratio:.3f}"
+                                                     for bits, ratio in sorted(model.ratios.items())))
+        selected, skipped = select_albums(albums, budget, priority=priority)
+        report(selected, skipped, budget)
+        if os.path.isdir(path_out):
+            free = shutil.disk_usage(path_out).free
+            to_write = sum(album.size - album.size_done for album in selected)
+            if to_write > free:
+                print(f"Warning: {to_write / 1e9:.2f} GB to write, but only {free / 1e9:.2f} GB free on the target.")
+
+        album_dirs = [album.path for album in selected]
+        if not b_dry_run and album_dirs:
+            self.parse_dir_convert(path_in, path_out, to_copy=to_copy, b_manifest=b_manifest, subdirs=album_dirs,
+                                   b_longest_first=False, **kwargs)
+        return album_dirs
+
+    def verify(self, path_in, path_out, workers=None, device_streams=2, device_limits=None, b_decode=False,
+               since_ns=None, time_limit=None, b_full=False):
+        """
+        Verify that the FLAC files below path_out hold the audio of the WAV files they were converted from, see
+        verify.Verifier. Files verified by a previous run, that didn't change since, are skipped.
+
+        :param path_in: the root of the WAV library.
+        :param path_out: the output path in which the folder structure found within path_in is mirrored.
+        :param workers: number of threads verifying files; defaults to the number of CPUs.
+        :param device_streams: maximum number of files read at the same time from a single device.
+        :param device_limits: optional dictionary mapping a path to the maximum number of files read at the same time
+        from the device holding that path.
+        :param b_decode: decode the FLAC files, to check every frame stored on the target, instead of comparing
+        the MD5 the encoder stored in their header.
+        :param since_ns: also verify the files last verified before this time (time.time_ns()).
+        :param time_limit: number of seconds after which no more files are started.
+        :param b_full: verify all files.
+        :return: list of verify.VerifyResult
+        """
+        for path in (path_in, path_out):
+            if not os.path.isdir(path):
+                raise ValueError(f"Directory '{path}' does not exist.")
+        jobs = collect_jobs(path_in, path_out, lambda name: name[:-4] + '.flac' if name.lower().endswith('.wav')
+                            else None, b_wav_in=True)
+        verifier = Verifier(workers=workers, device_streams=device_streams, device_limits=device_limits,
+                            b_decode=b_decode)
+        results, left = verifier.run(jobs, path_out, since_ns=since_ns, time_limit=time_limit, b_full=b_full)
+        report_verify(results, left)
+        self.failed = [result.job.path_wav for result in results if result.status != Status.OK]
+        return results
+
+    def update_tags(self, path):
+        """
+        Update the tags of all FLAC files below path, which is the root of the library, to the ones derived from
+        their path.
+
+        :param path: the root of the FLAC library.
+        """
+        self.ref_path = path
+        self._parse_dir_update_tags(path)
+
+    def _resume_jobs(self, previous):
+        """
+        Get the jobs an interrupted run didn't finish (or that failed), and the manifest entries of those it did.
+
+        Jobs of which the source no longer exists are dropped. Sources modified since the interrupted run was planned
+        are converted again completely, with a manifest entry for their current size and modification time.
+
+        :param previous: the journal of the interrupted run, as returned by Journal.load().
+        :return: jobs, adopted manifest entries
+        """
+        header, records, done = previous
+        adopted = {k: ManifestEntry(*v) for k, v in header.get('adopted', {}).items()}
+        jobs = []
+        for record in records:
+            result = done.get(record['path_in'])
+            if result is None or not result['ok']:
+                job = self._job_from_record(record)
+                dir_info = self.tree.get(os.path.dirname(job.path_in))
+                if dir_info is None or os.path.basename(job.path_in) not in dir_info.files:
+                    print(f"Source no longer exists, skipped: [{job.path_in}]")
+                    continue
+                file_info = dir_info.file_info(os.path.basename(job.path_in))
+                if job.entry is not None and (job.entry.size, job.entry.mtime_ns) != tuple(file_info):
+                    job = ConvertJob(job.path_in, job.path_out, job.audio_format,
+                                     entry=job.entry._replace(size=file_info.size, mtime_ns=file_info.mtime_ns,
+                                                              content_hash=None))
+                jobs.append(job)
+            elif result['entry'] is not None:
+                adopted[os.path.relpath(record['path_in'], self.ref_path)] = ManifestEntry(*result['entry'])
+        return jobs, adopted
+
+    def _remove_orphans(self, previous):
+        """
+        Remove the temporary files left by the jobs an interrupted run didn't finish.
+        """
+        _, records, done = previous
+        for record in records:
+            if record['path_in'] in done:
+                continue
+            for temp_file in (record['path_out'] + TEMP_SUFFIX, record['path_out'] + COVER_TEMP_SUFFIX):
+                if os.path.isfile(temp_file):
+                    os.remove(temp_file)
+                    print(f"Removed incomplete file [{temp_file}]")
+
+    @classmethod
+    def _job_record(cls, job):
+        """
+        Convert a ConvertJob to a dictionary that can be stored in the journal.
+        """
+        record = job._asdict()
+        record['audio_format'] = None if job.audio_format is None else job.audio_format.value
+        record['entry'] = None if job.entry is None else list(job.entry)
+        return record
+
+    @classmethod
+    def _job_from_record(cls, record):
+        record = dict(record)
+        if record['audio_format'] is not None:
+            record['audio_format'] = Format(record['audio_format'])
+        if record['entry'] is not None:
+            record['entry'] = ManifestEntry(*record['entry'])
+        return ConvertJob(**record)
+
+    def _job_bytes(self, job):
+        """
+        Number of bytes a job reads from its source file, as far as known from the source tree.
+        """
+        if job.b_retag_only:
+            return 0
+        return self.tree.get(os.path.dirname(job.path_in)).file_info(os.path.basename(job.path_in)).size
+
+    def _plan_dedupe(self, jobs, manifest, path_out, workers=None):
+        """
+        Find the WAV files to encode that hold the same audio as another file, so that their audio is only encoded
+        once.
+
+        Files are matched on the hash of their PCM data (the manifest's content hash, so that hashes stored in the
+        manifest can be reused) and on their sample format.
+
+        :param jobs: the conversion jobs of the run.
+        :param manifest: the manifest of path_out, or None. Files converted by previous runs are used as the source
+        of the duplicates they hold the same audio as.
+        :param path_out: the output root.
+        :param workers: number of threads hashing files; defaults to the number of CPUs.
+        :return: the jobs to process first, in which duplicates of files converted before are set up to be derived
+        from them; list of (job, job of the file it duplicates) for the duplicates of files encoded in this run.
+        """
+        candidates = [job for job in jobs if job.audio_format == Format.WAV and not job.b_retag_only and
+                      job.prev_hash is None and job.source_out is None]
+        # Hashing is mostly I/O, and hashlib releases the GIL while hashing large blocks
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            keys = dict(zip(map(id, candidates), executor.map(self._audio_key, candidates)))
+
+        # Content hash -> output of a file converted by a previous run
+        converted = {}
+        if manifest is not None:
+            in_run = {os.path.relpath(job.path_in, self.ref_path) for job in jobs}
+            for source, row in manifest.load().items():
+                if row.content_hash and source not in in_run:
+                    converted.setdefault(row.content_hash, os.path.join(path_out, row.path_out))
+
+        # Audio key -> job encoding that audio in this run, or path of an output that holds it already
+        sources = {}
+        planned, duplicates = [], []
+        for job in jobs:
+            key = keys.get(id(job))
+            if key is None:
+                planned.append(job)
+                continue
+            if job.entry is not None:
+                job = job._replace(entry=job.entry._replace(content_hash=key[-1]))
+
+            source = sources.get(key)
+            if source is None:
+                source_out = converted.get(key[-1])
+                if source_out is not None and self._has_format(source_out, key):
+                    source = sources[key] = source_out
+            if source is None:
+                sources[key] = job
+                planned.append(job)
+            elif isinstance(source, str):
+                planned.append(job._replace(source_out=source))
+            else:
+                duplicates.append((job, source))
+
+        return planned, duplicates
+
+    def _audio_key(self, job):
+        """
+        Identify the audio of a WAV file: sample format and hash of its PCM data.
+
+        :return: tuple, or None if the file can't be parsed.
+        """
+        try:
+            wav_info = read_wav_header(job.path_in)
+        except (OSError, ValueError):
+            return None
+        content_hash = job.entry.content_hash if job.entry is not None else None
+        if not content_hash:
+            content_hash = hash_file(job.path_in, offset=wav_info.data_offset, size=wav_info.data_size)
+        return (wav_info.format_tag, wav_info.channels, wav_info.sample_rate, wav_info.bits_per_sample,
+                content_hash)
+
+    @classmethod
+    def _has_format(cls, path, key):
+        """
+        Check that a FLAC file has the sample format of an audio key, as returned by _audio_key.
+        """
+        from mutagen.flac import FLAC
+        try:
+            info = FLAC(path).info
+        except Exception:
+            return False
+        return (info.channels, info.sample_rate, info.bits_per_sample) == key[1:4]
+
+    def _finish_run(self, path_in, jobs, results, manifest, adopted, journal):
+        """
+        Collect the failed files, update the manifest and close the journal (if any), once all jobs of a run have
+        been processed.
+        """
+        self.failed = [job.path_in for job, result in zip(jobs, results) if not result.b_ok]
+
+        if manifest is not None:
+            with stage('manifest'):
+                entries = dict(adopted)
+                for job, result in zip(jobs, results):
+                    if result.b_ok and result.entry is not None:
+                        entries[self._relpath(job.path_in, path_in)] = result.entry
+                manifest.update(entries)
+                # Failed files may have left a broken output behind; make sure they are converted again next time
+                manifest.delete([self._relpath(e, path_in) for e in self.failed])
+                manifest.close()
+        # The run is complete; there is nothing left to resume
+        if journal is not None:
+            journal.close()
+
+        print()
+        if not self.failed:
+            print("All files converted successfully.")
+        else:
+            for e in self.failed:
+                print(f"Failed to process: [{e}]")
+
+    async def convert_async(self, path_in, path_out, b_add_cover=False, to_copy=None, max_encoders=None,
+                            max_io_per_device=2, device_limits=None, b_manifest=True, recorder=None, b_resume=False):
+        """
+        Asynchronous version of parse_dir_convert, for when source and target are different devices.
+
+        Encoders run as asyncio subprocesses, at most max_encoders at a time, while the reads, encodes and copies of
+        other files go on, so that neither device sits idle. Each device only gets a limited number of files read
+        or written at the same time, so that a slow target such as an SD card is never oversubscribed.
+
+        Usage: asyncio.run(w2f.convert_async(path_in=PATH_IN, path_out=PATH_OUT, device_limits={PATH_OUT: 1}))
+
+        :param path_in: the path to parse
+        :param path_out: the output path in which the folder structure found within path_in will be mirrored.
+        :param b_add_cover: try to add cover to converted FLAC files
+        :param to_copy: an optional set of file extensions that should be copied from PATH_IN to PATH_OUT.
+        :param max_encoders: maximum number of files being encoded at the same time; defaults to the number of CPUs.
+        :param max_io_per_device: maximum number of files being read from or written to a single device at the same
+        time.
+        :param device_limits: optional dictionary mapping a path to the maximum number of files being read from or
+        written to the device holding that path, overriding max_io_per_device for that device.
+        :param b_manifest: keep track of converted files in a manifest stored in path_out, see parse_dir_convert.
+        :param recorder: optional metrics.Recorder, see parse_dir_convert. Its profiler is not used, as jobs run
+        concurrently in threads of a single process.
+        :param b_resume: only process the files an interrupted previous run didn't finish, see parse_dir_convert.
+        :return:
+        """
+        recorder = Recorder() if recorder is None else recorder
+        with recorder.activate():
+            jobs, manifest, adopted, journal = self._start_run(path_in, path_out, b_add_cover=b_add_cover,
+                                                               to_copy=to_copy, b_manifest=b_manifest,
+                                                               b_resume=b_resume)
+
+        loop = asyncio.get_running_loop()
+        encoders = asyncio.Semaphore(max_encoders or os.cpu_count() or 1)
+        devices = DeviceSemaphores(max_io_per_device, limits=device_limits)
+        recorder.start(len(jobs), sum(self._job_bytes(job) for job in jobs))
+        self.profiler = None
+        results = await asyncio.gather(*[self._process_job_async(job, loop, encoders=encoders, devices=devices,
+                                                                 recorder=recorder, journal=journal)
+                                         for job in jobs])
+
+        with recorder.activate():
+            self._finish_run(path_in, jobs, results, manifest=manifest, adopted=adopted, journal=journal)
+        recorder.finish()
+
+    async def _process_job_async(self, job, loop, encoders, devices, recorder, journal):
+        """
+        Process a single job, once an encoder slot (if needed) and the source and target devices are available.
+
+        WAV files are streamed to an asyncio ffmpeg subprocess; all other jobs are handed to _process_job, in a
+        thread of the default executor.
+
+        :return: JobResult
+        """
+        b_encode = job.audio_format is not None and not job.b_retag_only
+        b_stream = b_encode and job.prev_hash is None and job.source_out is None and \
+            self.encoder == Encoder.STREAM and job.audio_format == Format.WAV
+
+        held = []
+        try:
+            # Wait for a free encoder first, so as not to keep a device slot while waiting
+            if b_encode:
+                await encoders.acquire()
+                held.append(encoders)
+            for sem in devices.for_paths(job.path_in, job.path_out):
+                await sem.acquire()
+                held.append(sem)
+
+            result = None
+            if b_stream:
+                try:
+                    result = await self._encode_stream_async(job, loop)
+                except ValueError as e:
+                    print(f"Can't stream '{os.path.basename(job.path_in)}' ({e}), falling back to pydub.")
+            if result is None:
+                result = await loop.run_in_executor(None, self._process_job, job)
+        except Exception as e:
+            # E.g., the source vanished or can't be read: only this file fails, the other jobs go on
+            print(e.__class__.__name__)
+            print(e)
+            for temp_file in (job.path_out + TEMP_SUFFIX, job.path_out + COVER_TEMP_SUFFIX):
+                if os.path.isfile(temp_file):
+                    os.remove(temp_file)
+            result = JobResult(False)
+        finally:
+            for sem in reversed(held):
+                sem.release()
+        recorder.record(result.metrics, result.b_ok)
+        journal.done(job.path_in, result.b_ok, result.entry)
+        return result
+
+    async def _encode_stream_async(self, job, loop):
+        """
+        Asynchronous version of _encode_stream, for a complete job.
+
+        Blocks are read in the default executor rather than through a memory mapping, so that waiting for the
+        source device never blocks the event loop.
 
-        # First, check directory for presence of image file
+        :return: JobResult
+        """
+        full_path_in, full_path_out = job.path_in, job.path_out
+        # Jobs are interleaved in the event loop's thread, so this one's metrics are recorded explicitly
+        start = time.perf_counter()
+        metrics = FileMetrics(full_path_in, kind='convert')
+        with metrics.stage('extract_tags'):
+            tags, cover_pic = await loop.run_in_executor(None, self._extract_tags, full_path_in, job.audio_format)
+        wav_info = read_wav_header(full_path_in)
+        raw_format = PCM_RAW_FORMATS.get((wav_info.format_tag, wav_info.bits_per_sample))
+        if raw_format is None:
+            raise ValueError(f"unsupported WAV format {wav_info.format_tag}/{wav_info.bits_per_sample} bit")
+
+        print(f"Converting '{os.path.basename(full_path_in)}' to\n\t[{full_path_out}]")
+
+        temp_file = full_path_out + TEMP_SUFFIX
+        args = self._stream_args(wav_info, raw_format, tags, cover_pic, temp_file)
+        content_hash = hashlib.blake2b(digest_size=16)
+        try:
+            with metrics.stage('encode'):
+                await self._feed_encoder_async(args, full_path_in, wav_info, content_hash, loop)
+            os.replace(temp_file, full_path_out)
+        except Exception as e:
+            print(e.__class__.__name__)
+            print(e)
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+            metrics.seconds = time.perf_counter() - start
+            return JobResult(False, metrics=metrics)
+
+        if cover_pic is not None:
+            print(f"Attempted to add cover from image [{cover_pic}]...")
+
+        metrics.bytes_in = wav_info.data_offset + wav_info.data_size
+        metrics.bytes_out = os.path.getsize(full_path_out)
+        metrics.seconds = time.perf_counter() - start
+        if job.entry is None:
+            return JobResult(True, metrics=metrics)
+        return JobResult(True, job.entry._replace(content_hash=content_hash.hexdigest()), metrics=metrics)
+
+    async def _feed_encoder_async(self, args, full_path_in, wav_info, content_hash, loop):
+        """
+        Run the ffmpeg command line 'args' as an asyncio subprocess, feeding it the PCM data of a WAV file.
+        """
+        proc = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE)
+        try:
+            with open(full_path_in, 'rb') as f:
+                f.seek(wav_info.data_offset)
+                remaining = wav_info.data_size
+                while remaining > 0:
+                    block = await loop.run_in_executor(None, f.read, min(self.block_size, remaining))
+                    if not block:
+                        break
+                    remaining -= len(block)
+                    content_hash.update(block)
+                    proc.stdin.write(block)
+                    await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg quit early; its error message is reported below
+            pass
+        proc.stdin.close()
+        stderr = await proc.stderr.read()
+        ret = await proc.wait()
+        if ret != 0:
+            raise RuntimeError(f"ffmpeg exited with code {ret}: {stderr.decode(errors='replace').strip()}")
+
+    def _collect_jobs(self, path_in, path_out, to_copy, jobs: list, rows=None, adopted=None, b_dry_run=False):
+        """
+        Walk a directory tree, and add a ConvertJob to 'jobs' for each file that needs to be converted or copied.
+        Output directories are created along the way.
+
+        :param path_in: the path to parse
+        :param path_out: the output path in which the folder structure found within self.ref_path will be mirrored.
+        :param to_copy: set of file extensions that should be copied from PATH_IN to PATH_OUT.
+        :param jobs: list to which the jobs are appended.
+        :param rows: the content of the manifest, as returned by Manifest.load(), or None if no manifest is used.
+        :param adopted: dictionary to which ManifestEntry objects are added for files that were converted before the
+        manifest was used, and that don't need to be converted again.
+        :param b_dry_run: don't create the output directories.
+        :return:
+        """
+        stack = [path_in]
+        while stack:
+            dir_path = stack.pop()
+            dir_info = self.tree.get(dir_path)
+            stack.extend(os.path.join(dir_path, elem) for elem in reversed(dir_info.subdirs))
+            jobs.extend(self._dir_jobs(dir_path, dir_info, path_out, to_copy, rows=rows, adopted=adopted,
+                                       b_dry_run=b_dry_run))
+
+    def _iter_jobs(self, path_in, path_out, to_copy, manifest=None, order='name'):
+        """
+        Walk a directory tree one directory at a time, and yield a ConvertJob for each file that needs to be converted
+        or copied, without holding the listing of the tree or the content of the manifest in memory: the manifest
+        entries of a directory are loaded when it is reached, and the files adopted in it (see _collect_jobs) are
+        written to the manifest when it is done.
+
+        :param path_in: the path to parse
+        :param path_out: the output path in which the folder structure found within self.ref_path will be mirrored.
+        :param to_copy: set of file extensions that should be copied from PATH_IN to PATH_OUT.
+        :param manifest: the Manifest of path_out, or None if no manifest is used.
+        :param order: order in which directories are walked, see walk.iter_dirs.
+        :return: generator of ConvertJob
+        """
+        adopted = {}
+        for dir_path, dir_info in iter_dirs(path_in, order=order):
+            self.tree.put(dir_info)
+            rows = None
+            if manifest is not None:
+                rows = manifest.load_dir('' if dir_path == self.ref_path else self._relpath(dir_path, self.ref_path))
+            yield from self._dir_jobs(dir_path, dir_info, path_out, to_copy, rows=rows, adopted=adopted)
+            if adopted:
+                manifest.update(adopted)
+                adopted.clear()
+
+    def _dir_jobs(self, path_in, dir_info, path_out, to_copy, rows=None, adopted=None, b_dry_run=False):
+        """
+        Yield a ConvertJob for each file of a single directory that needs to be converted or copied, creating its
+        output directory if needed; see _collect_jobs for the parameters.
 
-        for elem in os.listdir(path_in):
+        :param dir_info: tree.DirInfo of the directory.
+        """
+        full_dir_out = path_in.replace(self.ref_path, path_out)
+        for elem in dir_info.files:
             full_path_in = os.path.join(path_in, elem)
-            # Get file extension, if applicable (i.e., we're not dealing with a directory)
+            # Get file extension
             ext = elem.rsplit('.', 1)
             if len(ext) == 2:
                 ext = ext[1].lower()
             else:
                 ext = ''
 
-            # If the element is a directory, recursively parse it
-            if os.path.isdir(full_path_in):
-                self.parse_dir_convert(full_path_in, path_out, to_copy=to_copy, _b_initial=False)
-            elif ext == "wav":
-                full_dir_out = os.path.dirname(full_path_in).replace(self.ref_path, path_out)
-                if not os.path.exists(full_dir_out):
-                    os.makedirs(full_dir_out)
-                # Don't do ".replace('.wav', '.flac'), because that way you miss the cases
-                # where the original file has '.WAV' in uppercase.
-                full_path_out = os.path.join(full_dir_out, elem)[:-4] + '.flac'
+            if ext in ("wav", "mpga") or ext in to_copy:
+                if not self.out_tree.isdir(full_dir_out):
+                    if not b_dry_run:
+                        os.makedirs(full_dir_out)
+                    # In a dry run, the directory is only added to the model, as if it had been created
+                    self.out_tree.add_dir(full_dir_out)
+                if ext in ("wav", "mpga"):
+                    # Don't do ".replace('.wav', '.flac'), because that way you miss the cases
+                    # where the original file has '.WAV' in uppercase.
+                    full_path_out = os.path.join(full_dir_out, elem)[:-4] + '.flac'
+                    audio_format = Format.WAV if ext == "wav" else Format.MPGA
+                    if rows is not None:
+                        job = self._plan_manifest_job(full_path_in, full_path_out, path_out, audio_format,
+                                                      rows=rows, adopted=adopted)
+                        if job is not None:
+                            yield job
+                        continue
+                else:
+                    # Files to copy are skipped if the copy is up to date
+                    full_path_out = os.path.join(full_dir_out, elem)
+                    dir_info_out = self.out_tree.get(full_dir_out)
+                    info_out = dir_info_out.file_info(elem) if elem in dir_info_out.files else None
+                    if needs_copy(dir_info.file_info(elem), info_out):
+                        yield ConvertJob(full_path_in, full_path_out, None)
+                    continue
                 # File already exists? Then skip.
-                if os.path.isfile(full_path_out):
+                if self.out_tree.isfile(full_path_out):
                     continue
+                yield ConvertJob(full_path_in, full_path_out, audio_format)
 
-                tags, cover_pic = self._extract_tags(full_path_in, audio_format=Format.WAV)
+    @classmethod
+    def _relpath(cls, path, root):
+        """
+        os.path.relpath, without normalizing both paths first in the common case of a path built below root.
+        """
+        if path.startswith(root) and path[len(root):len(root) + 1] == os.sep:
+            return path[len(root) + 1:]
+        return os.path.relpath(path, root)
+
+    def _plan_manifest_job(self, full_path_in, full_path_out, path_out, audio_format, rows, adopted):
+        """
+        Decide what needs to happen to an audio file, based on its entry in the manifest.
+
+        :return: a ConvertJob, or None if the file can be skipped.
+        """
+        source = self._relpath(full_path_in, self.ref_path)
+        file_info = self.tree.get(os.path.dirname(full_path_in)).file_info(os.path.basename(full_path_in))
+        tags, cover_pic = self._extract_tags(full_path_in, audio_format=audio_format, b_prepare_cover=False)
+        cover_info = None
+        if cover_pic is not None:
+            cover_info = self.tree.get(os.path.dirname(cover_pic)).file_info(os.path.basename(cover_pic))
+        entry = ManifestEntry(size=file_info.size, mtime_ns=file_info.mtime_ns, content_hash=None,
+                              path_out=self._relpath(full_path_out, path_out),
+                              tag_hash=hash_tags(tags), cover_hash=hash_cover(cover_pic, cover_info, self.ref_path))
+
+        # The output directory was already listed by _dir_jobs
+        b_out_exists = self.out_tree.isfile(full_path_out)
+        row = rows.get(source)
+        if row is None:
+            # Files converted before the manifest was used are adopted, unless they weren't written completely
+            if b_out_exists and self._is_complete_output(full_path_in, full_path_out, audio_format):
+                adopted[source] = entry
+                return None
+            return ConvertJob(full_path_in, full_path_out, audio_format, entry=entry)
+
+        b_retag = row.tag_hash != entry.tag_hash
+        if row.cover_hash != entry.cover_hash and row.path_out == entry.path_out and row.size == entry.size and \
+                row.mtime_ns == entry.mtime_ns and b_out_exists:
+            # Only the cover changed: the audio frames of the output are copied into a new file with the new cover
+            # (and tags), see _derive_output
+            return ConvertJob(full_path_in, full_path_out, audio_format, entry=entry._replace(
+                content_hash=row.content_hash), source_out=full_path_out)
+        # Outputs deleted from the target, e.g., to free space, are converted again
+        if not b_out_exists or row.path_out != entry.path_out or row.cover_hash != entry.cover_hash or \
+                row.size != entry.size:
+            if row.size == entry.size and row.mtime_ns == entry.mtime_ns:
+                # The audio didn't change, so its hash is still valid, e.g., to find duplicates
+                entry = entry._replace(content_hash=row.content_hash)
+            return ConvertJob(full_path_in, full_path_out, audio_format, entry=entry)
+        if row.mtime_ns != entry.mtime_ns:
+            # Touched, but maybe not modified: let the worker compare content hashes before re-encoding
+            if not row.content_hash:
+                return ConvertJob(full_path_in, full_path_out, audio_format, entry=entry)
+            return ConvertJob(full_path_in, full_path_out, audio_format, b_retag_only=b_retag, entry=entry,
+                              prev_hash=row.content_hash)
+        if b_retag:
+            return ConvertJob(full_path_in, full_path_out, audio_format, b_retag_only=True,
+                              entry=entry._replace(content_hash=row.content_hash))
+        return None
+
+    @classmethod
+    def _is_complete_output(cls, full_path_in, full_path_out, audio_format):
+        """
+        Check that a FLAC file was written completely: its header should give the number of samples of the source,
+        and its last frame should end at that sample. The header is written first, so it is complete even in a file
+        that was cut off.
+        """
+        try:
+            total_samples = read_streaminfo(full_path_out).total_samples
+            if audio_format == Format.WAV:
+                if total_samples != read_wav_header(full_path_in).nb_frames:
+                    return False
+            elif total_samples <= 0:
+                return False
+            return flac_end_sample(full_path_out) == total_samples
+        except Exception:
+            return False
+
+    def _process_job(self, job):
+        """
+        Convert or copy a single file, recording the time spent in each stage and the number of bytes read and
+        written.
 
-                print(f"Converting '{elem}' to\n\t[{full_path_out}]")
+        :param job: the ConvertJob to process.
+        :return: JobResult, including its metrics
+        """
+        if job.audio_format is None:
+            kind = 'copy'
+        else:
+            kind = 'retag' if job.b_retag_only else 'convert'
+        metrics = FileMetrics(job.path_in, kind=kind)
+        with metrics.activate():
+            if self.profiler is not None and self.profiler.should_profile(job.path_in):
+                result = self.profiler.run(metrics, self._run_job, job)
+            else:
+                result = self._run_job(job)
+        if result.b_ok:
+            try:
+                if kind != 'retag':
+                    metrics.bytes_in = os.path.getsize(job.path_in)
+                metrics.bytes_out = os.path.getsize(job.path_out)
+            except OSError:
+                pass
+        return result._replace(metrics=metrics)
+
+    def _run_job(self, job):
+        """
+        Convert or copy a single file.
 
-                # Convert to flac
-                # ### PyDub
+        :param job: the ConvertJob to process.
+        :return: JobResult
+        """
+        elem = os.path.basename(job.path_in)
+        full_path_in, full_path_out = job.path_in, job.path_out
+
+        # Is this a file that should be copied?
+        if job.audio_format is None:
+            print(f"Copying [{full_path_in}] to\n\t[{full_path_out}]")
+            with stage('copy'):
+                copy_file(full_path_in, full_path_out)
+            return JobResult(True)
+
+        if job.source_out is not None:
+            return self._derive_output(job)
+
+        # Only re-tag files whose audio did not change
+        b_encode = not job.b_retag_only
+        content_hash = None
+        if job.prev_hash is not None:
+            content_hash = self._hash_source(full_path_in, job.audio_format)
+            b_encode = content_hash != job.prev_hash
+            if not b_encode and not job.b_retag_only:
+                return JobResult(True, job.entry._replace(content_hash=content_hash))
+        if not b_encode:
+            print(f"Updating tags of [{full_path_out}]")
+            with stage('extract_tags'):
+                tags, _ = self._extract_tags(full_path_in, audio_format=job.audio_format, b_prepare_cover=False)
+            try:
+                if not self._write_tags(full_path_out, tags):
+                    print("\tTags already up to date.")
+            except Exception as e:
+                print(e.__class__.__name__)
+                print(e)
+                return JobResult(False)
+            entry = job.entry
+            if content_hash is not None:
+                entry = entry._replace(content_hash=content_hash)
+            return JobResult(True, entry)
+
+        with stage('extract_tags'):
+            tags, cover_pic = self._extract_tags(full_path_in, audio_format=job.audio_format)
+
+        print(f"Converting '{elem}' to\n\t[{full_path_out}]")
+
+        # Convert to flac
+        # Unless streamed, the file is encoded to a temporary file, that only replaces full_path_out once complete,
+        # cover included
+        temp_file = full_path_out + TEMP_SUFFIX
+        content_hash = None
+        analysis = None
+        b_streamed = False
+        try:
+            if self.encoder == Encoder.STREAM and job.audio_format == Format.WAV:
                 try:
-                    song = AudioSegment.from_wav(full_path_in)
-
-                    song.export(full_path_out, format='flac', tags=tags)
-                    # Add cover image
-                    if cover_pic is not None:
-                        # Using FLAC library doesn't make the image show up on Sony Walkman device
-                        # song = FLAC(full_path_out)
-                        # song.add_picture(cover_pic)
-                        # song.save()
-
-                        # ffmpeg device to use
-                        # ffmpeg -i song.flac -i image.jpg -map_metadata 0 -map 0 -map 1 -acodec copy -disposition:v attached_pic song_with_cover.flac
-                        temp_file = full_path_out[:-5] + '_temp.flac'
-                        ffmpeg = (
-                            FFmpeg()
-                            .input(full_path_out)
-                            .input(cover_pic)
-                            .output(temp_file,
-                                {'map_metadata': 0,
-                                 'acodec': 'copy',
-                                 'disposition:v': 'attached_pic'}
-                            )
-                        )
-
-                        # For debugging purposes
-                        # @ffmpeg.on("start")
-                        # def on_start(arguments: list[str]):
-                        #     print("arguments:", arguments)
-                        #
-                        # @ffmpeg.on("stderr")
-                        # def on_stderr(line):
-                        #     print("stderr:", line)
-                        #
-                        # @ffmpeg.on("progress")
-                        # def on_progress(progress):
-                        #     print(progress)
-                        #
-                        # @ffmpeg.on("completed")
-                        # def on_completed():
-                        #     print("completed")
-                        #
-                        # @ffmpeg.on("terminated")
-                        # def on_terminated():
-                        #     print("terminated")
-
-                        ffmpeg.execute()
-
-                        os.remove(full_path_out)
-                        os.rename(temp_file, full_path_out)
-
-                        print(f"Attempted to add cover from image [{cover_pic}]...")
+                    # Encodes, tags and adds the cover in a single pass
+                    content_hash, analysis = self._encode_stream(full_path_in, full_path_out, tags,
+                                                                 cover_pic=cover_pic, b_analyze=self.b_analyze)
+                    b_streamed = True
+                except ValueError as e:
+                    print(f"Can't stream '{elem}' ({e}), falling back to pydub.")
+            if not b_streamed:
+                if self.b_analyze and job.audio_format == Format.WAV:
+                    # Not streamed, so the file is read once more for the analysis
+                    try:
+                        with stage('analyze'):
+                            analysis = analyze_file(full_path_in)
+                    except ValueError as e:
+                        print(f"Can't analyse '{elem}' ({e}).")
+                self._encode_pydub(full_path_in, temp_file, tags)
+
+            # Add cover image
+            if cover_pic is None or b_streamed:
+                pass
+            elif job.audio_format == Format.MPGA:
+                from mutagen.flac import FLAC
+                with stage('tags'):
+                    song = FLAC(temp_file)
+                    song.add_picture(self._cover_picture(cover_pic))
+                    song.save(padding=self._keep_padding)
+            else:
+                # Using FLAC library doesn't make the image show up on Sony Walkman device
+                # song = FLAC(full_path_out)
+                # song.add_picture(cover_pic)
+                # song.save()
+
+                # ffmpeg device to use
+                # ffmpeg -i song.flac -i image.jpg -map_metadata 0 -map 0 -map 1 -acodec copy -disposition:v attached_pic song_with_cover.flac
+                from ffmpeg import FFmpeg
+                cover_temp_file = full_path_out + COVER_TEMP_SUFFIX
+                ffmpeg = (
+                    FFmpeg()
+                    .input(temp_file)
+                    .input(cover_pic)
+                    .output(cover_temp_file,
+                        {'map_metadata': 0,
+                         'acodec': 'copy',
+                         'disposition:v': 'attached_pic',
+                         'metadata_header_padding': self.padding,
+                         'f': 'flac'}
+                    )
+                )
+
+                # For debugging purposes
+                # @ffmpeg.on("start")
+                # def on_start(arguments: list[str]):
+                #     print("arguments:", arguments)
+                #
+                # @ffmpeg.on("stderr")
+                # def on_stderr(line):
+                #     print("stderr:", line)
+                #
+                # @ffmpeg.on("progress")
+                # def on_progress(progress):
+                #     print(progress)
+                #
+                # @ffmpeg.on("completed")
+                # def on_completed():
+                #     print("completed")
+                #
+                # @ffmpeg.on("terminated")
+                # def on_terminated():
+                #     print("terminated")
+
+                with stage('remux'):
+                    ffmpeg.execute()
+
+                os.replace(cover_temp_file, temp_file)
+
+            if not b_streamed:
+                if analysis is not None:
+                    self._write_analysis_tags(temp_file, analysis.tags())
+                os.replace(temp_file, full_path_out)
+            if cover_pic is not None:
+                print(f"Attempted to add cover from image [{cover_pic}]...")
 
-                except Exception as e:
-                    print(e.__class__.__name__)
-                    print(e)
-                    self.failed.append(full_path_in)
+            if job.entry is not None and content_hash is None:
+                content_hash = self._hash_source(full_path_in, job.audio_format)
 
-                # ### Python Audio Tools
-                # audio_file = audiotools.open(full_path_in)
-                # audio_file.convert(full_path_out, audiotools.FlacAudio)
-
-            elif ext == "mpga":
-                full_dir_out = os.path.dirname(full_path_in).replace(self.ref_path, path_out)
-                if not os.path.exists(full_dir_out):
-                    os.makedirs(full_dir_out)
-                # Don't do ".replace('.wav', '.flac'), because that way you miss the cases
-                # where the original file has '.WAV' in uppercase.
-                full_path_out = os.path.join(full_dir_out, elem)[:-4] + '.flac'
-                # File already exists? Then skip.
-                if os.path.isfile(full_path_out):
-                    continue
+        except Exception as e:
+            print(e.__class__.__name__)
+            print(e)
+            for f in (temp_file, full_path_out + COVER_TEMP_SUFFIX):
+                if os.path.isfile(f):
+                    os.remove(f)
+            return JobResult(False)
 
-                tags, cover_pic = self._extract_tags(full_path_in, audio_format=Format.MPGA)
+        # ### Python Audio Tools
+        # audio_file = audiotools.open(full_path_in)
+        # audio_file.convert(full_path_out, audiotools.FlacAudio)
 
-                print(f"Converting '{elem}' to\n\t[{full_path_out}]")
+        if job.entry is None:
+            return JobResult(True, analysis=analysis)
+        return JobResult(True, job.entry._replace(content_hash=content_hash), analysis=analysis)
 
-                # Convert to flac
-                # ### PyDub
+    def _derive_output(self, job):
+        """
+        Create the output of a job from an encoded FLAC file holding the same audio (job.source_out), with the job's
+        own tags and cover, instead of encoding the source. job.source_out may be the output itself, when only its
+        cover changed.
+
+        When analysing, the ReplayGain track tags come from the analysis of the file job.source_out was encoded from
+        in this run, or else from an analysis of the source; otherwise they are copied from job.source_out. Its album
+        tags are only kept if it is the output itself: those of another file belong to the album of that file.
+
+        Without a cover, the FLAC file is cloned and re-tagged. With a cover, ffmpeg copies its audio frames
+        into a new file, so that the cover shows up on the same devices as that of encoded files.
+
+        :return: JobResult
+        """
+        full_path_in, full_path_out = job.path_in, job.path_out
+        with stage('extract_tags'):
+            tags, cover_pic = self._extract_tags(full_path_in, audio_format=job.audio_format)
+
+        b_self = job.source_out == full_path_out
+        if b_self:
+            print(f"Updating cover of [{full_path_out}]")
+        else:
+            print(f"Deriving '{os.path.basename(full_path_in)}' from\n\t[{job.source_out}]")
+
+        temp_file = full_path_out + TEMP_SUFFIX
+        analysis = None
+        try:
+            from mutagen.flac import FLAC
+            if self.b_analyze and not b_self and job.audio_format == Format.WAV:
+                analysis = self._analyses.get(job.source_out)
+                if analysis is None:
+                    # Derived from a file converted by a previous run
+                    try:
+                        with stage('analyze'):
+                            analysis = analyze_file(full_path_in)
+                    except ValueError as e:
+                        print(f"Can't analyse '{os.path.basename(full_path_in)}' ({e}).")
+            if analysis is not None:
+                analysis_tags = analysis.tags()
+            else:
+                with stage('tags'):
+                    analysis_tags = self._analysis_tags(FLAC(job.source_out).tags)
+                if not b_self:
+                    analysis_tags = {k: v for k, v in analysis_tags.items() if k not in ALBUM_ANALYSIS_TAGS}
+
+            if cover_pic is None:
+                with stage('copy'):
+                    clone_file(job.source_out, temp_file)
+                with stage('tags'):
+                    song = FLAC(temp_file)
+                    song.clear()
+                    song.clear_pictures()
+                    song.update(tags)
+                    song.update(analysis_tags)
+                    song.save(padding=self._keep_padding)
+            else:
+                args = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-y',
+                        '-i', job.source_out, '-i', cover_pic, '-map', '0:a', '-map', '1:v',
+                        '-disposition:v', 'attached_pic', '-map_metadata', '-1']
+                tags = dict(tags, **analysis_tags)
+                for k, v in tags.items():
+                    args += ['-metadata', f'{k}={v}']
+                args += ['-c:a', 'copy', '-metadata_header_padding', str(self.padding), '-f', 'flac', temp_file]
+                with stage('remux'):
+                    proc = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                if proc.returncode != 0:
+                    raise RuntimeError(f"ffmpeg exited with code {proc.returncode}: "
+                                       f"{proc.stderr.decode(errors='replace').strip()}")
+            os.replace(temp_file, full_path_out)
+        except Exception as e:
+            print(e.__class__.__name__)
+            print(e)
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+            return JobResult(False)
+
+        return JobResult(True, job.entry, analysis=analysis)
+
+    def _cover_picture(self, cover_pic):
+        """
+        Create a FLAC Picture from a prepared cover image, reusing the bytes read for the previous track.
+        """
+        from mutagen import id3
+        from mutagen.flac import Picture
+        pic = Picture()
+        pic.data = self.cover_cache.read(cover_pic)
+        pic.type = id3.PictureType.COVER_FRONT
+        pic.mime = u"image/jpeg"
+        return pic
+
+    @classmethod
+    def _hash_source(cls, full_path_in, audio_format):
+        """
+        Hash the audio data of a source file: the 'data' chunk for WAV files, the complete file otherwise.
+        """
+        with stage('hash'):
+            if audio_format == Format.WAV:
                 try:
-                    song = AudioSegment.from_wav(full_path_in)
+                    wav_info = read_wav_header(full_path_in)
+                    return hash_file(full_path_in, offset=wav_info.data_offset, size=wav_info.data_size)
+                except ValueError:
+                    pass
+            return hash_file(full_path_in)
+
+    def _write_tags(self, path, tags):
+        """
+        Replace the tags of a FLAC file, unless they are already identical.
 
-                    song.export(full_path_out, format='flac', tags=tags)
-                    # Add cover image
-                    if cover_pic is not None:
-                        song = FLAC(full_path_out)
-                        song.add_picture(cover_pic)
-                        song.save()
+        If the new tags fit in the file's padding, only the metadata blocks at the start of the file are rewritten;
+        the audio data is only moved when the padding is too small.
+
+        :return: True if the file was modified, False if its tags were already up to date.
+        """
+        from mutagen.flac import FLAC
+        with stage('tags'):
+            song = FLAC(path)
+            if self._tags_equal(song.tags, tags):
+                return False
+            analysis_tags = self._analysis_tags(song.tags)
+            song.clear()
+            song.update(tags)
+            song.update(analysis_tags)
+            song.save(padding=self._keep_padding)
+        return True
+
+    def _write_analysis_tags(self, path, tags):
+        """
+        Add the tags computed by the analysis to a FLAC file, in place if they fit in its padding.
+        """
+        from mutagen.flac import FLAC
+        with stage('tags'):
+            song = FLAC(path)
+            song.update(tags)
+            song.save(padding=self._keep_padding)
 
+    @classmethod
+    def _analysis_tags(cls, comments):
+        """
+        Get the tags written by the analysis from the Vorbis comments of a FLAC file (or None), to keep them when
+        its other tags are replaced.
+        """
+        current = {} if comments is None else comments.as_dict()
+        return {k: v[0] for k, v in current.items() if k in ANALYSIS_TAGS}
+
+    def _write_album_gains(self, jobs, results):
+        """
+        Write the ReplayGain album tags of each output directory of which all WAV files were analysed in this run.
+        """
+        albums = {}
+        for job, result in zip(jobs, results):
+            if result.b_ok and result.analysis is not None:
+                albums.setdefault(os.path.dirname(job.path_in), []).append((job.path_out, result.analysis))
+        for dir_in, tracks in albums.items():
+            nb_tracks = self.tree.get(dir_in).ext_counts.get(Format.WAV.value, 0)
+            if len(tracks) < nb_tracks:
+                print(f"Only {len(tracks)} of {nb_tracks} tracks of [{dir_in}] were analysed, album gain not updated.")
+                continue
+            tags = album_tags([analysis for _, analysis in tracks])
+            for path_out, _ in tracks:
+                try:
+                    self._write_analysis_tags(path_out, tags)
                 except Exception as e:
                     print(e.__class__.__name__)
                     print(e)
-                    self.failed.append(full_path_in)
+                    self.failed.append(path_out)
 
-            # Is this a file that should be copied?
-            elif ext in to_copy:
-                full_dir_out = os.path.dirname(full_path_in).replace(self.ref_path, path_out)
-                if not os.path.exists(full_dir_out):
-                    os.makedirs(full_dir_out)
-                full_path_out = os.path.join(full_dir_out, elem)
-                if os.path.isfile(full_path_out):
-                    continue
-                print(f"Copying [{full_path_in}] to\n\t[{full_path_out}]")
-                shutil.copyfile(full_path_in, full_path_out)
+    @classmethod
+    def _tags_equal(cls, comments, tags):
+        """
+        Compare the Vorbis comments of a FLAC file (or None) with tags as computed by _extract_tags.
+        """
+        current = {} if comments is None else comments.as_dict()
+        current = {k: v for k, v in current.items() if k not in IGNORED_TAGS}
+        return current == {k.lower(): [v] for k, v in tags.items()}
 
-        if _b_initial:
-            print()
-            if not self.failed:
-                print("All files converted successfully.")
-            else:
-                for e in self.failed:
-                    print(f"Failed to process: [{e}]")
+    def _keep_padding(self, info):
+        """
+        Padding policy for mutagen's save(): keep the file size unchanged as long as the metadata fits, so that it is
+        written in place, and reserve self.padding bytes again otherwise.
+        """
+        return info.padding if info.padding >= 0 else self.padding
+
+    def _encode_pydub(self, full_path_in, full_path_out, tags):
+        # ### PyDub
+        from pydub import AudioSegment
+        with stage('decode'):
+            song = AudioSegment.from_wav(full_path_in)
+        with stage('encode'):
+            song.export(full_path_out, format='flac', tags=tags,
+                        parameters=self.profile.ffmpeg_args() + ['-metadata_header_padding', str(self.padding)])
+
+    def _encode_stream(self, full_path_in, full_path_out, tags, cover_pic=None, b_analyze=False):
+        """
+        Encode a WAV file to FLAC by piping its PCM data, one block at a time, into an ffmpeg process.
+
+        The WAV file is memory-mapped, and each block is handed to the encoder as a slice of that mapping, so
+        that peak memory use is bounded by the block size, however long the track is.
+
+        ffmpeg writes the final FLAC file, including its tags and cover, in a single pass. It writes to a temporary
+        file in the target directory, which is renamed to full_path_out once complete.
+
+        :param full_path_in: the WAV file to encode
+        :param full_path_out: the FLAC file to write
+        :param tags: the tags to write to the FLAC file
+        :param cover_pic: optional path to the (prepared) cover image to embed
+        :param b_analyze: analyse the blocks of PCM data on their way to the encoder (see analysis.PCMAnalyzer),
+        write the ReplayGain tags of the track, and check the MD5 of the PCM data against the one of the FLAC file.
+        :return: hash of the PCM data, as computed by manifest.hash_file; analysis.TrackAnalysis, or None
+        """
+        wav_info = read_wav_header(full_path_in)
+        raw_format = PCM_RAW_FORMATS.get((wav_info.format_tag, wav_info.bits_per_sample))
+        if raw_format is None:
+            raise ValueError(f"unsupported WAV format {wav_info.format_tag}/{wav_info.bits_per_sample} bit")
+        analyzer = None
+        if b_analyze:
+            # ffmpeg encodes 8 bit audio to 16 bit FLAC files, its FLAC encoder has no 8 bit sample format
+            analyzer = PCMAnalyzer(wav_info, full_path_in,
+                                   flac_bits_per_sample=16 if wav_info.bits_per_sample == 8 else None)
+
+        temp_file = full_path_out + TEMP_SUFFIX
+        args = self._stream_args(wav_info, raw_format, tags, cover_pic, temp_file)
+
+        data_start = wav_info.data_offset
+        data_end = wav_info.data_offset + wav_info.data_size
+        content_hash = hashlib.blake2b(digest_size=16)
+        with stage('encode'):
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                with open(full_path_in, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, 'madvise'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    with memoryview(mm) as view:
+                        for offset in range(data_start, data_end, self.block_size):
+                            with view[offset:min(offset + self.block_size, data_end)] as block:
+                                content_hash.update(block)
+                                proc.stdin.write(block)
+                                if analyzer is not None:
+                                    analyzer.update(block)
+            except BrokenPipeError:
+                # ffmpeg quit early; its error message is reported below
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+                stderr = proc.stderr.read()
+                ret = proc.wait()
+        if ret != 0:
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+            raise RuntimeError(f"ffmpeg exited with code {ret}: {stderr.decode(errors='replace').strip()}")
+
+        analysis = None
+        if analyzer is not None:
+            from mutagen.flac import FLAC
+            with stage('analyze'):
+                analysis = analyzer.finish()
+            with stage('tags'):
+                song = FLAC(temp_file)
+                # Encoders may leave the MD5 unset (0)
+                if song.info.md5_signature and song.info.md5_signature != int(analysis.md5, 16):
+                    os.remove(temp_file)
+                    raise RuntimeError(f"MD5 of the encoded audio doesn't match the source: [{full_path_in}]")
+                song.update(analysis.tags())
+                song.save(padding=self._keep_padding)
+        os.replace(temp_file, full_path_out)
+
+        return content_hash.hexdigest(), analysis
+
+    def _stream_args(self, wav_info, raw_format, tags, cover_pic, path_out):
+        """
+        Build the ffmpeg command line that encodes raw PCM data, read from stdin, to a FLAC file.
+        """
+        args = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-y',
+                '-f', raw_format, '-ar', str(wav_info.sample_rate), '-ac', str(wav_info.channels), '-i', 'pipe:0']
+        if cover_pic is not None:
+            # Using FLAC library doesn't make the image show up on Sony Walkman device; ffmpeg's attached picture
+            # does, see the remux in _process_job.
+            args += ['-i', cover_pic, '-map', '0:a', '-map', '1:v', '-disposition:v', 'attached_pic']
+        for k, v in tags.items():
+            args += ['-metadata', f'{k}={v}']
+        args += ['-c:a', 'flac'] + self.profile.ffmpeg_args()
+        args += ['-metadata_header_padding', str(self.padding), '-f', 'flac', path_out]
+        return args
 
     def _parse_dir_update_tags(self, path, _b_initial=True):
+        """
+        Update the tags of all FLAC files below path. Only the files whose tags differ from the ones derived from
+        their path are written, in place if their padding allows it.
+        """
         # Reset container for failed files
         if path == self.ref_path:
             self.failed = []
+        if _b_initial:
+            self.retagged = []
+            self.tree = TreeModel.scan(path, b_stat=False)
 
-        for elem in os.listdir(path):
+        dir_info = self.tree.get(path)
+        for elem in dir_info.subdirs:
+            self._parse_dir_update_tags(os.path.join(path, elem), _b_initial=False)
+        for elem in dir_info.files:
             full_path_in = os.path.join(path, elem)
-            if os.path.isdir(full_path_in):
-                self._parse_dir_update_tags(full_path_in, _b_initial=False)
-            elif full_path_in.endswith(".flac"):
-                tags, cover_pic = self._extract_tags(full_path_in, audio_format=Format.FLAC)
+            if full_path_in.endswith(".flac"):
+                tags, _ = self._extract_tags(full_path_in, audio_format=Format.FLAC, b_prepare_cover=False)
 
                 try:
-                    song = FLAC(full_path_in)
-                    song.clear()
-                    song.update(tags)
-                    song.save()
+                    if self._write_tags(full_path_in, tags):
+                        self.retagged.append(full_path_in)
                 except Exception as e:
                     print(e.__class__.__name__)
                     print(e)
@@ -268,13 +1690,14 @@ class WAVToFlac:
 
         if _b_initial:
             print()
+            print(f"Updated the tags of {len(self.retagged)} files.")
             if not self.failed:
                 print("All files converted successfully.")
             else:
                 for e in self.failed:
                     print(f"Failed to process: [{e}]")
 
-    def _extract_tags(self, path: str, audio_format: Format = Format.FLAC):
+    def _extract_tags(self, path: str, audio_format: Format = Format.FLAC, b_prepare_cover: bool = True):
         """
         Extract tags from path and filename
 
@@ -289,6 +1712,8 @@ class WAVToFlac:
 
         :param path: the path to parse
         :param audio_format: file format
+        :param b_prepare_cover: if False, the cover image found in the directory is returned as is, without
+        resizing it.
         :return: tags, cover_pic
         """
         tags = {}
@@ -302,20 +1727,10 @@ class WAVToFlac:
             cover_pic = self._look_for_cover(dir_path)
             if cover_pic is not None:
                 cover_pic = os.path.join(dir_path, cover_pic)
-
-            #     path_cover = os.path.join(dir_path, img_cover)
-            #     path_cover_temp = os.path.splitext(path_cover)[0] + '_TEMP.jpg'
-                with open(cover_pic, 'rb') as f:
-                    img_pic = Image.open(f).convert('RGB')
-                    if img_pic.height > 500:
-                        conv = 500 / img_pic.height
-                        new_width = round(img_pic.width*conv)
-                        im_new = img_pic.resize((new_width, 500))
-                        _main, _ext = os.path.splitext(cover_pic)
-                        if not _ext.lower() in ('.jpg', '.jpeg'):
-                            cover_pic = _main + '.jpg'
-                        im_new.save(cover_pic, quality=95)
-                        print(f"Resized cover image to {new_width}px x 500px.")
+            if cover_pic is not None and b_prepare_cover:
+                # The resized JPEG is prepared once per album, in a cache outside of the library
+                cover_info = self.tree.get(dir_path).file_info(os.path.basename(cover_pic))
+                cover_pic = self.cover_cache.get(cover_pic, cover_info)
 
             #
             #     cover_pic = Picture()
@@ -335,102 +1750,18 @@ class WAVToFlac:
             #     print(f"Attempted to add cover from image [{path_cover}], mime type: [image/{img_format}]")
 
         # Get total number of tracks for disc
-        nb_tracks = len([x for x in os.listdir(os.path.dirname(path)) if x.endswith(audio_format.value)])
+        nb_tracks = self.tree.get(dir_path).ext_counts.get(audio_format.value, 0)
         tags['totaltracks'] = str(nb_tracks)
 
-        elem = path[path.rfind('/')+1:]
-        album_dir = os.path.dirname(path).replace(self.ref_path, '')[1:]  # Only the 'artist - album/disc' part
-        len_dir = len(album_dir.split('/'))
-
-        # Parse directory/ies
-        if len_dir == 1:
-            tags['totaldiscs'] = '1'
-            dir_parts = [x.strip() for x in album_dir.split(' - ', 2)]
-
-            tags['artist'] = dir_parts[0]
-            if len(dir_parts) == 2:
-                tags['album'] = dir_parts[1]
-            elif len(dir_parts) == 3:
-                tags['album'] = dir_parts[2]
-                tags['date'] = dir_parts[1][1:-1]
-            # else:
-            #     raise ValueError(f"Don't know what to do here!\n{path}")
-        elif len_dir == 2:
-            root_album_dir = path.rsplit('/', 2)[0]  # Full path to 'artist - album' part
-            album_dir_parts = album_dir.split('/')
-            root_dir, disc_dir = album_dir_parts[0], album_dir_parts[1]
-            # Get number of discs/collections
-            nb_discs = len([x for x in os.listdir(root_album_dir) if os.path.isdir(os.path.join(root_album_dir, x))])
-            tags['totaldiscs'] = str(nb_discs)
-
-            dir_parts = [x.strip() for x in root_dir.split(' - ', 2)]
-
-            # Situation of one album composed of multiple discs, with folders ending with "Disc X" or "CD X"
-            if "disc " in disc_dir.lower() or "cd " in disc_dir.lower() or "part " in disc_dir.lower():
-                tags['artist'] = dir_parts[0]
-                if len(dir_parts) == 2:
-                    tags['album'] = dir_parts[1]
-                elif len(dir_parts) == 3:
-                    tags['album'] = dir_parts[2]
-                    tags['date'] = dir_parts[1][1:-1]
-
-                disc_nr = self._extract_discnr(disc_dir)
-                if disc_nr:
-                    tags['discnumber'] = disc_nr
-
-            # Situation of one album composed of multiple discs, with each subfolder not ending with "Disc"/"CD"
-            else:
-                tags['artist'] = dir_parts[0]
-                if len(dir_parts) == 2:
-                    tags['album'] = f'{dir_parts[1]} - {disc_dir}'
-                elif len(dir_parts) == 3:
-                    tags['album'] = f'{dir_parts[2]} - {disc_dir}'
-                    tags['date'] = dir_parts[1][1:-1]
-
-            # else:
-            #     raise ValueError(f"DiscDir: Don't know what to do here!\n{path}\n{album_dir}\n{disc_dir}")
-        # Audiobooks
-        elif len_dir == 3:
-            album_dir_parts = album_dir.split('/')
-            author_dir, book_dir, disc_dir = album_dir_parts[0], album_dir_parts[1], album_dir_parts[2]
-
-            # Get number of discs
-            root_album_dir = path.rsplit('/', 2)[0]  # Full path to 'artist - album' part, without the 'disc' folder
-            nb_discs = len([x for x in os.listdir(root_album_dir) if os.path.isdir(os.path.join(root_album_dir, x))])
-            tags['totaldiscs'] = str(nb_discs)
-
-            tags['author'] = author_dir
-            tags['artist'] = author_dir
-            tags['album'] = book_dir
-
-            disc_nr = self._extract_discnr(disc_dir)
-            if disc_nr:
-                tags['discnumber'] = disc_nr
-
-        else:
-            cprint(f"Don't know what to do here!\n{path}\n{album_dir}", color='cyan')
-
-        # Strip extension and extract tags from filename
-        elem = elem[:elem.rfind('.')]
-        if len(elem) > 3 and elem[:2].isdecimal() and elem[2] == '-' or \
-                len(elem) > 5 and elem[:2].isdecimal() and elem[3] == '-':
-            song_parts = [x.strip() for x in elem.split('-', maxsplit=1)]
-        else:
-            song_parts = [x.strip() for x in elem.split(' ', maxsplit=1)]
-
-        if len(song_parts) == 2:
-            tags['tracknumber'] = song_parts[0]
-            tags['title'] = song_parts[1]
-        elif len(song_parts) == 1:
-            tags['title'] = song_parts[0]
-        else:
-            raise ValueError(f"Don't know what to do with:\n\t[{song_parts}]")
+        # Artist, album, etc. are derived once per directory; track number and title from the filename
+        tags.update(self._path_tags().parse(path))
 
         return tags, cover_pic
 
     def _look_for_cover(self, dir_path):
+        dir_info = self.tree.get(dir_path)
         imgs = []
-        for f in os.listdir(dir_path):
+        for f in dir_info.files:
             if f.lower().endswith('.jpg') or f.lower().endswith('.png'):
                 imgs.append(f)
 
@@ -440,46 +1771,26 @@ class WAVToFlac:
         elif imgs:
             min_idx, min_size = 0, math.inf
             for idx_f, f in enumerate(imgs):
-                full_path = os.path.join(dir_path, f)
-                if os.path.getsize(full_path) < min_size:
-                    min_size = os.path.getsize(full_path)
+                size = dir_info.file_info(f).size
+                if size < min_size:
+                    min_size = size
                     min_idx = idx_f
             min_file = imgs[min_idx]
 
         return min_file
 
+    def _path_tags(self):
+        """
+        Get the parser deriving tags from paths, for the current library and tree model.
+        """
+        parser = self._path_parser
+        if parser is None or parser.ref_path != self.ref_path or parser.tree is not self.tree:
+            parser = self._path_parser = PathTagParser(self.ref_path, self.tree)
+        return parser
+
     @classmethod
     def _extract_discnr(cls, disc_dir: str):
-        res = ''
-
-        offset = 4
-        disc_dir = disc_dir.lower()
-        start_idx = disc_dir.find('disc')
-        if start_idx == -1:
-            start_idx = disc_dir.find('cd')
-            offset = 2
-        if start_idx == -1:
-            return res
-
-        for c in disc_dir[start_idx + offset:]:
-            if c == ' ':
-                continue
-            elif c.isdigit():
-                res += c
-            else:
-                break
-
-        # if disc_dir.lower().startswith('disc'):
-        #     disc_nr = disc_dir[4:].strip()
-        #     if disc_nr.isdigit():
-        #         res = disc_nr
-        #
-        # elif disc_dir.lower().startswith('cd'):
-        #     disc_nr = disc_dir[2:].strip()
-        #     if disc_nr.isdigit():
-        #         res = disc_nr
-
-        return res
+        return extract_discnr(disc_dir)
 
 
 if __name__ == '__main__':